@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+"""
+Benchmarks for githelper.
+
+This script builds a synthetic tree of nested git working copies, each
+cloned from its own local bare repository, and measures how long the
+built-in subcommands and some :class:`githelper.GitWorkingCopy` API calls
+take on it.
+
+Create a fixture once, then run the benchmarks against it::
+
+    $ ./benchmark.py create /tmp/gh-fixture --repositories 40 --depth 3 --history 200 --dirty 5 --divergence 2
+    $ ./benchmark.py run /tmp/gh-fixture --output before.json
+
+Every measurement runs in a fresh child process, so each result includes the
+wall time, the number of subprocesses githelper started, the number of git
+processes launched through ``PATH`` and the peak RSS of the child process.
+To compare two revisions of githelper, point ``--githelper`` at a copy of the
+other revision and compare the result files::
+
+    $ git show HEAD~5:githelper/githelper.py > /tmp/githelper_old.py
+    $ ./benchmark.py run /tmp/gh-fixture --githelper /tmp/githelper_old.py --output before.json
+    $ ./benchmark.py run /tmp/gh-fixture --output after.json
+    $ ./benchmark.py compare before.json after.json
+
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import statistics
+import subprocess
+import importlib.util
+
+
+FIXTURE_METADATA_FILENAME = 'fixture.json'
+
+
+def fixture_environment(fixture_path):
+    """Returns an environment that isolates git from the user's configuration."""
+    home_path = os.path.join(fixture_path, 'home')
+    environment = dict(os.environ)
+    environment.update({
+        'HOME': home_path,
+        'XDG_CONFIG_HOME': os.path.join(home_path, '.config'),
+        'GIT_CONFIG_NOSYSTEM': '1',
+        'GIT_AUTHOR_NAME': 'Benchmark',
+        'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+        'GIT_COMMITTER_NAME': 'Benchmark',
+        'GIT_COMMITTER_EMAIL': 'benchmark@example.com',
+    })
+    return environment
+
+
+class FixtureBuilder(object):
+    """
+    Builds a tree of nested working copies below ``fixture_path/tree``.
+
+    Working copy 0 is the root. The others are distributed round-robin over
+    the levels 1 to ``depth``, each one nested inside the most recently created
+    working copy of the level above. Every working copy has ``history`` commits,
+    ``dirty`` modified files, and is ``divergence`` commits ahead of and behind
+    its upstream branch.
+
+    """
+
+    def __init__(self, fixture_path, repositories=20, depth=3, history=100, dirty=2, divergence=1):
+        self.fixture_path = os.path.abspath(fixture_path)
+        self.repositories = repositories
+        self.depth = depth
+        self.history = history
+        self.dirty = dirty
+        self.divergence = divergence
+        self.environment = fixture_environment(self.fixture_path)
+        self.file_count = max(dirty, 10)
+
+    def parameters(self):
+        return {
+            'repositories': self.repositories,
+            'depth': self.depth,
+            'history': self.history,
+            'dirty': self.dirty,
+            'divergence': self.divergence,
+        }
+
+    def tree_path(self):
+        return os.path.join(self.fixture_path, 'tree')
+
+    def git(self, path, *arguments, **kwargs):
+        return subprocess.check_output(('git',) + arguments, cwd=path, env=self.environment, text=True, **kwargs)
+
+    def working_copy_paths(self):
+        paths = [self.tree_path()]
+        last_path_for_level = {0: paths[0]}
+        for i in range(1, self.repositories):
+            level = (i - 1) % self.depth + 1
+            path = os.path.join(last_path_for_level[level - 1], 'sub{0:03d}'.format(i))
+            last_path_for_level[level] = path
+            paths.append(path)
+        return paths
+
+    def build(self):
+        if os.path.exists(self.fixture_path) and os.listdir(self.fixture_path):
+            raise Exception('Fixture directory {0} is not empty'.format(self.fixture_path))
+        os.makedirs(os.path.join(self.fixture_path, 'home'), exist_ok=True)
+        os.makedirs(os.path.join(self.fixture_path, 'remotes'))
+
+        for i, path in enumerate(self.working_copy_paths()):
+            remote_path = os.path.join(self.fixture_path, 'remotes', 'repo{0:03d}.git'.format(i))
+            self.build_repository(remote_path, path)
+
+        with open(os.path.join(self.fixture_path, FIXTURE_METADATA_FILENAME), 'w') as f:
+            json.dump(self.parameters(), f, indent=4, sort_keys=True)
+
+    def build_repository(self, remote_path, path):
+        name = os.path.basename(remote_path)
+        os.makedirs(remote_path)
+        self.git(remote_path, 'init', '-q', '--bare')
+        self.git(remote_path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+        self.fast_import(remote_path, self.history_stream(name))
+
+        self.git(os.path.dirname(path), 'clone', '-q', remote_path, path)
+        if self.divergence:
+            self.fast_import(remote_path, self.commit_stream(name, self.divergence, 'upstream', continue_branch=True))
+            self.git(path, 'fetch', '-q')
+            self.fast_import(path, self.commit_stream(name, self.divergence, 'local', continue_branch=True, modify_files=False))
+
+        for n in range(self.dirty):
+            with open(os.path.join(path, 'file{0}'.format(n)), 'a') as f:
+                f.write('dirty\n')
+
+    def fast_import(self, path, stream):
+        self.git(path, 'fast-import', '--quiet', input=stream)
+
+    def history_stream(self, name):
+        commands = []
+        commands.append(self.commit_command(name, 1, 'Initial commit', ['file{0}'.format(n) for n in range(self.file_count)]))
+        for i in range(2, self.history + 1):
+            commands.append(self.commit_command(name, i, 'Commit {0}'.format(i), ['file{0}'.format(i % self.file_count)]))
+        return ''.join(commands)
+
+    def commit_stream(self, name, count, kind, continue_branch=False, modify_files=True):
+        commands = []
+        for i in range(count):
+            file_names = ['{0}{1}'.format(kind, i)] if modify_files else []
+            commands.append(self.commit_command(name, self.history + i + 1, '{0} commit {1}'.format(kind.capitalize(), i + 1), file_names, continue_branch=continue_branch and i == 0))
+        return ''.join(commands)
+
+    def commit_command(self, name, number, message, file_names, continue_branch=False):
+        timestamp = int(time.time()) - (self.history + 100 - number) * 3600
+        lines = [
+            'commit refs/heads/master',
+            'committer Benchmark <benchmark@example.com> {0} +0000'.format(timestamp),
+            self.data_command(message),
+        ]
+        if continue_branch:
+            lines.append('from refs/heads/master^0')
+        for file_name in file_names:
+            lines.append('M 644 inline {0}'.format(file_name))
+            lines.append(self.data_command('{0} {1} revision {2}\n'.format(name, file_name, number)))
+        return '\n'.join(lines) + '\n\n'
+
+    @classmethod
+    def data_command(cls, text):
+        return 'data {0}\n{1}'.format(len(text.encode('utf-8')), text)
+
+
+class BenchmarkCases(object):
+    """
+    The individual measurements. Each case is a ``benchmark_`` classmethod that
+    receives the githelper module under test and the root path of the fixture tree.
+
+    """
+
+    @classmethod
+    def case_names(cls):
+        return [name[len('benchmark_'):].replace('_', '-') for name in dir(cls) if name.startswith('benchmark_')]
+
+    @classmethod
+    def case(cls, name):
+        return getattr(cls, 'benchmark_' + name.replace('-', '_'))
+
+    @classmethod
+    def run_subcommand(cls, githelper, tree_path, arguments, jobs=1):
+        global_arguments = ['-j', str(jobs)] if jobs > 1 else []
+        sys.argv = ['githelper.py', '--root_path', tree_path] + global_arguments + arguments
+        githelper.GitHelperCommandLineDriver.run()
+
+    @classmethod
+    def benchmark_tree(cls, githelper, tree_path, jobs=1):
+        cls.run_subcommand(githelper, tree_path, ['tree'], jobs=jobs)
+
+    @classmethod
+    def benchmark_status(cls, githelper, tree_path, jobs=1):
+        cls.run_subcommand(githelper, tree_path, ['status'], jobs=jobs)
+
+    @classmethod
+    def benchmark_branch(cls, githelper, tree_path, jobs=1):
+        cls.run_subcommand(githelper, tree_path, ['branch'], jobs=jobs)
+
+    @classmethod
+    def benchmark_fetch(cls, githelper, tree_path, jobs=1):
+        cls.run_subcommand(githelper, tree_path, ['fetch'], jobs=jobs)
+
+    @classmethod
+    def benchmark_each(cls, githelper, tree_path, jobs=1):
+        cls.run_subcommand(githelper, tree_path, ['each', 'git', 'rev-parse', 'HEAD'], jobs=jobs)
+
+    @classmethod
+    def benchmark_api_iterate(cls, githelper, tree_path, jobs=1):
+        [wc.path for wc in githelper.GitWorkingCopy(tree_path)]
+
+    @classmethod
+    def benchmark_api_state(cls, githelper, tree_path, jobs=1):
+        for wc in githelper.GitWorkingCopy(tree_path):
+            wc.current_branch()
+            wc.head_commit_hash()
+            wc.current_branch_upstream()
+            wc.is_dirty()
+
+    @classmethod
+    def benchmark_api_branch_names(cls, githelper, tree_path, jobs=1):
+        for wc in githelper.GitWorkingCopy(tree_path):
+            wc.branch_names()
+
+    @classmethod
+    def benchmark_api_upstream_divergence(cls, githelper, tree_path, jobs=1):
+        for wc in githelper.GitWorkingCopy(tree_path):
+            if wc.current_branch_has_upstream():
+                wc.commits_not_in_upstream()
+                wc.commits_only_in_upstream()
+
+    @classmethod
+    def benchmark_api_upstream_counts(cls, githelper, tree_path, jobs=1):
+        for wc in githelper.GitWorkingCopy(tree_path):
+            wc.commit_counts_relative_to_upstream()
+
+
+class SubprocessCounter(object):
+    """Counts subprocesses started through :class:`subprocess.Popen` in this process."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def install(self):
+        counter = self
+        original_popen = subprocess.Popen
+
+        class CountingPopen(original_popen):
+
+            def __init__(self, *args, **kwargs):
+                with counter.lock:
+                    counter.count += 1
+                super(CountingPopen, self).__init__(*args, **kwargs)
+
+        subprocess.Popen = CountingPopen
+
+
+class GitCommandLog(object):
+    """
+    Installs a ``git`` wrapper script at the front of ``PATH`` that logs each
+    invocation. This also catches git processes started by shell commands,
+    which :class:`SubprocessCounter` only sees as one shell process.
+
+    """
+
+    def __init__(self, directory_path):
+        self.directory_path = directory_path
+        self.log_path = os.path.join(directory_path, 'git-commands.log')
+        self.real_git_path = shutil.which('git')
+
+    def environment(self, environment):
+        script_path = os.path.join(self.directory_path, 'git')
+        with open(script_path, 'w') as f:
+            f.write('#!/bin/sh\necho "$*" >> "{0}"\nexec "{1}" "$@"\n'.format(self.log_path, self.real_git_path))
+        os.chmod(script_path, os.stat(script_path).st_mode | stat.S_IXUSR)
+
+        environment = dict(environment)
+        environment['PATH'] = self.directory_path + os.pathsep + environment.get('PATH', '')
+        return environment
+
+    def commands(self):
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            return f.read().splitlines()
+
+
+class BenchmarkRunner(object):
+
+    def __init__(self, fixture_path, githelper_path, cases=None, repeat=5, warmup=1, jobs=1):
+        self.fixture_path = os.path.abspath(fixture_path)
+        self.githelper_path = os.path.abspath(githelper_path)
+        self.cases = cases or BenchmarkCases.case_names()
+        self.repeat = repeat
+        self.warmup = warmup
+        self.jobs = jobs
+        self.environment = fixture_environment(self.fixture_path)
+
+    def tree_path(self):
+        return os.path.join(self.fixture_path, 'tree')
+
+    def run_case_in_child_process(self, case_name, environment=None):
+        command = [sys.executable, os.path.abspath(__file__), 'run-case', '--githelper', self.githelper_path, '--jobs', str(self.jobs), self.tree_path(), case_name]
+        start = time.perf_counter()
+        output = subprocess.check_output(command, env=environment or self.environment, cwd=self.tree_path(), text=True)
+        process_time = time.perf_counter() - start
+        result = json.loads(output)
+        result['process_time'] = process_time
+        return result
+
+    def run_case(self, case_name):
+        for i in range(self.warmup):
+            self.run_case_in_child_process(case_name)
+        samples = [self.run_case_in_child_process(case_name) for i in range(self.repeat)]
+
+        with tempfile.TemporaryDirectory() as temp_path:
+            git_command_log = GitCommandLog(temp_path)
+            self.run_case_in_child_process(case_name, environment=git_command_log.environment(self.environment))
+            git_commands = git_command_log.commands()
+
+        wall_times = [sample['wall_time'] for sample in samples]
+        process_times = [sample['process_time'] for sample in samples]
+        return {
+            'wall_times': wall_times,
+            'wall_time_min': min(wall_times),
+            'wall_time_median': statistics.median(wall_times),
+            'process_time_median': statistics.median(process_times),
+            'subprocess_count': max(sample['subprocess_count'] for sample in samples),
+            'git_command_count': len(git_commands),
+            'peak_rss_kb': max(sample['peak_rss_kb'] for sample in samples),
+        }
+
+    def run(self, progress_stream=sys.stderr):
+        with open(os.path.join(self.fixture_path, FIXTURE_METADATA_FILENAME)) as f:
+            fixture_parameters = json.load(f)
+
+        results = {}
+        for case_name in self.cases:
+            progress_stream.write('{0}... '.format(case_name))
+            progress_stream.flush()
+            results[case_name] = self.run_case(case_name)
+            progress_stream.write('{0:.3f}s\n'.format(results[case_name]['wall_time_median']))
+
+        return {
+            'githelper': self.githelper_path,
+            'githelper_revision': self.githelper_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'git': subprocess.check_output(['git', '--version'], text=True).strip(),
+            'jobs': self.jobs,
+            'repeat': self.repeat,
+            'fixture': fixture_parameters,
+            'results': results,
+        }
+
+    def githelper_revision(self):
+        try:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(self.githelper_path), stderr=subprocess.DEVNULL, text=True).strip()
+        except (subprocess.CalledProcessError, OSError):
+            return None
+
+    @classmethod
+    def peak_rss_kb(cls):
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        return peak_rss
+
+    @classmethod
+    def run_case_in_this_process(cls, githelper_path, tree_path, case_name, jobs=1):
+        """Runs one case with all output discarded and writes the measurements to stdout as JSON."""
+        spec = importlib.util.spec_from_file_location('githelper', githelper_path)
+        githelper = importlib.util.module_from_spec(spec)
+        sys.modules['githelper'] = githelper
+        spec.loader.exec_module(githelper)
+
+        counter = SubprocessCounter()
+        counter.install()
+
+        result_fd = os.dup(1)
+        devnull_fd = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull_fd, 1)
+        os.dup2(devnull_fd, 2)
+
+        os.chdir(tree_path)
+        start = time.perf_counter()
+        BenchmarkCases.case(case_name)(githelper, tree_path, jobs=jobs)
+        wall_time = time.perf_counter() - start
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        result = {
+            'wall_time': wall_time,
+            'subprocess_count': counter.count,
+            'peak_rss_kb': cls.peak_rss_kb(),
+        }
+        os.write(result_fd, json.dumps(result).encode('utf-8'))
+
+
+class BenchmarkComparison(object):
+
+    metrics = ('wall_time_median', 'subprocess_count', 'git_command_count', 'peak_rss_kb')
+
+    def __init__(self, before, after, threshold=0.1):
+        self.before = before
+        self.after = after
+        self.threshold = threshold
+
+    def rows(self):
+        for case_name in sorted(set(self.before['results']) & set(self.after['results'])):
+            for metric in self.metrics:
+                before_value = self.before['results'][case_name].get(metric)
+                after_value = self.after['results'][case_name].get(metric)
+                if before_value is None or after_value is None:
+                    continue
+                ratio = after_value / before_value if before_value else None
+                yield case_name, metric, before_value, after_value, ratio
+
+    def is_regression(self, ratio):
+        return ratio is not None and ratio > 1 + self.threshold
+
+    def print_report(self):
+        if self.before.get('fixture') != self.after.get('fixture'):
+            print('Warning: the results were measured on different fixtures', file=sys.stderr)
+
+        regressions = 0
+        print('{0:<28} {1:<18} {2:>12} {3:>12} {4:>8}'.format('case', 'metric', 'before', 'after', 'ratio'))
+        for case_name, metric, before_value, after_value, ratio in self.rows():
+            marker = ''
+            if self.is_regression(ratio):
+                marker = ' !'
+                regressions += 1
+            ratio_string = '{0:.2f}'.format(ratio) if ratio is not None else '-'
+            print('{0:<28} {1:<18} {2:>12.4g} {3:>12.4g} {4:>8}{5}'.format(case_name, metric, before_value, after_value, ratio_string, marker))
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='githelper benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    create_parser = subparsers.add_parser('create', help='Create a synthetic fixture tree of nested working copies')
+    create_parser.add_argument('fixture_path')
+    create_parser.add_argument('--repositories', type=int, default=20, help='Number of working copies, including the root')
+    create_parser.add_argument('--depth', type=int, default=3, help='Maximum nesting depth')
+    create_parser.add_argument('--history', type=int, default=100, help='Number of commits in each repository')
+    create_parser.add_argument('--dirty', type=int, default=2, help='Number of modified files in each working copy')
+    create_parser.add_argument('--divergence', type=int, default=1, help='Number of commits each working copy is ahead of and behind its upstream')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks against a fixture')
+    run_parser.add_argument('fixture_path')
+    run_parser.add_argument('--githelper', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'githelper.py'), help='Path of the githelper.py revision to measure')
+    run_parser.add_argument('--case', action='append', dest='cases', choices=BenchmarkCases.case_names(), help='Run only this case, can be given multiple times')
+    run_parser.add_argument('--repeat', type=int, default=5, help='Number of measured runs per case')
+    run_parser.add_argument('--warmup', type=int, default=1, help='Number of unmeasured runs per case')
+    run_parser.add_argument('-j', '--jobs', type=int, default=1, help='Passed to githelper as its --jobs option')
+    run_parser.add_argument('--output', help='Write the results to this JSON file instead of stdout')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative increase that counts as a regression')
+
+    run_case_parser = subparsers.add_parser('run-case')
+    run_case_parser.add_argument('--githelper', required=True)
+    run_case_parser.add_argument('--jobs', type=int, default=1)
+    run_case_parser.add_argument('tree_path')
+    run_case_parser.add_argument('case', choices=BenchmarkCases.case_names())
+
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        FixtureBuilder(args.fixture_path, repositories=args.repositories, depth=args.depth, history=args.history, dirty=args.dirty, divergence=args.divergence).build()
+    elif args.command == 'run':
+        results = BenchmarkRunner(args.fixture_path, args.githelper, cases=args.cases, repeat=args.repeat, warmup=args.warmup, jobs=args.jobs).run()
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+        else:
+            json.dump(results, sys.stdout, indent=4, sort_keys=True)
+            print()
+    elif args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        if BenchmarkComparison(before, after, threshold=args.threshold).print_report():
+            exit(1)
+    elif args.command == 'run-case':
+        BenchmarkRunner.run_case_in_this_process(args.githelper, args.tree_path, args.case, jobs=args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -98,6 +98,34 @@ See the subcommand's detailed help for an explanation of the columns.
 
 Many subcommands, ``fetch`` included, run the ``branch`` subcommand automatically after they finish.
 
+Subcommands like ``fetch``, ``pull``, ``status`` and ``each`` can process several working copies
+at the same time. Pass the ``-j`` option before the subcommand name to enable that::
+
+    $ gh -j 8 fetch
+
+The output of each working copy is still printed in one piece and in tree order.
+
+To see which commands a subcommand runs and where the time goes, pass ``--profile``.
+This prints a summary of all subprocesses to stderr when the subcommand is done.
+``--profile-json`` writes the same data to a file::
+
+    $ gh --profile branch
+    $ gh --profile-json branch-profile.json branch
+
+For scripts and dashboards, ``--format=jsonl`` makes ``tree``, ``status``, ``branch`` and ``each``
+print one JSON object per working copy and line instead, with the keys described in
+:py:meth:`GitWorkingCopy.state_record`. ``each`` adds the command's exit status and output::
+
+    $ gh --format=jsonl -j 8 each git gc --auto
+
+If you run ``tree``, ``status`` or ``branch`` often in a large tree, you can start a daemon that
+keeps the state of all working copies in memory and watches them for changes, see
+:py:class:`WorkingCopyStateDaemon`. While it runs, these subcommands get their output from it::
+
+    $ gh daemon --detach
+    $ gh b
+    $ gh daemon --stop
+
 These are just a few examples, see the command line help for the remaining subcommands.
 
 Usage as Toolkit Module
@@ -161,7 +189,8 @@ Extending with Plug-In Classes
 ==============================
 
 To extend the command line utility with additional custom subcommands, create a
-file called :file:`githelper_local.py` and store it somewhere in your :envvar:`PATH`.
+file called :file:`githelper_local.py` and store it somewhere in your :envvar:`PATH`,
+or point the :envvar:`GITHELPER_LOCAL` environment variable to it.
 The file must contain one class per subcommand. Each class name must start with
 ``Subcommand``, anything after that part is used as the actual subcommand name
 that you pass on the command line to invoke it.
@@ -192,18 +221,59 @@ API Documentation
 
 import os
 import re
+import array
 import sys
-import pickle
-import select
-import logging
+import json
+import time
+import atexit
+import codecs
+import locale
+import fnmatch
 import datetime
 import argparse
-import textwrap
+import functools
+import importlib.util
+import threading
 import itertools
+import selectors
 import subprocess
 import contextlib
 import collections
 
+
+class LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is used for the first time, then imports it
+    and forwards attribute access to it from then on. This keeps modules that most subcommands
+    don't need, asyncio in particular, out of the command line utility's startup time.
+
+    :param str name: The name of the module, this is also the name of the global variable.
+    :param str import_name: The name of the module to import, if it is a submodule of ``name``.
+
+    """
+
+    def __init__(self, name, import_name=None):
+        self.name = name
+        self.import_name = import_name or name
+        self.module = None
+
+    def __getattr__(self, attribute_name):
+        if self.module is None:
+            importlib.import_module(self.import_name)
+            self.module = sys.modules[self.name]
+        return getattr(self.module, attribute_name)
+
+
+socket = LazyModule('socket')
+struct = LazyModule('struct')
+shutil = LazyModule('shutil')
+asyncio = LazyModule('asyncio')
+hashlib = LazyModule('hashlib')
+logging = LazyModule('logging')
+tempfile = LazyModule('tempfile')
+textwrap = LazyModule('textwrap')
+concurrent = LazyModule('concurrent', 'concurrent.futures')
+
 class PopenOutputFilter:
     """
     Represents a set of inclusion/exclusion rules to filter the output of :py:class:`FilteringPopen`.
@@ -258,7 +328,7 @@ class PopenOutputFilter:
     def compile_rules(self, ruleset):
         if not ruleset:
             return None
-        return [(action, re.compile(regex_string)) for action, regex_string in ruleset]
+        return PopenOutputFilterRuleSet(ruleset)
 
     def filtered_stdoutlines(self, lines):
         if not lines:
@@ -267,10 +337,12 @@ class PopenOutputFilter:
         return [line for line in lines if self.keep_line(line, ruleset)]
 
     def keep_stdoutline(self, line):
-        return self.keep_line(line, self.stdout_rules)
+        ruleset = self.stdout_rules
+        return ruleset.keep_line(line) if ruleset else True
 
     def keep_stderrline(self, line):
-        return self.keep_line(line, self.stderr_rules)
+        ruleset = self.stderr_rules
+        return ruleset.keep_line(line) if ruleset else True
 
     def filtered_stderrlines(self, lines):
         if not lines:
@@ -279,45 +351,327 @@ class PopenOutputFilter:
         return [line for line in lines if self.keep_line(line, ruleset)]
 
     def keep_line(self, line, ruleset):
-        for rule in ruleset:
-#            print '{0} {1} {2} {3}'.format(action, regex, regex.search(line), line)
-            action, regex = rule
-            if regex.search(line):
-                if action == '+':
-                    return True
-                if action == '-':
-                    return False
+        if not ruleset:
+            return True
+        return ruleset.keep_line(line)
+
+
+class PopenOutputFilterRuleSet(object):
+    """
+    One compiled rule set of a :py:class:`PopenOutputFilter`.
+
+    The rules are prepared once so that checking a line does as little work per rule as possible:
+    each rule's action is resolved to a boolean up front, rules whose action is neither ``+`` nor
+    ``-`` are dropped because they never decide anything, and the compiled regular expressions'
+    ``search`` methods are looked up ahead of time. If all rules are plain strings without any
+    regular expression syntax, simple substring tests are used instead of regular expressions.
+
+    The first matching rule still decides, exactly like described in :py:class:`PopenOutputFilter`.
+
+    Iterating over an instance yields the ``(action, compiled_regex)`` pairs.
+
+    :param list rules: A rule set as described in :py:class:`PopenOutputFilter`.
+
+    """
+
+    regex_syntax_regex = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    def __init__(self, rules):
+        self.rules = [(action, re.compile(regex_string)) for action, regex_string in rules]
+        effective_rules = [(action, regex) for action, regex in self.rules if action in ('+', '-')]
+        self.literal_rules = None
+        self.regex_rules = None
+        if all(self.is_literal_regex(regex) for action, regex in effective_rules):
+            self.literal_rules = [(regex.pattern, action == '+') for action, regex in effective_rules]
+        else:
+            self.regex_rules = [(regex.search, action == '+') for action, regex in effective_rules]
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    @classmethod
+    def is_literal_regex(cls, regex):
+        return isinstance(regex.pattern, str) and regex.flags == re.UNICODE and not cls.regex_syntax_regex.search(regex.pattern)
+
+    def keep_line(self, line):
+        """Returns ``True`` if the line should be kept."""
+        if self.literal_rules is not None:
+            for literal, keep in self.literal_rules:
+                if literal in line:
+                    return keep
+            return True
+
+        for search, keep in self.regex_rules:
+            if search(line):
+                return keep
         return True
 
 
+class PipeLineReader(object):
+    """
+    Splits the raw output of one of :py:class:`FilteringPopen`'s pipes into lines.
+
+    Chunks of bytes are decoded incrementally, so multi-byte characters split across
+    reads are handled correctly. ``\\n``, ``\\r\\n`` and ``\\r`` all end a line, like
+    in text mode. Incomplete lines are held back until the rest arrives or the pipe is
+    closed, at which point a final line without a line ending is passed on as well.
+
+    """
+
+    line_separator_regex = re.compile(r'\r\n|\r|\n')
+
+    def __init__(self, line_handler, encoding, errors):
+        self.line_handler = line_handler
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+        self.pending = ''
+        self.byte_count = 0
+
+    def feed(self, data):
+        self.byte_count += len(data)
+        self.process_text(self.pending + self.decoder.decode(data), final=False)
+
+    def finish(self):
+        self.process_text(self.pending + self.decoder.decode(b'', final=True), final=True)
+
+    def process_text(self, text, final):
+        held_back = ''
+        if not final and text.endswith('\r'):
+            # might be the first half of a \r\n pair
+            text, held_back = text[:-1], '\r'
+        lines = self.line_separator_regex.split(text)
+        self.pending = lines.pop() + held_back
+        if final and self.pending:
+            lines.append(self.pending)
+            self.pending = ''
+        for line in lines:
+            self.line_handler(line)
+
+
+class SubprocessProfile(object):
+    """
+    Records every subprocess that githelper starts while the profile is installed, see :py:meth:`recording`.
+
+    For each command it keeps the number of invocations, the durations and the number of bytes
+    read from stdout and stderr. The command is identified by the program name, and for git also
+    the git subcommand name, for example ``git rev-parse``. Each invocation is also attributed
+    to the :py:class:`GitWorkingCopy` method (or another githelper method) that started it, and
+    to the subcommand that was running at the time. This also covers subcommands from
+    :file:`githelper_local.py` plug-ins.
+
+    Recording is thread-safe, so it works together with :py:class:`ParallelTraversal`.
+
+    The command line utility's ``--profile`` and ``--profile-json`` options use this class.
+
+    """
+
+    current = None
+    """The installed profile, or ``None``."""
+
+    plumbing_methods = frozenset(['wrapper', 'output_for_git_command', 'run_shell_command', '_check_output_in_path', '_call_in_path', 'is_git_working_copy_path', 'read_object', 'run_git_command'])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.command_records = collections.defaultdict(list)
+        self.caller_records = collections.defaultdict(list)
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def recording(cls, profile=None):
+        """
+        Installs a profile for the duration of a ``with`` block and yields it.
+
+        :param githelper.SubprocessProfile profile: The profile to install. A new one is created if this is ``None``.
+
+        """
+        previous_profile = cls.current
+        profile = profile or cls()
+        cls.current = profile
+        try:
+            yield profile
+        finally:
+            profile.end_time = time.perf_counter()
+            cls.current = previous_profile
+
+    @classmethod
+    def record_finished(cls, command, start_time, stdout_byte_count, stderr_byte_count):
+        """
+        Records one finished subprocess in the installed profile, if there is one.
+
+        :param object command: The command as passed to :py:class:`subprocess.Popen`.
+        :param float start_time: The :py:func:`time.perf_counter` value from when the subprocess was started.
+        :param int stdout_byte_count: The number of bytes read from the command's stdout.
+        :param int stderr_byte_count: The number of bytes read from the command's stderr.
+
+        """
+        profile = cls.current
+        if profile:
+            profile.record(command, time.perf_counter() - start_time, stdout_byte_count, stderr_byte_count)
+
+    @classmethod
+    def command_name(cls, command):
+        if isinstance(command, (str, bytes)):
+            words = os.fsdecode(command).split()
+        else:
+            words = [os.fsdecode(word) for word in command]
+        if not words:
+            return ''
+        words[0] = os.path.basename(words[0])
+        if words[0] == 'git':
+            words = [word for word in words if not word.startswith('-')]
+        return ' '.join(words[:2])
+
+    @classmethod
+    def calling_frame_names(cls, frame):
+        caller = None
+        subcommand = None
+        while frame:
+            receiver = frame.f_locals.get('self')
+            if receiver is not None:
+                if caller is None and isinstance(receiver, (GitWorkingCopy, AsyncGitWorkingCopy, WorkingCopySnapshot, AbstractSubcommand)) and frame.f_code.co_name not in cls.plumbing_methods:
+                    caller = '{}.{}'.format(receiver.__class__.__name__, frame.f_code.co_name)
+                if isinstance(receiver, AbstractSubcommand):
+                    subcommand = receiver.__class__.__name__
+            frame = frame.f_back
+        return caller, subcommand
+
+    def record(self, command, duration, stdout_byte_count, stderr_byte_count):
+        """
+        Records one finished subprocess. The caller is determined from the current call stack.
+
+        :param object command: The command as passed to :py:class:`subprocess.Popen`.
+        :param float duration: The wall clock time in seconds.
+        :param int stdout_byte_count: The number of bytes read from the command's stdout.
+        :param int stderr_byte_count: The number of bytes read from the command's stderr.
+
+        """
+        caller, subcommand = self.calling_frame_names(sys._getframe(1))
+        name = self.command_name(command)
+        with self.lock:
+            self.command_records[name].append((duration, stdout_byte_count, stderr_byte_count))
+            self.caller_records[(subcommand, caller, name)].append(duration)
+
+    @classmethod
+    def percentile(cls, sorted_values, percent):
+        index = max(0, int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1)
+        return sorted_values[min(index, len(sorted_values) - 1)]
+
+    @classmethod
+    def duration_summary(cls, durations):
+        durations = sorted(durations)
+        return {
+            'count': len(durations),
+            'total': sum(durations),
+            'p50': cls.percentile(durations, 50),
+            'p99': cls.percentile(durations, 99),
+        }
+
+    def summary(self):
+        """
+        Returns the recorded data as a dictionary suitable for JSON serialization.
+
+        :rtype: dict
+
+        """
+        with self.lock:
+            command_records = {name: list(records) for name, records in self.command_records.items()}
+            caller_records = {key: list(durations) for key, durations in self.caller_records.items()}
+
+        commands = []
+        for name, records in command_records.items():
+            command = self.duration_summary([record[0] for record in records])
+            command['command'] = name
+            command['stdout_bytes'] = sum(record[1] for record in records)
+            command['stderr_bytes'] = sum(record[2] for record in records)
+            commands.append(command)
+        commands.sort(key=lambda i: i['total'], reverse=True)
+
+        callers = []
+        for (subcommand, caller, name), durations in caller_records.items():
+            summary = self.duration_summary(durations)
+            summary.update({'subcommand': subcommand, 'caller': caller, 'command': name})
+            callers.append(summary)
+        callers.sort(key=lambda i: i['total'], reverse=True)
+
+        end_time = self.end_time or time.perf_counter()
+        return {
+            'wall_time': end_time - self.start_time,
+            'subprocess_count': sum(command['count'] for command in commands),
+            'subprocess_time': sum(command['total'] for command in commands),
+            'commands': commands,
+            'callers': callers,
+        }
+
+    def write_json(self, path):
+        """Writes :py:meth:`summary` to the file at ``path``."""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+    def print_summary(self, file=None):
+        """Prints :py:meth:`summary` as tables, by default to stderr."""
+        file = file or sys.stderr
+        summary = self.summary()
+        print('{subprocess_count} subprocesses, {subprocess_time:.3f}s subprocess time, {wall_time:.3f}s wall time'.format(**summary), file=file)
+
+        print(file=file)
+        print('{:>6} {:>9} {:>8} {:>8} {:>10} {:>10}  {}'.format('count', 'total', 'p50', 'p99', 'stdout', 'stderr', 'command'), file=file)
+        for command in summary['commands']:
+            print('{count:>6} {total:>9.3f} {p50:>8.3f} {p99:>8.3f} {stdout_bytes:>10} {stderr_bytes:>10}  {command}'.format(**command), file=file)
+
+        print(file=file)
+        print('{:>6} {:>9}  {}'.format('count', 'total', 'caller'), file=file)
+        for caller in summary['callers']:
+            origin = caller['caller']
+            if caller['subcommand'] and not (origin or '').startswith(caller['subcommand'] + '.'):
+                origin = ' '.join(name for name in (caller['subcommand'], origin) if name)
+            print('{:>6} {:>9.3f}  {} ({})'.format(caller['count'], caller['total'], origin or '-', caller['command']), file=file)
+
+
 class FilteringPopen(object):
     """
     A wrapper around :py:class:`subprocess.Popen` that filters the subprocess's output.
 
     The constructor's parameters are forwarded mostly unchanged to :py:class:`Popen's constructor <subprocess.Popen>`.
-    Exceptions are ``bufsize``, which is set to ``1`` for line-buffered output, and ``stdout``, and ``stderr``,
-    which are both set to :py:data:`subprocess.PIPE`.
+    Exceptions are ``stdout`` and ``stderr``, which are both set to :py:data:`subprocess.PIPE`, and ``bufsize``,
+    ``text``, ``universal_newlines``, ``encoding`` and ``errors``, because the output is always read
+    as raw bytes and decoded into lines by :py:class:`FilteringPopen` itself. ``encoding`` and ``errors``
+    select the decoding and default to the locale's preferred encoding and ``replace``. The lines are
+    always text, so a false ``text`` or ``universal_newlines`` value raises :py:exc:`ValueError`.
 
     This method sets up the Popen instance but does not run it. See :py:meth:`run` for that.
 
     """
 
+    read_chunk_size = 64 * 1024
+
     def __init__(self, *args, **kwargs):
         self.stdoutbuffer = []
         self.stderrbuffer = []
         self.cmd = args[0]
         self.wd = kwargs.get('cwd', None)
 
-        kwargs['bufsize'] = 1;
+        self.encoding = kwargs.pop('encoding', None) or locale.getpreferredencoding(False)
+        self.errors = kwargs.pop('errors', None) or 'replace'
+        for name in ('text', 'universal_newlines'):
+            value = kwargs.pop(name, None)
+            if value is not None and not value:
+                raise ValueError('FilteringPopen always decodes the output into text lines, {}={!r} is not supported'.format(name, value))
+
+        kwargs['bufsize'] = 0
         kwargs['stdout'] = subprocess.PIPE
         kwargs['stderr'] = subprocess.PIPE
 
+        self.start_time = time.perf_counter()
         self.popen = subprocess.Popen(*args, **kwargs)
 
     def run(self, filter=None, filter_rules=None, store_stdout=True, store_stderr=True, echo_stdout=True, echo_stderr=True, check_returncode=True, header=None):
         """
         Run the command and capture its (potentially filtered) output, similar to :py:meth:`subprocess.Popen.communicate`.
 
+        Both pipes are read as their output arrives, so the method returns as soon as the command exits
+        and closes them.
+
         :param githelper.PopenOutputFilter filter: An optional filter for stderr and stdout.
         :param array filter_rules: Instead of a :py:class:`PopenOutputFilter` instance, you can also pass a rule set directly.
         :param bool store_stdout: If ``False``, the command's output will not be stored for later retrieval. If set to ``True``, the output can be retrieved through the :py:meth:`stdoutlines` method after it has finished executing.
@@ -343,48 +697,55 @@ class FilteringPopen(object):
         self.echo_stdout = echo_stdout
         self.echo_stderr = echo_stderr
 
-        returncode = None
-        while returncode is None:
-            self.check_pipes()
-            returncode = self.popen.poll()
-        self.check_pipes(0)
+        self.read_pipes()
+        returncode = self.popen.wait()
+
+        SubprocessProfile.record_finished(self.cmd, self.start_time, self.stdout_reader.byte_count, self.stderr_reader.byte_count)
 
         if check_returncode and returncode:
             wd = self.wd if self.wd else os.getcwd()
-            raise Exception('Non-zero exit status for shell command "{}" in {}'.format(self.cmd, self.wd))
-
-    def check_pipes(self, timeout=1):
-        logging.debug('about to select(), timeout = {}'.format(timeout))
-        ready_read_handles = select.select([self.popen.stdout, self.popen.stderr], (), (), timeout)[0]
-        for handle in ready_read_handles:
-            is_stdout = False
-            is_stderr = False
-            if handle == self.popen.stdout:
-                is_stdout = True
-            if handle == self.popen.stderr:
-                is_stderr = True
-            while True:
-                line = handle.readline().rstrip('\n')
-                if not line:
-                    break
-                if handle == self.popen.stdout:
-                    if self.filter and not self.filter.keep_stdoutline(line):
+            raise Exception('Non-zero exit status for shell command "{}" in {}'.format(self.cmd, wd))
+
+    def read_pipes(self):
+        self.stdout_reader = PipeLineReader(self.handle_stdout_line, self.encoding, self.errors)
+        self.stderr_reader = PipeLineReader(self.handle_stderr_line, self.encoding, self.errors)
+        with selectors.DefaultSelector() as selector:
+            for handle, reader in ((self.popen.stdout, self.stdout_reader), (self.popen.stderr, self.stderr_reader)):
+                os.set_blocking(handle.fileno(), False)
+                selector.register(handle, selectors.EVENT_READ, reader)
+
+            while selector.get_map():
+                for key, events in selector.select():
+                    try:
+                        data = os.read(key.fd, self.read_chunk_size)
+                    except BlockingIOError:
                         continue
-                    if self.store_stdout:
-                        self.stdoutbuffer.append(line)
-                    if self.echo_stdout:
-                        self.print_header_once()
-                        with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
-                            print(line, file=sys.stderr)
-                elif handle == self.popen.stderr:
-                    if self.filter and not self.filter.keep_stderrline(line):
-                        continue
-                    if self.store_stderr:
-                        self.stderrbuffer.append(line)
-                    if self.echo_stderr:
-                        self.print_header_once()
-                        with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
-                            print(line, file=sys.stdout)
+                    if data:
+                        key.data.feed(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        key.data.finish()
+
+    def handle_stdout_line(self, line):
+        if self.filter and not self.filter.keep_stdoutline(line):
+            return
+        if self.store_stdout:
+            self.stdoutbuffer.append(line)
+        if self.echo_stdout:
+            self.print_header_once()
+            with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
+                print(line, file=sys.stderr)
+
+    def handle_stderr_line(self, line):
+        if self.filter and not self.filter.keep_stderrline(line):
+            return
+        if self.store_stderr:
+            self.stderrbuffer.append(line)
+        if self.echo_stderr:
+            self.print_header_once()
+            with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
+                print(line, file=sys.stdout)
 
     def print_header_once(self):
         if self.did_print_header or not self.header:
@@ -453,11 +814,210 @@ class ANSIColor(object):
         return '{}{}{}'.format(cls.start_sequence(color), value, cls.clear_sequence())
 
 
+class BufferedOutputStream(object):
+    """
+    A stand-in for :py:data:`sys.stdout` or :py:data:`sys.stderr` used by :py:class:`ParallelTraversal`.
+
+    Writes from a thread that has an output buffer installed go into that buffer, together
+    with the original stream they were meant for. Writes from all other threads pass straight
+    through to the original stream.
+
+    """
+
+    def __init__(self, stream, thread_state):
+        self.stream = stream
+        self.thread_state = thread_state
+
+    def write(self, string):
+        buffer = getattr(self.thread_state, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(string)
+        buffer.append((self.stream, string))
+        return len(string)
+
+    def flush(self):
+        if getattr(self.thread_state, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ParallelTraversal(object):
+    """
+    Runs a :py:meth:`GitWorkingCopy.traverse` callable on a bounded pool of worker threads.
+
+    The root working copy is processed first on the calling thread, so a callable that returns
+    :py:data:`GitWorkingCopy.STOP_TRAVERSAL` for the root stops the traversal exactly like the
+    sequential mode does. The remaining working copies are then processed concurrently. Anything
+    they print to stdout or stderr is buffered per working copy and written out in tree order, so
+    the output of different working copies never interleaves.
+
+    If a callable returns :py:data:`GitWorkingCopy.STOP_TRAVERSAL` for a nested working copy, no
+    further working copies are started. Working copies that were already running at that point
+    finish and their output is printed.
+
+    Unlike the sequential mode, the current working directory is not changed, so the callable
+    must not depend on it. All :py:class:`GitWorkingCopy` methods run their commands in the
+    working copy's path explicitly.
+
+    :param int jobs: The maximum number of working copies processed at the same time.
+    :param bool parents_first: If ``True``, a working copy is only processed after its parent working copy
+                               is done, for callables that modify the working copies. Working copies in
+                               different subtrees are still processed concurrently.
+    :param bool completion_order: If ``True``, the output of each working copy is written as soon as it is done
+                                  instead of in tree order.
+
+    """
+
+    def __init__(self, jobs, parents_first=False, completion_order=False):
+        self.jobs = max(1, jobs)
+        self.parents_first = parents_first
+        self.completion_order = completion_order
+        self.thread_state = threading.local()
+        self.finished_events = {}
+
+    def run(self, root_wc, iterator):
+        items = iter(root_wc)
+        root_item = next(items)
+        if iterator(root_item) is GitWorkingCopy.STOP_TRAVERSAL:
+            return
+
+        with self.buffered_output():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                self.process_items(executor, items, iterator)
+
+    def process_items(self, executor, items, iterator):
+        window_size = self.jobs * 4
+        pending = collections.deque()
+        should_stop = False
+        while True:
+            while not should_stop and len(pending) < window_size:
+                item = next(items, None)
+                if item is None:
+                    break
+                if self.parents_first:
+                    self.finished_events[id(item)] = threading.Event()
+                pending.append(executor.submit(self.run_item_with_buffered_output, iterator, item))
+
+            if not pending:
+                break
+
+            future = self.next_finished_future(pending)
+            if future.cancelled():
+                continue
+            result, buffer, exception = future.result()
+            self.write_buffer(buffer)
+            if exception is not None:
+                for other_future in pending:
+                    other_future.cancel()
+                self.finish_running_items(pending)
+                raise exception
+            if result is GitWorkingCopy.STOP_TRAVERSAL:
+                should_stop = True
+                for other_future in pending:
+                    other_future.cancel()
+
+    def next_finished_future(self, pending):
+        if not self.completion_order:
+            return pending.popleft()
+        done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        future = next(i for i in pending if i in done)
+        pending.remove(future)
+        return future
+
+    def finish_running_items(self, pending):
+        for future in pending:
+            if future.cancelled():
+                continue
+            result, buffer, exception = future.result()
+            self.write_buffer(buffer)
+
+    def run_item_with_buffered_output(self, iterator, item):
+        buffer = []
+        self.thread_state.buffer = buffer
+        try:
+            if self.parents_first:
+                # the parent was submitted first, so it is already running or done
+                parent_finished = self.finished_events.get(id(getattr(item, 'parent', None)))
+                if parent_finished:
+                    parent_finished.wait()
+            return iterator(item), buffer, None
+        except Exception as e:
+            return None, buffer, e
+        finally:
+            self.thread_state.buffer = None
+            if self.parents_first:
+                self.finished_events[id(item)].set()
+
+    @classmethod
+    def write_buffer(cls, buffer):
+        for stream, string in buffer:
+            stream.write(string)
+        for stream in set(stream for stream, string in buffer):
+            stream.flush()
+
+    @contextlib.contextmanager
+    def buffered_output(self):
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        sys.stdout = BufferedOutputStream(original_stdout, self.thread_state)
+        sys.stderr = BufferedOutputStream(original_stderr, self.thread_state)
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = original_stdout, original_stderr
+
+
 class GitRevision(object):
 
-    def __init__(self, revision, message):
+    """
+    One commit from the output of ``git log``.
+
+    Instances only hold the commit hash, subject line and, for records created by
+    :py:meth:`GitWorkingCopy.iter_log`, the author and date, so that large numbers
+    of them can be kept around cheaply.
+
+    """
+
+    __slots__ = ('revision', 'message', 'author', 'date')
+
+    log_format = '%H%x00%an%x00%ad%x00%s'
+    """The ``git log --format`` value for the NUL-separated fields read by :py:meth:`from_log_fields`."""
+
+    log_field_count = 4
+
+    def __init__(self, revision, message, author=None, date=None):
         self.revision = revision
         self.message = message
+        self.author = author
+        self.date = date
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(self.__class__.__name__, self.revision[:12], self.message)
+
+    @classmethod
+    def from_log_fields(cls, fields):
+        """Returns a new instance for the list of fields of one commit in :py:attr:`log_format` order."""
+        revision, author, date, message = fields
+        return cls(revision, message, author=author, date=date)
+
+    @classmethod
+    def parse_log_output(cls, output):
+        """
+        Returns a generator of instances for the output of ``git log -z --format=`` with :py:attr:`log_format`.
+
+        :param str output: The complete output of the command.
+
+        """
+        fields = output.split('\0')
+        if fields and not fields[-1]:
+            fields.pop()
+        for index in range(0, len(fields) - cls.log_field_count + 1, cls.log_field_count):
+            yield cls.from_log_fields(fields[index:index + cls.log_field_count])
+
+    def oneline_description(self):
+        """Returns the abbreviated hash, date and subject in one line."""
+        return '{}  {}  {}'.format(self.revision[:12], self.date, self.message)
 
     @classmethod
     def parse_log_line_oneline(cls, log_line):
@@ -472,132 +1032,1186 @@ class GitRevision(object):
         return [cls.parse_log_line_oneline(line) for line in log_lines]
 
 
-class GitWorkingCopy(object):
-    """
-    A class to represent a git working copy.
-
-    :param str path: The file system path to the working copy.
-    :param githelper.GitWorkingCopy parent: A parent instance, you don't usually use this yourself.
+class GitObjectReader(object):
     """
+    A long-lived ``git cat-file --batch`` process that answers object lookups for one repository
+    over a pipe, so that each lookup does not have to pay for starting a new git process.
 
-    STOP_TRAVERSAL = False
-    """returned from a :py:meth:`~AbstractSubcommand.__call__` implementation to stop further recursion by :py:meth:`traverse`."""
-
-    DID_LOG_ABOUT_CACHED_CHILD_LIST = False
-
-    def __init__(self, path, parent=None, verbose=False):
-        self.path = os.path.abspath(path)
-        self.parent = parent
-        self.child_list = None
-        self.verbose = verbose
+    The process is started on the first lookup. Lookups from different threads are serialized.
+    You don't usually create instances yourself, use :py:meth:`GitWorkingCopy.read_object`,
+    which gets them from the shared :py:class:`GitObjectReaderPool`.
 
-        status = subprocess.call('git status 1>/dev/null 2>/dev/null', shell=True, cwd=self.path)
-        if status:
-            raise Exception('{0} is not a git working copy'.format(self.path))
+    :param str path: The path of the working copy or git directory.
 
-    def __str__(self):
-        flags = ''
-        if not self.current_branch_has_upstream():
-            flags += 'l' # l for local-only
-        if self.is_dirty():
-            flags += '*'
-        if flags:
-            flags = ' ' + flags
+    """
 
-        return '<{0}{1}>'.format(self.root_relative_path(), flags)
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.process = None
+        self.is_closed = False
 
-    def root_relative_path(self):
-        if self.is_root():
-            return os.path.basename(self.path)
-        else:
-            root_prefix = os.path.dirname(self.root_working_copy().path)
-            return self.path[len(root_prefix) + 1:]
+    def start(self):
+        start_time = time.perf_counter()
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        SubprocessProfile.record_finished(['git', 'cat-file'], start_time, 0, 0)
 
-    def current_branch(self):
-        """Returns the name of the current git branch"""
-        output = self.output_for_git_command('git branch -a'.split())
-        [branch] = [i[2:] for i in output if i.startswith('* ')]
-        return branch
+    def read_object(self, name):
+        """
+        Looks up an object.
 
-    def fork_point_commit_id_for_branch(self, other_branch):
-        """Returns the fork point with another branch"""
-        cmd = ['git', 'merge-base', '--fork-point', other_branch]
-        output = self.output_for_git_command(cmd)
-        if len(output) != 1:
-            return None
-        return output[0].strip()
+        Returns a tuple of the object id, the object type and the object contents as bytes,
+        or ``None`` if there is no such object. If the reader was closed by its pool in the
+        meantime, returns :py:data:`GitObjectReader.CLOSED` instead.
 
-    def tags_pointing_at(self, commit_reference):
-        """Returns a list of tags that point to the given commit"""
-        return self.output_for_git_command(['git', 'tag', '-l', '--points-at', commit_reference])
+        :param str name: An object id or any other revision expression that names one object.
 
-    def tags_pointing_at_head_commit(self):
-        """Returns a list of tags that point to the head commit"""
-        return self.tags_pointing_at(self.head_commit_hash())
+        """
+        if '\n' in name:
+            raise Exception('Invalid object name "{}"'.format(name))
+
+        with self.lock:
+            if self.is_closed:
+                return self.CLOSED
+            if not self.process:
+                self.start()
+            try:
+                self.process.stdin.write(name.encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+                header = self.process.stdout.readline()
+                if not header:
+                    raise Exception('git cat-file exited unexpectedly in "{}"'.format(self.path))
+                fields = header.decode('utf-8', 'replace').split()
+                if len(fields) != 3 or fields[-1] in ('missing', 'ambiguous'):
+                    return None
+                object_id, object_type, size = fields
+                contents = self.process.stdout.read(int(size) + 1)[:-1]
+            except Exception:
+                self.stop()
+                raise
+            return object_id, object_type, contents
+
+    def stop(self):
+        if not self.process:
+            return
+        process, self.process = self.process, None
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
 
-    def head_commit_hash(self):
-        return self.output_for_git_command(['git', 'rev-parse', 'HEAD'])[0][:8]
+    def close(self):
+        """Terminates the git process. The reader can't be used after this."""
+        with self.lock:
+            self.is_closed = True
+            self.stop()
 
-    def head_commit_age(self):
-        head_commit_timestamp = self.output_for_git_command(['git', 'show', '--format=%ct', '--no-patch', 'HEAD'])[0]
-        return datetime.datetime.now() - datetime.datetime.fromtimestamp(int(head_commit_timestamp))
 
-    def head_commit_age_approximate_string(self):
-        seconds = self.head_commit_age().total_seconds()
+GitObjectReader.CLOSED = object()
 
-        days = int(seconds / (60 * 60 * 24))
-        if days:
-            return '{}d'.format(days)
 
-        hours = int(seconds / (60 * 60))
-        if hours:
-            return '{}h'.format(hours)
+class GitObjectReaderPool(object):
+    """
+    A bounded pool of :py:class:`GitObjectReader` instances, one per repository.
 
-        minutes = int(seconds / 60)
-        if minutes:
-            return '{}m'.format(minutes)
+    When the pool is full, the least recently used reader is closed to make room, so the number of
+    git processes stays bounded even for trees with hundreds of working copies. The readers of the
+    shared pool are closed when the interpreter exits.
 
-        return '{}s'.format(int(seconds))
+    :param int size: The maximum number of readers kept open at the same time.
 
-    def current_repository(self):
-        """Returns the name of the current git repository."""
-        output = self.output_for_git_command('git remote -v'.split())[0]
-        repository_names = re.findall(r'/([^/]+?)(?:\s|\.git)', output)
-        return repository_names[0]
+    """
 
-    def has_branch(self, branch_name):
-        """Returns True if the working copy has a git branch with the given name"""
-        return branch_name in self.branch_names()
+    default_size = 16
+    shared = None
 
-    def branch_names(self):
-        """Returns a list of git branch names."""
-        output = self.output_for_git_command('git branch -a'.split())
-        return [i[2:] for i in output]
+    def __init__(self, size=None):
+        self.size = size or self.default_size
+        self.readers = collections.OrderedDict()
+        self.lock = threading.Lock()
 
-    def remote_branch_names(self):
+    @classmethod
+    def shared_pool(cls):
+        """Returns the pool used by :py:class:`GitWorkingCopy`."""
+        if cls.shared is None:
+            cls.shared = cls()
+            atexit.register(cls.shared.close_all)
+        return cls.shared
+
+    def reader_for_path(self, path):
+        evicted_readers = []
+        with self.lock:
+            reader = self.readers.pop(path, None) or GitObjectReader(path)
+            self.readers[path] = reader
+            while len(self.readers) > self.size:
+                evicted_readers.append(self.readers.popitem(last=False)[1])
+        for evicted_reader in evicted_readers:
+            evicted_reader.close()
+        return reader
+
+    def read_object(self, path, name):
         """
-        Returns a list of git branch names starting with ``remote/``.
+        Looks up an object in the repository at ``path``, see :py:meth:`GitObjectReader.read_object`.
 
-        The leading ``remote/`` part will be removed.
         """
-        return [i[8:] for i in self.branch_names() if i.startswith('remotes/')]
+        while True:
+            result = self.reader_for_path(path).read_object(name)
+            if result is not GitObjectReader.CLOSED:
+                return result
+
+    def close(self, path):
+        """Closes the reader for ``path``, if there is one. A new one is started on the next lookup."""
+        with self.lock:
+            reader = self.readers.pop(path, None)
+        if reader:
+            reader.close()
+
+    def close_all(self):
+        with self.lock:
+            readers = list(self.readers.values())
+            self.readers.clear()
+        for reader in readers:
+            reader.close()
+
+
+class GitRefReader(object):
+    """
+    Reads ``HEAD`` and the branch refs of a repository directly from its git directory, without running git.
 
-    def local_branch_names(self):
-        """Returns a list of git branch names not starting with ``remote/``."""
-        return [i for i in self.branch_names() if not i.startswith('remotes/')]
+    Both loose refs and the ``packed-refs`` file are supported, as are working copies whose ``.git``
+    entry is a file pointing somewhere else, like linked worktrees and submodules. Files are only
+    parsed again when their modification time, size or inode changes, so repeated queries are cheap.
 
-    def remote_branch_name_for_name_list(self, name_list):
-        """
-        Returns a remote branch name matching a list of candidate strings.
+    Repositories that use the reftable ref storage format or that are selected with the
+    ``GIT_DIR`` environment variable are not supported, :py:meth:`is_supported` returns ``False``
+    for them and callers have to fall back to running git.
 
-        Tries to find a remote branch names using all possible combinations
-        of the names in the list. For example, given::
+    :param str path: The path of the working copy.
 
-            ['foo', 'bar']
+    """
 
-        as ``name_list``, it would find any of these::
+    def __init__(self, path):
+        self.path = path
+        self.git_directory = self.find_git_directory(path)
+        self.common_directory = None
+        if self.git_directory:
+            self.common_directory = self.git_directory
+            commondir = self.read_file(os.path.join(self.git_directory, 'commondir'))
+            if commondir:
+                self.common_directory = os.path.normpath(os.path.join(self.git_directory, commondir.strip()))
+        self.file_cache = {}
 
-            remotes/foo
+    @classmethod
+    def find_git_directory(cls, path):
+        """
+        Returns the git directory of the working copy at ``path`` or one of its parent directories,
+        or ``None`` if there is none or it is selected through the environment.
+
+        """
+        if 'GIT_DIR' in os.environ:
+            return None
+        while True:
+            dot_git_path = os.path.join(path, '.git')
+            if os.path.isdir(dot_git_path):
+                return dot_git_path
+            if os.path.isfile(dot_git_path):
+                contents = cls.read_file(dot_git_path) or ''
+                match = re.match(r'gitdir: (.+)', contents)
+                if not match:
+                    return None
+                return os.path.normpath(os.path.join(path, match.group(1).strip()))
+            parent_path = os.path.dirname(path)
+            if parent_path == path:
+                return None
+            path = parent_path
+
+    @classmethod
+    def read_file(cls, path):
+        try:
+            with open(path, encoding='utf-8', errors='surrogateescape') as f:
+                return f.read()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+
+    def is_supported(self):
+        """Returns ``True`` if the receiver can read the repository's refs."""
+        return bool(self.git_directory) and not os.path.exists(os.path.join(self.common_directory, 'reftable'))
+
+    def cached_file_contents(self, path, parser):
+        """
+        Returns the contents of the file at ``path``, processed by the ``parser`` callable, or ``None``
+        if it does not exist. The result is cached until the file changes.
+
+        """
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            self.file_cache.pop(path, None)
+            return None
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = self.file_cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        contents = self.read_file(path)
+        value = parser(contents) if contents is not None else None
+        self.file_cache[path] = (key, value)
+        return value
+
+    @classmethod
+    def parse_packed_refs(cls, contents):
+        refs = {}
+        for line in contents.splitlines():
+            if not line or line[0] in '#^':
+                continue
+            object_id, _, ref_name = line.partition(' ')
+            refs[ref_name] = object_id
+        return refs
+
+    def packed_refs(self):
+        """Returns a dictionary that maps the ref names in the ``packed-refs`` file to their object ids."""
+        return self.cached_file_contents(os.path.join(self.common_directory, 'packed-refs'), self.parse_packed_refs) or {}
+
+    def loose_ref_path(self, ref_name):
+        if ref_name == 'HEAD' or not ref_name.startswith('refs/'):
+            return os.path.join(self.git_directory, ref_name)
+        return os.path.join(self.common_directory, ref_name)
+
+    def ref_value(self, ref_name):
+        """
+        Returns the value of a ref, either an object id or ``ref: <name>`` for a symbolic ref,
+        or ``None`` if the ref does not exist.
+
+        """
+        value = self.cached_file_contents(self.loose_ref_path(ref_name), lambda contents: contents.strip())
+        if value:
+            return value
+        return self.packed_refs().get(ref_name)
+
+    def head(self):
+        """Returns the value of ``HEAD``, see :py:meth:`ref_value`."""
+        return self.ref_value('HEAD')
+
+    def resolve_ref(self, ref_name):
+        """Returns the object id a ref points to, following symbolic refs, or ``None`` if it does not exist."""
+        for i in range(10):
+            value = self.ref_value(ref_name)
+            if not value or not value.startswith('ref: '):
+                return value
+            ref_name = value[len('ref: '):]
+        return None
+
+    def current_branch(self):
+        """
+        Returns the name of the current branch, or a description of the detached head in the same
+        format as :py:meth:`WorkingCopySnapshot.branch`.
+
+        """
+        head = self.head() or ''
+        if head.startswith('ref: refs/heads/'):
+            return head[len('ref: refs/heads/'):]
+        if head.startswith('ref: '):
+            return head[len('ref: '):]
+        return '(HEAD detached at {})'.format(head[:7])
+
+    def loose_ref_names(self, prefix):
+        ref_names = []
+        directories = [(os.path.join(self.common_directory, prefix), prefix)]
+        while directories:
+            directory_path, directory_ref_name = directories.pop()
+            try:
+                entries = list(os.scandir(directory_path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                ref_name = directory_ref_name + '/' + entry.name
+                if entry.is_dir():
+                    directories.append((entry.path, ref_name))
+                elif not entry.name.endswith('.lock'):
+                    ref_names.append(ref_name)
+        return ref_names
+
+    def ref_names(self, prefix):
+        """
+        Returns the sorted full names of all refs below ``prefix``, for example ``refs/heads``.
+
+        :param str prefix: A ref directory name without a trailing slash.
+
+        """
+        ref_names = set(self.loose_ref_names(prefix))
+        ref_names.update(name for name in self.packed_refs() if name.startswith(prefix + '/'))
+        return sorted(ref_names, key=lambda name: name.encode('utf-8', 'surrogateescape'))
+
+    def branch_names(self):
+        """
+        Returns the branch names in the same form as the output of ``git branch -a``,
+        without the leading markers.
+
+        """
+        branch_names = []
+        head = self.head() or ''
+        if not head.startswith('ref: '):
+            branch_names.append(self.current_branch())
+        for prefix, display_prefix in (('refs/heads', ''), ('refs/remotes', 'remotes/')):
+            for ref_name in self.ref_names(prefix):
+                value = self.ref_value(ref_name)
+                if not value:
+                    continue
+                name = display_prefix + ref_name[len(prefix) + 1:]
+                if value.startswith('ref: '):
+                    target = value[len('ref: '):]
+                    for target_prefix in ('refs/heads/', 'refs/remotes/'):
+                        if target.startswith(target_prefix):
+                            target = target[len(target_prefix):]
+                            break
+                    name = '{} -> {}'.format(name, target)
+                branch_names.append(name)
+        return branch_names
+
+
+class WorkingCopySnapshot(object):
+    """
+    The branch, upstream, HEAD and modification state of a :py:class:`GitWorkingCopy` at one point in time.
+
+    The state is collected lazily with ``git status --porcelain=v2 --branch`` for everything but the head
+    commit's time, which is read through the working copy's :py:class:`GitObjectReader`. Untracked files
+    are not part of the state, so ``git status`` does not need to look for them. Reading several values from the
+    same snapshot is therefore much cheaper than calling the corresponding :py:class:`GitWorkingCopy` methods
+    one by one. You get an instance from :py:meth:`GitWorkingCopy.snapshot`.
+
+    :param githelper.GitWorkingCopy working_copy: The working copy to describe.
+
+    """
+
+    # status would otherwise take the index lock to write back refreshed stat data
+    status_command = 'git --no-optional-locks status --porcelain=v2 -z --branch --untracked-files=no'.split()
+
+    def __init__(self, working_copy):
+        self.working_copy = working_copy
+        self.status_headers = None
+        self.status_entries = None
+        self.head_commit_timestamp_value = None
+
+    def is_loaded(self):
+        """Returns ``True`` if the status was already collected, so that reading it does not run git."""
+        return self.status_headers is not None
+
+    def load_status(self):
+        if self.is_loaded():
+            return
+        self.parse_status_output(self.working_copy._check_output_in_path(self.status_command))
+
+    def parse_status_output(self, output):
+        # with -z, paths are not quoted and rename entries carry the original path in a separate field
+        self.status_headers = {}
+        self.status_entries = []
+        fields = iter(output.split('\0'))
+        for field in fields:
+            if not field:
+                continue
+            if field.startswith('# '):
+                key, _, value = field[2:].partition(' ')
+                self.status_headers[key] = value
+            elif field.startswith('2 '):
+                self.status_entries.append((field, next(fields, '')))
+            else:
+                self.status_entries.append((field, None))
+
+    def status_header(self, key):
+        self.load_status()
+        return self.status_headers.get(key)
+
+    def branch(self):
+        """Returns the name of the current branch, or a description of the detached head."""
+        branch = self.status_header('branch.head')
+        if branch == '(detached)':
+            return '(HEAD detached at {})'.format(self.status_header('branch.oid')[:7])
+        return branch
+
+    def upstream(self):
+        """Returns the name of the current branch's upstream branch, or ``None`` if it does not have one."""
+        if not self.has_upstream():
+            return None
+        return self.status_header('branch.upstream')
+
+    def has_upstream(self):
+        """Returns ``True`` if the current branch tracks an upstream branch that exists."""
+        # git only reports the ahead/behind counts if the upstream branch actually exists
+        return self.status_header('branch.ab') is not None
+
+    def commits_ahead_of_upstream(self):
+        """Returns the number of commits not yet pushed to upstream, or ``None`` if there is no upstream."""
+        ahead_behind = self.status_header('branch.ab')
+        if ahead_behind is None:
+            return None
+        return int(ahead_behind.split()[0])
+
+    def commits_behind_upstream(self):
+        """Returns the number of upstream commits not in the local branch, or ``None`` if there is no upstream."""
+        ahead_behind = self.status_header('branch.ab')
+        if ahead_behind is None:
+            return None
+        return -int(ahead_behind.split()[1])
+
+    def head_commit_hash(self):
+        """Returns the abbreviated head commit ID, or ``None`` if there is no commit yet."""
+        head_commit = self.status_header('branch.oid')
+        if head_commit == '(initial)':
+            return None
+        return head_commit[:8]
+
+    def head_commit_timestamp(self):
+        if self.head_commit_timestamp_value is None:
+            self.load_status()
+            head_commit = self.status_header('branch.oid')
+            if head_commit == '(initial)':
+                head_commit = 'HEAD'
+            self.head_commit_timestamp_value = self.working_copy.commit_timestamp(head_commit)
+        return self.head_commit_timestamp_value
+
+    def head_commit_age(self):
+        return datetime.datetime.now() - datetime.datetime.fromtimestamp(self.head_commit_timestamp())
+
+    def head_commit_age_approximate_string(self):
+        seconds = self.head_commit_age().total_seconds()
+
+        days = int(seconds / (60 * 60 * 24))
+        if days:
+            return '{}d'.format(days)
+
+        hours = int(seconds / (60 * 60))
+        if hours:
+            return '{}h'.format(hours)
+
+        minutes = int(seconds / 60)
+        if minutes:
+            return '{}m'.format(minutes)
+
+        return '{}s'.format(int(seconds))
+
+    def dirty_file_lines(self):
+        """Returns the paths of the files marked as modified, renamed etc., with renames shown as ``original -> new``."""
+        self.load_status()
+        dirty_file_lines = []
+        for entry, original_path in self.status_entries:
+            entry_type = entry[:1]
+            if entry_type == '1':
+                dirty_file_lines.append(entry.split(' ', 8)[8])
+            elif entry_type == '2':
+                dirty_file_lines.append('{} -> {}'.format(original_path, entry.split(' ', 9)[9]))
+            elif entry_type == 'u':
+                dirty_file_lines.append(entry.split(' ', 10)[10])
+        return dirty_file_lines
+
+    def is_dirty(self):
+        """Returns True if the working copy has uncommitted modifications."""
+        return bool(self.dirty_file_lines())
+
+    def state_record(self):
+        """
+        Returns the state as a dictionary of JSON-compatible values, see :py:meth:`GitWorkingCopy.state_record`.
+        """
+        head_commit = self.status_header('branch.oid')
+        if head_commit == '(initial)':
+            head_commit = None
+        head_commit_timestamp = self.head_commit_timestamp() if head_commit else None
+        return {
+            'path': self.working_copy.path,
+            'relative_path': self.working_copy.root_relative_path(),
+            'branch': self.branch(),
+            'upstream': self.upstream(),
+            'ahead': self.commits_ahead_of_upstream(),
+            'behind': self.commits_behind_upstream(),
+            'head': head_commit,
+            'head_commit_timestamp': head_commit_timestamp,
+            'head_commit_age_seconds': int(time.time() - head_commit_timestamp) if head_commit else None,
+            'dirty_files': self.dirty_file_lines(),
+        }
+
+    def __str__(self):
+        flags = ''
+        if not self.has_upstream():
+            flags += 'l' # l for local-only
+        if self.is_dirty():
+            flags += '*'
+        if flags:
+            flags = ' ' + flags
+
+        return '<{0}{1}>'.format(self.working_copy.root_relative_path(), flags)
+
+
+class WorkingCopyDiscoveryIndex(object):
+    """
+    A persistent record of the directories that :py:class:`WorkingCopyDiscovery` scanned, used to
+    avoid listing them again on the next run.
+
+    For each directory, the index stores its modification time, whether it contains a ``.git`` entry,
+    and the names of the subdirectories to descend into. Creating or removing an entry in a directory
+    changes the directory's modification time, so a directory whose modification time still matches
+    does not need to be listed again, and only the parts of the tree that actually changed are rescanned.
+
+    The index is stored as JSON in the root working copy's githelper configuration directory. It is
+    discarded if its format version, root path or exclusion patterns don't match.
+
+    :param str file_path: The index file's path.
+    :param str root_path: The root working copy's path.
+    :param list exclude_patterns: The exclusion patterns in effect, see :py:class:`WorkingCopyDiscovery`.
+
+    """
+
+    version = 1
+
+    # Directories modified within this many nanoseconds before they were scanned might have been
+    # modified again within the file system's timestamp granularity, so they are not trusted later.
+    racy_interval = 2 * 1000 * 1000 * 1000
+
+    def __init__(self, file_path, root_path, exclude_patterns):
+        self.file_path = file_path
+        self.root_path = root_path
+        self.exclude_patterns = list(exclude_patterns)
+        self.directories = {}
+        self.visited_directories = {}
+        self.is_modified = False
+
+    @classmethod
+    def load(cls, file_path, root_path, exclude_patterns):
+        """Returns an index with the contents of the given file if it exists and matches, or an empty one."""
+        index = cls(file_path, root_path, exclude_patterns)
+        try:
+            with open(file_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return index
+
+        if data.get('version') == cls.version and data.get('root_path') == root_path and data.get('exclude_patterns') == index.exclude_patterns:
+            index.directories = data.get('directories', {})
+        return index
+
+    def clear(self):
+        self.directories = {}
+        self.is_modified = True
+
+    def lookup(self, relative_path, modification_time):
+        """Returns the stored ``(has_git_entry, subdirectory_names)`` for the directory if it is unchanged, ``None`` otherwise."""
+        entry = self.directories.get(relative_path)
+        if not entry or entry[0] != modification_time:
+            return None
+        self.visited_directories[relative_path] = entry
+        return entry[1], entry[2]
+
+    def store(self, relative_path, modification_time, has_git_entry, subdirectory_names):
+        if modification_time >= time.time_ns() - self.racy_interval:
+            modification_time = None
+        entry = [modification_time, has_git_entry, subdirectory_names]
+        self.directories[relative_path] = entry
+        self.visited_directories[relative_path] = entry
+        self.is_modified = True
+
+    def save(self):
+        """
+        Writes the index back to disk if anything changed. Only directories visited since the index was
+        loaded are kept, so this should be called after a complete traversal of the tree.
+
+        """
+        if not self.is_modified:
+            return
+        data = {
+            'version': self.version,
+            'root_path': self.root_path,
+            'exclude_patterns': self.exclude_patterns,
+            'directories': self.visited_directories,
+        }
+        temporary_file_path = '{}.{}.tmp'.format(self.file_path, os.getpid())
+        with open(temporary_file_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(temporary_file_path, self.file_path)
+        self.directories = self.visited_directories
+        self.visited_directories = {}
+        self.is_modified = False
+
+
+class WorkingCopyDiscovery(object):
+    """
+    Finds the git working copies nested inside a directory tree.
+
+    The tree is scanned with :py:func:`os.scandir`, which does not need to stat every file. It does not
+    descend into working copies that it finds, into directories matching one of the exclusion patterns,
+    or into a directory it already visited through another symbolic link, which protects against
+    symlink cycles.
+
+    Exclusion patterns are :py:mod:`fnmatch`-style patterns. Patterns without a ``/`` are matched against
+    directory names, patterns with a ``/`` against the path relative to the root working copy.
+    The :py:data:`default_exclude_patterns` always apply, you can add more with the multi-valued
+    ``githelper.discovery.exclude`` git configuration variable in the root working copy::
+
+        $ git config --add githelper.discovery.exclude build
+        $ git config --add githelper.discovery.exclude 'data/*'
+
+    Concurrent scanning mostly pays off on slow or networked file systems with a cold cache.
+    It is off by default, you can enable it with the ``githelper.discovery.jobs`` git configuration variable.
+
+    :param list exclude_patterns: Additional exclusion patterns.
+    :param int jobs: If greater than ``1``, directories are scanned concurrently by up to this many worker threads.
+    :param githelper.WorkingCopyDiscoveryIndex index: An optional index of previously scanned directories.
+
+    """
+
+    default_exclude_patterns = ('node_modules', '__pycache__', 'DerivedData')
+    """Directories that are never scanned because they are large and practically never contain working copies."""
+
+    def __init__(self, exclude_patterns=None, jobs=1, index=None):
+        self.exclude_patterns = list(self.default_exclude_patterns) + list(exclude_patterns or [])
+        self.jobs = max(1, jobs)
+        self.index = index
+        self.visited_lock = threading.Lock()
+        name_patterns = [fnmatch.translate(i) for i in self.exclude_patterns if '/' not in i]
+        path_patterns = [fnmatch.translate(i.strip('/')) for i in self.exclude_patterns if '/' in i]
+        self.excluded_name_regex = re.compile('|'.join(name_patterns)) if name_patterns else None
+        self.excluded_path_regex = re.compile('|'.join(path_patterns)) if path_patterns else None
+
+    def is_excluded(self, name, relative_path):
+        if self.excluded_name_regex and self.excluded_name_regex.match(name):
+            return True
+        if self.excluded_path_regex and self.excluded_path_regex.match(relative_path):
+            return True
+        return False
+
+    @classmethod
+    def join_relative_path(cls, relative_path, name):
+        return relative_path + '/' + name if relative_path else name
+
+    def scan_directory(self, path, relative_path, list_working_copy=False):
+        """
+        Lists one directory. Returns whether it contains a ``.git`` entry, and the names of the subdirectories
+        to descend into. Unless ``list_working_copy`` is ``True``, the subdirectories of a directory with a ``.git``
+        entry are not listed and ``None`` is returned for them.
+
+        """
+        subdirectory_names = []
+        has_git_entry = False
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return has_git_entry, subdirectory_names
+
+        for entry in entries:
+            if entry.name == '.git':
+                has_git_entry = True
+                if not list_working_copy:
+                    return has_git_entry, None
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+            except OSError:
+                continue
+            if self.is_excluded(entry.name, self.join_relative_path(relative_path, entry.name)):
+                continue
+            subdirectory_names.append(entry.name)
+
+        subdirectory_names.sort()
+        return has_git_entry, subdirectory_names
+
+    def visit_directory(self, path, relative_path, visited, is_start):
+        """
+        Visits one directory, using the index if possible. Returns ``None`` if the directory was already
+        visited, ``True`` if it is a nested working copy, or the list of ``(path, relative_path)`` pairs
+        of its subdirectories otherwise.
+
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return []
+
+        if not is_start:
+            directory_id = (stat.st_dev, stat.st_ino)
+            with self.visited_lock:
+                if directory_id in visited:
+                    return None
+                visited.add(directory_id)
+
+        result = self.index.lookup(relative_path, stat.st_mtime_ns) if self.index else None
+        if result is None or (is_start and result[1] is None):
+            result = self.scan_directory(path, relative_path, list_working_copy=is_start)
+            if self.index:
+                self.index.store(relative_path, stat.st_mtime_ns, *result)
+
+        has_git_entry, subdirectory_names = result
+        if has_git_entry and not is_start:
+            return True
+        return [(os.path.join(path, name), self.join_relative_path(relative_path, name)) for name in subdirectory_names]
+
+    @classmethod
+    def directory_ids(cls, path, root_path=None):
+        """
+        Returns the ``(device, inode)`` pairs of ``path`` and of all of its parent directories up to ``root_path``.
+        A symbolic link to any of these would lead into a cycle.
+
+        """
+        directory_ids = set()
+        while True:
+            stat = os.stat(path)
+            directory_ids.add((stat.st_dev, stat.st_ino))
+            parent_path = os.path.dirname(path)
+            if not root_path or path == root_path or parent_path == path or not path.startswith(root_path):
+                break
+            path = parent_path
+        return directory_ids
+
+    @classmethod
+    def relative_path(cls, path, root_path):
+        if not root_path or path == root_path:
+            return ''
+        return os.path.relpath(path, root_path).replace(os.sep, '/')
+
+    def iter_nested_working_copy_paths(self, path, root_path=None):
+        """
+        Yields the paths of the working copies nested inside ``path`` in sorted order,
+        without descending into them. Directories are scanned one at a time, so the first
+        results are available right away.
+
+        :param str root_path: An optional parent directory of ``path``, usually the root working copy's path.
+                              Exclusion patterns with a ``/`` are relative to it, and symbolic links to
+                              any directory between the two are not followed.
+
+        """
+        visited = self.directory_ids(path, root_path)
+        stack = [(path, self.relative_path(path, root_path))]
+        while stack:
+            directory_path, relative_path = stack.pop()
+            result = self.visit_directory(directory_path, relative_path, visited, directory_path == path)
+            if result is True:
+                yield directory_path
+            elif result:
+                stack.extend(reversed(result))
+
+    def nested_working_copy_paths(self, path, root_path=None):
+        """
+        Returns a sorted list of the paths of the working copies nested inside ``path``,
+        without descending into them. If :py:attr:`jobs` is greater than ``1``, each level
+        of the directory tree is scanned concurrently.
+
+        :param str root_path: See :py:meth:`iter_nested_working_copy_paths`.
+
+        """
+        if self.jobs < 2:
+            return list(self.iter_nested_working_copy_paths(path, root_path))
+
+        visited = self.directory_ids(path, root_path)
+        working_copy_paths = []
+
+        level = [(path, self.relative_path(path, root_path))]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while level:
+                results = executor.map(lambda item: self.visit_directory(item[0], item[1], visited, item[0] == path), level)
+                next_level = []
+                for (directory_path, relative_path), result in zip(level, results):
+                    if result is True:
+                        working_copy_paths.append(directory_path)
+                    elif result:
+                        next_level.extend(result)
+                level = next_level
+
+        return sorted(working_copy_paths, key=lambda i: i.split(os.sep))
+
+
+def memoized_query(category):
+    """
+    Decorator for read-only :py:class:`GitWorkingCopy` query methods. While the working copy's
+    tree has memoization enabled (see :py:meth:`GitWorkingCopy.memoized_queries`), the result is cached
+    per working copy and argument list until the given cache category is invalidated with
+    :py:meth:`GitWorkingCopy.invalidate_query_cache`.
+
+    The decorated method gets a ``cached_result(working_copy, *args)`` attribute that returns the
+    memoized result for an argument list without running the query, or ``None`` if there is none.
+
+    :param str category: The cache category, one of the ``QUERY_CACHE_...`` constants of :py:class:`GitWorkingCopy`.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            if not self.tree.query_cache_enabled:
+                return method(self, *args)
+            key = (category, method.__name__) + args
+            if self.query_cache is None:
+                self.query_cache = {}
+            try:
+                value = self.query_cache[key]
+            except KeyError:
+                value = self.query_cache[key] = method(self, *args)
+            if isinstance(value, list):
+                # callers are free to modify returned lists
+                return list(value)
+            return value
+
+        def cached_result(self, *args):
+            if not self.query_cache:
+                return None
+            return self.query_cache.get((category, method.__name__) + args)
+
+        wrapper.cached_result = cached_result
+        return wrapper
+    return decorator
+
+
+class WorkingCopyTree(object):
+    """
+    The shared, flat representation of a tree of :py:class:`GitWorkingCopy` instances.
+
+    All working copies of a tree are stored in one list in the order in which they were instantiated,
+    the root working copy first. Each working copy's parent index and depth are stored in
+    parallel arrays, so parent, depth and root lookups don't need to walk a chain of objects.
+    The tree also holds the state that is only needed once per tree, like the discovery configuration
+    and whether query memoization is enabled.
+
+    :param githelper.GitWorkingCopy root: The root working copy.
+    :param int discovery_jobs: See :py:class:`GitWorkingCopy`.
+
+    """
+
+    __slots__ = ('working_copies', 'parent_indexes', 'depths', 'lock', 'discovery', 'discovery_jobs', 'query_cache_enabled')
+
+    def __init__(self, root, discovery_jobs=None):
+        self.working_copies = [root]
+        self.parent_indexes = array.array('l', [-1])
+        self.depths = array.array('l', [0])
+        self.lock = threading.Lock()
+        self.discovery = None
+        self.discovery_jobs = discovery_jobs
+        self.query_cache_enabled = False
+
+    def __len__(self):
+        return len(self.working_copies)
+
+    def root(self):
+        return self.working_copies[0]
+
+    def add(self, working_copy, parent_index):
+        """Appends a working copy nested inside the one at ``parent_index`` and returns its index."""
+        with self.lock:
+            self.working_copies.append(working_copy)
+            self.parent_indexes.append(parent_index)
+            self.depths.append(self.depths[parent_index] + 1)
+            return len(self.working_copies) - 1
+
+    def parent(self, index):
+        """Returns the parent of the working copy at ``index``, or ``None`` for the root working copy."""
+        parent_index = self.parent_indexes[index]
+        return self.working_copies[parent_index] if parent_index >= 0 else None
+
+    def depth(self, index):
+        return self.depths[index]
+
+    def ancestors(self, index):
+        """Returns a list of the ancestors of the working copy at ``index``, its parent first."""
+        ancestors = []
+        index = self.parent_indexes[index]
+        while index >= 0:
+            ancestors.append(self.working_copies[index])
+            index = self.parent_indexes[index]
+        return ancestors
+
+
+class GitWorkingCopy(object):
+    """
+    A class to represent a git working copy.
+
+    :param str path: The file system path to the working copy.
+    :param githelper.GitWorkingCopy parent: A parent instance, you don't usually use this yourself.
+    :param int discovery_jobs: The number of threads used to look for nested working copies, see :py:class:`WorkingCopyDiscovery`.
+                               Defaults to the ``githelper.discovery.jobs`` git configuration variable, or ``1``.
+
+    Instances use ``__slots__`` and share one :py:class:`WorkingCopyTree` per tree, which keeps
+    trees with many thousands of working copies small.
+    """
+
+    __slots__ = ('path', 'tree', 'tree_index', 'child_list', 'verbose', 'query_cache', 'ref_reader_instance')
+
+    STOP_TRAVERSAL = False
+    """returned from a :py:meth:`~AbstractSubcommand.__call__` implementation to stop further recursion by :py:meth:`traverse`."""
+
+    DID_LOG_ABOUT_CACHED_CHILD_LIST = False
+
+    QUERY_CACHE_STATUS = 'status'
+    """Query cache category for the working copy's branch, HEAD and modification state."""
+    QUERY_CACHE_REFS = 'refs'
+    """Query cache category for branches, tags and the commits relative to other refs."""
+    QUERY_CACHE_CONFIG = 'config'
+    """Query cache category for the git configuration and repository layout."""
+
+    def __init__(self, path, parent=None, verbose=False, discovery_jobs=None):
+        self.path = sys.intern(os.path.abspath(path))
+        self.child_list = None
+        self.verbose = verbose
+        self.query_cache = None
+        self.ref_reader_instance = None
+
+        if not self.is_git_working_copy_path(self.path):
+            raise Exception('{0} is not a git working copy'.format(self.path))
+
+        if parent is None:
+            self.tree = WorkingCopyTree(self, discovery_jobs=discovery_jobs)
+            self.tree_index = 0
+        else:
+            self.tree = parent.tree
+            self.tree_index = self.tree.add(self, parent.tree_index)
+
+    @property
+    def parent(self):
+        """The parent working copy, or ``None`` for the root working copy."""
+        return self.tree.parent(self.tree_index)
+
+    def depth(self):
+        """Returns the number of working copies that the receiver is nested in, ``0`` for the root working copy."""
+        return self.tree.depth(self.tree_index)
+
+    @classmethod
+    def is_git_working_copy_path(cls, path):
+        """
+        Returns True if ``path`` is inside a git working copy. This only needs to run git for
+        subdirectories of a working copy, for the top-level directory the ``.git`` entry is enough.
+
+        """
+        if not os.path.isdir(path):
+            return False
+        if os.path.exists(os.path.join(path, '.git')):
+            return True
+        start_time = time.perf_counter()
+        status = subprocess.call(['git', 'rev-parse', '--git-dir'], cwd=path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        SubprocessProfile.record_finished(['git', 'rev-parse'], start_time, 0, 0)
+        return status == 0
+
+    def __str__(self):
+        return str(self.snapshot())
+
+    @memoized_query(QUERY_CACHE_STATUS)
+    def snapshot(self):
+        """
+        Returns a :py:class:`WorkingCopySnapshot` that collects the receiver's current state
+        with a minimal number of git invocations.
+
+        While query memoization is enabled, the same snapshot is returned until the
+        :py:data:`QUERY_CACHE_STATUS` category is invalidated.
+
+        """
+        return WorkingCopySnapshot(self)
+
+    def cached_snapshot(self):
+        """
+        Returns the snapshot that :py:meth:`snapshot` memoized during the current traversal,
+        or ``None`` if there is none. Unlike :py:meth:`snapshot`, this never creates one.
+
+        """
+        return GitWorkingCopy.snapshot.cached_result(self)
+
+    @contextlib.contextmanager
+    def memoized_queries(self):
+        """
+        A :ref:`context manager <context-managers>` for the :py:keyword:`with` statement
+        that enables memoization of read-only queries for the whole tree of working copies
+        that the receiver belongs to. When the block is left, memoization is disabled again
+        and the cached results are discarded. :py:meth:`traverse` uses this for the duration
+        of a traversal.
+
+        Methods that modify the working copy through the API invalidate the affected cached
+        results themselves. If you modify a working copy in any other way while memoization
+        is enabled, call :py:meth:`invalidate_query_cache`.
+
+        """
+        tree = self.tree
+        if tree.query_cache_enabled:
+            yield
+            return
+
+        tree.query_cache_enabled = True
+        try:
+            yield
+        finally:
+            tree.query_cache_enabled = False
+            for wc in list(tree.working_copies):
+                wc.invalidate_query_cache()
+
+    def instantiated_working_copies(self):
+        if self.is_root():
+            for wc in list(self.tree.working_copies):
+                yield wc
+            return
+        yield self
+        for child in self.child_list or []:
+            for item in child.instantiated_working_copies():
+                yield item
+
+    def invalidate_query_cache(self, *categories):
+        """
+        Discards the receiver's memoized query results in the given categories, or all of them
+        if no category is given.
+
+        :param str categories: One or more of the ``QUERY_CACHE_...`` constants.
+
+        """
+        if not categories or self.QUERY_CACHE_STATUS in categories or self.QUERY_CACHE_REFS in categories:
+            GitObjectReaderPool.shared_pool().close(self.path)
+        if self.query_cache is None:
+            return
+        if not categories:
+            self.query_cache.clear()
+            return
+        for key in list(self.query_cache.keys()):
+            if key[0] in categories:
+                self.query_cache.pop(key, None)
+
+    def root_relative_path(self):
+        if self.is_root():
+            return os.path.basename(self.path)
+        else:
+            root_prefix = os.path.dirname(self.root_working_copy().path)
+            return self.path[len(root_prefix) + 1:]
+
+    def ref_reader(self):
+        """
+        Returns a :py:class:`GitRefReader` for the receiver's repository, or ``None`` if
+        its refs can't be read without running git.
+
+        """
+        if self.ref_reader_instance is None:
+            self.ref_reader_instance = GitRefReader(self.path)
+        if not self.ref_reader_instance.is_supported():
+            return None
+        return self.ref_reader_instance
+
+    def current_branch(self):
+        """Returns the name of the current git branch"""
+        ref_reader = self.ref_reader()
+        if ref_reader:
+            return ref_reader.current_branch()
+        return self.snapshot().branch()
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def fork_point_commit_id_for_branch(self, other_branch):
+        """Returns the fork point with another branch"""
+        cmd = ['git', 'merge-base', '--fork-point', other_branch]
+        output = self.output_for_git_command(cmd)
+        if len(output) != 1:
+            return None
+        return output[0].strip()
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def tags_pointing_at(self, commit_reference):
+        """Returns a list of tags that point to the given commit"""
+        return self.output_for_git_command(['git', 'tag', '-l', '--points-at', commit_reference])
+
+    def tags_pointing_at_head_commit(self):
+        """Returns a list of tags that point to the head commit"""
+        return self.tags_pointing_at(self.head_commit_hash())
+
+    def head_commit_hash(self):
+        return self.snapshot().head_commit_hash()
+
+    def head_commit_id(self):
+        """Returns the full object id of the head commit, or ``None`` if there is no commit yet."""
+        ref_reader = self.ref_reader()
+        if ref_reader:
+            return ref_reader.resolve_ref('HEAD')
+        output = self.output_for_git_command(['git', 'rev-parse', '--verify', '-q', 'HEAD'], check_returncode=False)
+        return output[0] if output else None
+
+    def read_object(self, name):
+        """
+        Looks up a git object through a long-lived ``git cat-file --batch`` process, see :py:class:`GitObjectReaderPool`.
+
+        Returns a tuple of the object id, the object type and the object contents as bytes,
+        or ``None`` if there is no such object.
+
+        :param str name: An object id or any other revision expression that names one object.
+
+        """
+        return GitObjectReaderPool.shared_pool().read_object(self.path, name)
+
+    def commit_timestamp(self, revision):
+        """
+        Returns the committer timestamp of a commit as seconds since the epoch.
+
+        :param str revision: An object id or any other revision expression that names a commit.
+
+        """
+        result = self.read_object(revision + '^{commit}')
+        if not result:
+            raise Exception('Unable to find commit "{}" in {}'.format(revision, self.path))
+        match = re.search(br'^committer .* (\d+) [+-]\d{4}$', result[2], re.MULTILINE)
+        return int(match.group(1))
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def object_statistics(self):
+        """
+        Returns the output of ``git count-objects -v`` as a dictionary, for example ``{'count': 12, 'packs': 1, ...}``.
+        ``count`` is the number of loose objects, ``packs`` the number of pack files. Sizes are in KiB.
+
+        """
+        statistics = {}
+        for line in self.output_for_git_command('git count-objects -v'.split()):
+            key, _, value = line.partition(': ')
+            statistics[key] = int(value) if value.isdigit() else value
+        return statistics
+
+    def has_commit_graph(self):
+        """
+        Returns ``True`` if the repository has a commit-graph file. git uses it to walk the commit history,
+        for example to count commits with ``git rev-list``, without parsing each commit object.
+
+        """
+        info_directory = os.path.join(self.git_common_directory(), 'objects', 'info')
+        return os.path.exists(os.path.join(info_directory, 'commit-graph')) or os.path.exists(os.path.join(info_directory, 'commit-graphs', 'commit-graph-chain'))
+
+    def head_commit_age(self):
+        return self.snapshot().head_commit_age()
+
+    def head_commit_age_approximate_string(self):
+        return self.snapshot().head_commit_age_approximate_string()
+
+    @memoized_query(QUERY_CACHE_CONFIG)
+    def current_repository(self):
+        """Returns the name of the current git repository."""
+        output = self.output_for_git_command('git remote -v'.split())[0]
+        repository_names = re.findall(r'/([^/]+?)(?:\s|\.git)', output)
+        return repository_names[0]
+
+    def has_branch(self, branch_name):
+        """Returns True if the working copy has a git branch with the given name"""
+        return branch_name in self.branch_names()
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def branch_names(self):
+        """Returns a list of git branch names, including remote branches, in the form used by ``git branch -a``."""
+        ref_reader = self.ref_reader()
+        if ref_reader:
+            return ref_reader.branch_names()
+        output = self.output_for_git_command('git branch -a'.split())
+        return [i[2:] for i in output]
+
+    def remote_branch_names(self):
+        """
+        Returns a list of git branch names starting with ``remote/``.
+
+        The leading ``remote/`` part will be removed.
+        """
+        return [i[8:] for i in self.branch_names() if i.startswith('remotes/')]
+
+    def local_branch_names(self):
+        """Returns a list of git branch names not starting with ``remote/``."""
+        return [i for i in self.branch_names() if not i.startswith('remotes/')]
+
+    def remote_branch_name_for_name_list(self, name_list):
+        """
+        Returns a remote branch name matching a list of candidate strings.
+
+        Tries to find a remote branch names using all possible combinations
+        of the names in the list. For example, given::
+
+            ['foo', 'bar']
+
+        as ``name_list``, it would find any of these::
+
+            remotes/foo
             remotes/Foo
             remotes/bar
             remotes/Bar
@@ -625,12 +2239,14 @@ class GitWorkingCopy(object):
             raise Exception('{0} does not have a branch named {1}, cannot switch'.format(self, branch_name))
 
         self.run_shell_command(['git', 'checkout', branch_name])
+        self.invalidate_query_cache(self.QUERY_CACHE_STATUS, self.QUERY_CACHE_REFS)
 
     def hard_reset_current_branch(self, target):
         """Hard-resets the current branch to the given ref"""
         self.run_shell_command(['git', 'reset', '--hard', target])
+        self.invalidate_query_cache(self.QUERY_CACHE_STATUS, self.QUERY_CACHE_REFS)
 
-    def run_shell_command(self, command, filter_rules=None, shell=None, header=None, check_returncode=True):
+    def run_shell_command(self, command, filter_rules=None, shell=None, header=None, check_returncode=True, capture_output=False):
         """
         Runs the given shell command (array or string) in the receiver's working directory using :py:class:`FilteringPopen`.
 
@@ -638,6 +2254,10 @@ class GitWorkingCopy(object):
         :param array filter_rules: Passed to :py:class:`FilteringPopen`'s constructor.
         :param bool shell: Passed to :py:class:`FilteringPopen`'s constructor.
         :param object header: Passed to :py:class:`FilteringPopen.run`.
+        :param bool capture_output: If ``True``, the output is not printed but stored in the returned :py:class:`FilteringPopen`.
+
+        Returns the :py:class:`FilteringPopen` instance, its :py:meth:`FilteringPopen.returncode`
+        is the command's exit status.
 
         """
         if shell is None:
@@ -646,13 +2266,21 @@ class GitWorkingCopy(object):
             else:
                 shell = False
 
-        popen = FilteringPopen(command, cwd=self.path, shell=shell, text=True)
-        popen.run(filter_rules=filter_rules, store_stdout=False, store_stderr=False, header=header, check_returncode=check_returncode)
+        try:
+            popen = FilteringPopen(command, cwd=self.path, shell=shell, text=True)
+            popen.run(filter_rules=filter_rules, store_stdout=capture_output, store_stderr=capture_output, echo_stdout=not capture_output, echo_stderr=not capture_output, header=header, check_returncode=check_returncode)
+            return popen
+        finally:
+            # the command could have changed anything
+            self.invalidate_query_cache()
 
     def output_for_git_command(self, command, shell=False, filter_rules=None, header=None, check_returncode=None, echo_stderr=True):
         """
         Runs the given shell command (array or string) in the receiver's working directory and returns the output.
 
+        This is meant for commands that only read information. It does not invalidate any memoized
+        query results, see :py:meth:`memoized_queries`.
+
         :param bool shell: If ``True``, runs the command through the shell. See the :py:mod:`subprocess` library module documentation for details.
 
         """
@@ -662,55 +2290,163 @@ class GitWorkingCopy(object):
 
     def is_root(self):
         """Returns True if the receiver does not have a parent working copy."""
-        return self.parent is None
+        return self.tree_index == 0
 
+    @memoized_query(QUERY_CACHE_CONFIG)
     def has_autostash_enabled(self):
         output = self.output_for_git_command('git config rebase.autoStash'.split())
         return output and output[0] == 'true'
 
     def ancestors(self):
         """
-        Returns a list of parent working copies.
+        Returns a list of parent working copies.
+
+        If the receiver is the root working copy, this returns an empty list.
+
+        """
+        return self.tree.ancestors(self.tree_index)
+
+    def current_branch_upstream(self):
+        upstream = self.snapshot().upstream()
+        return [upstream] if upstream else []
+
+    def current_branch_has_upstream(self):
+        return self.snapshot().has_upstream()
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def commits_not_in_upstream(self):
+        """
+        Returns a list of git commits that have not yet been pushed to upstream.
+        If you only need the number, use :py:meth:`commit_counts_relative_to_upstream`.
+        """
+        return list(self.iter_log(['@{u}..HEAD'], check_returncode=False))
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def commits_only_in_upstream(self):
+        """
+        Returns a list of git commits that are only in upstream but not in the local tracking branch.
+        If you only need the number, use :py:meth:`commit_counts_relative_to_upstream`.
+        """
+        return list(self.iter_log(['HEAD..@{u}'], check_returncode=False))
 
-        If the receiver is the root working copy, this returns an empty list.
+    def commit_count(self, revisions):
+        """
+        Returns the number of commits that ``git log`` would list for the given revision arguments,
+        without listing them.
+        """
+        output = self.output_for_git_command(['git', 'rev-list', '--count'] + revisions + ['--'], check_returncode=True)
+        return int(output[0])
 
+    def iter_log(self, revisions, max_count=None, skip=None, check_returncode=True, chunk_size=65536):
         """
-        ancestors = []
-        if not self.is_root():
-            ancestors.append(self.parent)
-            ancestors.extend(self.parent.ancestors())
-        return ancestors
+        Runs ``git log`` for the given revisions and returns a generator of
+        :py:class:`GitRevision` instances, newest first.
 
-    def current_branch_upstream(self):
-        output = self.output_for_git_command('git rev-parse --abbrev-ref --symbolic-full-name @{u}'.split(), filter_rules=[('-', r'fatal')])
-        return output
+        The output is read and parsed incrementally as the generator is consumed,
+        so memory use does not depend on the length of the history. If the generator
+        is closed before it is exhausted, the ``git log`` process is terminated.
 
-    def current_branch_has_upstream(self):
-        return bool(self.current_branch_upstream())
+        :param list revisions: The revision arguments for ``git log``, for example ``['main', '^HEAD']``.
+        :param int max_count: If given, at most this many commits are returned.
+        :param int skip: If given, this many commits are skipped before the first one that is returned.
+        :param bool check_returncode: If ``True``, raises an exception if ``git log`` fails. Otherwise its error output is printed and the generator ends.
 
-    def commits_not_in_upstream(self):
-        """Returns a list of git commits that have not yet been pushed to upstream."""
-        output = self.output_for_git_command('git log --oneline @{u}..HEAD'.split())
-        return GitRevision.parse_log_lines_oneline(output)
+        """
+        command = ['git', 'log', '-z', '--format=' + GitRevision.log_format]
+        if max_count is not None:
+            command.append('--max-count={}'.format(max_count))
+        if skip:
+            command.append('--skip={}'.format(skip))
+        command.extend(revisions)
+        command.append('--')
+
+        # stderr goes to a file so that a lot of error output can't block git while stdout is read
+        stderr_file = tempfile.TemporaryFile()
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, cwd=self.path, stdout=subprocess.PIPE, stderr=stderr_file)
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        byte_count = 0
+        finished = False
+        try:
+            fields = []
+            pending = ''
+            while True:
+                chunk = process.stdout.read1(chunk_size)
+                if not chunk:
+                    break
+                byte_count += len(chunk)
+                pieces = (pending + decoder.decode(chunk)).split('\0')
+                pending = pieces.pop()
+                for piece in pieces:
+                    fields.append(piece)
+                    if len(fields) == GitRevision.log_field_count:
+                        yield GitRevision.from_log_fields(fields)
+                        fields = []
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                fields.append(pending)
+            if len(fields) == GitRevision.log_field_count:
+                yield GitRevision.from_log_fields(fields)
+            finished = True
+        finally:
+            if not finished and process.poll() is None:
+                process.terminate()
+            process.stdout.close()
+            returncode = process.wait()
+            with stderr_file:
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+            SubprocessProfile.record_finished(command, start_time, byte_count, len(stderr))
+            stderr = stderr.decode('utf-8', 'replace')
+        if returncode and not check_returncode:
+            sys.stderr.write(stderr)
+        elif returncode:
+            raise Exception('Non-zero exit status {} for command "{}" in {}: {}'.format(returncode, ' '.join(command), self.path, stderr.strip()))
+
+    @memoized_query(QUERY_CACHE_REFS)
+    def commit_counts_relative_to_upstream(self, upstream='@{u}'):
+        """
+        Returns a tuple of the number of commits not yet pushed to upstream and the number of
+        upstream commits not in the local branch, or ``None`` if there is no upstream.
 
-    def commits_only_in_upstream(self):
-        """Returns a list of git commits that are only in upstream but not in the local tracking branch."""
+        This gives the same numbers as :py:meth:`commits_not_in_upstream` and :py:meth:`commits_only_in_upstream`,
+        but one ``git rev-list --count --left-right`` process counts both sides without printing any commits.
+        Counting walks the history between the branches, which is a lot faster if the repository
+        has a commit-graph file, see :py:meth:`has_commit_graph` and :py:meth:`write_commit_graph`.
+
+        :param str upstream: The branch to compare with, the upstream branch of the current branch by default.
+
+        """
+        command = ['git', 'rev-list', '--count', '--left-right', '{}...HEAD'.format(upstream)]
+        output = self.output_for_git_command(command, check_returncode=False, echo_stderr=False)
+        if len(output) != 1:
+            return None
+        behind, ahead = output[0].split()
+        return int(ahead), int(behind)
 
-        output = self.output_for_git_command('git log --oneline HEAD..@{u}'.split())
-        return GitRevision.parse_log_lines_oneline(output)
+    def write_commit_graph(self):
+        """Writes a commit-graph file for all reachable commits, see :py:meth:`has_commit_graph`."""
+        self.run_shell_command(['git', 'commit-graph', 'write', '--reachable', '--changed-paths'])
 
     def root_working_copy(self):
         """Returns the root working copy, which could be self."""
-        if self.is_root():
-            return self
-        return self.parent.root_working_copy()
+        return self.tree.root()
+
+    def _call_in_path(self, command):
+        start_time = time.perf_counter()
+        status = subprocess.call(command, cwd=self.path)
+        SubprocessProfile.record_finished(command, start_time, 0, 0)
+        return status
 
     def _check_output_in_path(self, command):
+        start_time = time.perf_counter()
         try:
-            return subprocess.check_output(command, cwd=self.path)
+            output = subprocess.check_output(command, cwd=self.path, text=True)
         except:
             print('Error running shell command in "{}":'.format(self.path), file=sys.stderr)
             raise
+        SubprocessProfile.record_finished(command, start_time, len(output.encode('utf-8')), 0)
+        return output
 
     def is_dirty(self):
         """
@@ -718,8 +2454,26 @@ class GitWorkingCopy(object):
 
         Many operations depend on a clean state.
 
+        Untracked files don't count. If a memoized :py:class:`WorkingCopySnapshot` with the status
+        is available, it is used. Otherwise this runs ``git diff --quiet`` for the work tree and then
+        ``git diff --cached --quiet`` for the index. Both stop at the first modification they find, and
+        they use the file system monitor if one is configured with ``core.fsmonitor``.
+
         """
-        return bool(self.dirty_file_lines())
+        snapshot = self.cached_snapshot()
+        if snapshot is not None and snapshot.is_loaded():
+            return snapshot.is_dirty()
+        return self.has_uncommitted_changes()
+
+    @memoized_query(QUERY_CACHE_STATUS)
+    def has_uncommitted_changes(self):
+        for command in (['git', 'diff', '--quiet'], ['git', 'diff', '--cached', '--quiet']):
+            status = self._call_in_path(command)
+            if status == 1:
+                return True
+            if status:
+                raise Exception('Non-zero exit status {} for "{}" in {}'.format(status, ' '.join(command), self.path))
+        return False
 
     def create_stash_and_reset_hard(self):
         """
@@ -738,18 +2492,40 @@ class GitWorkingCopy(object):
             print('Stashed changes, restore with "git stash apply {0}"'.format(stash_commit))
             output = self.output_for_git_command('git reset --hard'.split())
             #print '\n'.join(output)
+            self.invalidate_query_cache(self.QUERY_CACHE_STATUS)
 
         return stash_commit
 
     def apply_stash_commit(self, stash_commit):
-        #print 'Applying stash ' + stash_commit
-        output = self.output_for_git_command('git stash apply'.split() + [stash_commit])
+        """
+        Applies a stash commit created by :py:meth:`create_stash_and_reset_hard`.
+        Returns ``True`` if that worked, ``False`` if it failed, for example because of conflicts.
+
+        """
+        try:
+            popen = FilteringPopen('git stash apply'.split() + [stash_commit], cwd=self.path)
+            popen.run(echo_stdout=False, check_returncode=False)
+            return popen.returncode() == 0
+        finally:
+            self.invalidate_query_cache(self.QUERY_CACHE_STATUS)
 
     def dirty_file_lines(self):
         """Returns the output of git status for the files marked as modified, renamed etc."""
-        output = self._check_output_in_path('git status --porcelain'.split()).splitlines()
-        dirty_file_lines = [line[3:].strip('"') for line in output if not line.startswith('?')]
-        return dirty_file_lines
+        return self.snapshot().dirty_file_lines()
+
+    def state_record(self):
+        """
+        Returns the receiver's state as a dictionary that can be serialized to JSON, with these keys:
+
+        ``path``, ``relative_path``, ``branch``, ``upstream`` (``None`` if there is none),
+        ``ahead`` and ``behind`` (commit counts relative to the upstream, ``None`` if there is none),
+        ``head`` (the full head commit ID, ``None`` before the first commit), ``head_commit_timestamp``,
+        ``head_commit_age_seconds`` and ``dirty_files`` (see :py:meth:`dirty_file_lines`).
+
+        This is what the ``--format=jsonl`` command line option prints.
+
+        """
+        return self.snapshot().state_record()
 
     def info(self):
         config_path = os.path.join(self.path, '.git/config')
@@ -762,48 +2538,80 @@ class GitWorkingCopy(object):
         return os.path.basename(self.path)
 
     def children(self):
+        """Returns a list of the working copies nested directly inside the receiver."""
         if self.child_list is None:
-            self.child_list = self.cached_child_list()
-            if self.child_list is None:
-                self.child_list = []
-                for (dirpath, dirnames, filenames) in os.walk(self.path, followlinks=True):
-                    if dirpath == self.path:
-                        continue
+            for child in self.iter_children():
+                pass
+        return self.child_list
 
-                    if not '.git' in dirnames:
-                        continue
+    def iter_children(self):
+        """
+        Returns an iterator over the working copies nested directly inside the receiver.
+        Unless concurrent discovery is configured, each one is yielded as soon as it is found.
+
+        """
+        if self.child_list is not None:
+            for child in self.child_list:
+                yield child
+            return
 
-                    del dirnames[:]
+        discovery = self.working_copy_discovery()
+        root_path = self.root_working_copy().path
+        if discovery.jobs > 1:
+            paths = discovery.nested_working_copy_paths(self.path, root_path)
+        else:
+            paths = discovery.iter_nested_working_copy_paths(self.path, root_path)
 
-                    wc = GitWorkingCopy(dirpath, parent=self, verbose=self.verbose)
-                    self.child_list.append(wc)
-                self.store_cached_child_list(self.child_list)
-        return self.child_list
+        child_list = []
+        for path in paths:
+            wc = GitWorkingCopy(path, parent=self, verbose=self.verbose)
+            child_list.append(wc)
+            yield wc
+        self.child_list = child_list
 
-    def cached_child_list(self):
-        if not self.is_root():
-            return None
-        cache_file_path = os.path.join(self.githelper_config_directory(), 'cached_child_list')
-        if os.path.exists(cache_file_path):
-            age = datetime.datetime.now() - datetime.datetime.fromtimestamp(os.stat(cache_file_path).st_mtime)
-            if age.total_seconds() > 24 * 60 * 60:
-                return None
-            if self.verbose:
-                self.print_cache_message(cache_file_path)
-            with open(cache_file_path) as f:
-                return [GitWorkingCopy(dirpath, parent=self, verbose=self.verbose) for dirpath in pickle.load(f)]
+    def working_copy_discovery(self):
+        """
+        Returns the :py:class:`WorkingCopyDiscovery` used to find nested working copies in the receiver's tree.
+        It is configured from the root working copy's git configuration and uses a :py:class:`WorkingCopyDiscoveryIndex`
+        stored in the root working copy's githelper configuration directory.
+
+        """
+        root = self.root_working_copy()
+        tree = self.tree
+        if tree.discovery is None:
+            config = collections.defaultdict(list)
+            for line in root.output_for_git_command(['git', 'config', '--get-regexp', r'^githelper\.discovery\.']):
+                key, _, value = line.partition(' ')
+                config[key].append(value)
+
+            jobs = tree.discovery_jobs
+            if jobs is None:
+                jobs = int(config['githelper.discovery.jobs'][-1]) if config['githelper.discovery.jobs'] else 1
+            discovery = WorkingCopyDiscovery(config['githelper.discovery.exclude'], jobs=jobs)
+
+            index_path = os.path.join(root.githelper_config_directory(should_create=True), 'discovery_index.json')
+            discovery.index = WorkingCopyDiscoveryIndex.load(index_path, root.path, discovery.exclude_patterns)
+            if discovery.index.directories and root.verbose:
+                root.print_cache_message(index_path)
+            tree.discovery = discovery
+        return tree.discovery
+
+    def discard_discovery_index(self):
+        """Makes the next discovery of nested working copies rescan the whole tree instead of using the index."""
+        self.working_copy_discovery().index.clear()
+
+    def save_discovery_index(self):
+        """Writes the discovery index back to disk if it changed. :py:meth:`__iter__` does this after a complete iteration of the root working copy."""
+        discovery = self.tree.discovery
+        if discovery is not None and discovery.index is not None:
+            discovery.index.save()
 
     @classmethod
     def print_cache_message(cls, cache_file_path):
         if cls.DID_LOG_ABOUT_CACHED_CHILD_LIST:
             return
         cls.DID_LOG_ABOUT_CACHED_CHILD_LIST = True
-        print('Using cached subrepository list from {}'.format(cache_file_path))
-
-    def store_cached_child_list(self, child_list):
-        cache_file_path = os.path.join(self.githelper_config_directory(should_create=True), 'cached_child_list')
-        with open(cache_file_path, 'w') as f:
-            pickle.dump([wc.path for wc in child_list], f)
+        print('Using subrepository index from {}'.format(cache_file_path))
 
     def githelper_config_directory(self, should_create=False):
         config_directory_path = os.path.join(self.git_directory(), 'githelper')
@@ -811,21 +2619,37 @@ class GitWorkingCopy(object):
             os.mkdir(config_directory_path)
         return config_directory_path
 
+    @memoized_query(QUERY_CACHE_CONFIG)
     def git_directory(self):
-        with self.chdir_to_path():
-            return os.path.abspath(self.output_for_git_command('git rev-parse --git-dir'.split())[0])
+        ref_reader = self.ref_reader()
+        if ref_reader:
+            return os.path.abspath(ref_reader.git_directory)
+        return os.path.abspath(os.path.join(self.path, self.output_for_git_command('git rev-parse --git-dir'.split())[0]))
+
+    @memoized_query(QUERY_CACHE_CONFIG)
+    def git_common_directory(self):
+        """Returns the git directory that the receiver shares with its linked worktrees, if any, with objects and refs."""
+        ref_reader = self.ref_reader()
+        if ref_reader:
+            return os.path.abspath(ref_reader.common_directory)
+        return os.path.abspath(os.path.join(self.path, self.output_for_git_command('git rev-parse --git-common-dir'.split())[0]))
 
     def __iter__(self):
         """
         Returns an iterator over ``self`` and all of its nested git working copies.
 
+        Nested working copies are yielded as they are discovered, so processing can start
+        before the whole tree has been scanned.
+
         See the :ref:`example above <iteration-example>`.
 
         """
         yield self
-        for child in self.children():
+        for child in self.iter_children():
             for item in child:
                 yield item
+        if self.is_root():
+            self.save_discovery_index()
 
     def self_or_descendants_dirty_working_copies(self):
         """
@@ -841,7 +2665,7 @@ class GitWorkingCopy(object):
 
         return dirty_working_copies
 
-    def traverse(self, iterator):
+    def traverse(self, iterator, jobs=1):
         """
         Runs the given callable ``iterator`` on the receiver and all of its
         nested sub-working copies.
@@ -849,60 +2673,947 @@ class GitWorkingCopy(object):
         Before each call to iterator for a given working copy, the current directory is first
         set to that working copy's path.
 
+        Read-only queries are memoized for the duration of the traversal, see :py:meth:`memoized_queries`.
+
+        If ``iterator`` has a ``prepare_for_root`` method, it is called with the receiver before the traversal,
+        and the traversal is skipped if it returns :py:data:`GitWorkingCopy.STOP_TRAVERSAL`. If ``iterator`` has a
+        ``finish_for_root`` method, it is called with the receiver after the traversal.
+
         See the :ref:`example above <iteration-example>`.
+
+        :param int jobs: If greater than ``1``, the nested working copies are processed concurrently
+                         by up to this many worker threads. In that mode the current directory is not changed
+                         and output is buffered per working copy, see :py:class:`ParallelTraversal` for details.
         """
-        if callable(getattr(iterator, "prepare_for_root", None)):
-            if iterator.prepare_for_root(self) is GitWorkingCopy.STOP_TRAVERSAL:
-                return
+        with self.memoized_queries():
+            if callable(getattr(iterator, "prepare_for_root", None)):
+                if iterator.prepare_for_root(self) is GitWorkingCopy.STOP_TRAVERSAL:
+                    return
+
+            if not callable(iterator):
+                raise Exception('{0} is not callable'.format(iterator))
+
+            if jobs > 1:
+                parents_first = callable(getattr(iterator, 'parallel_traversal_processes_parents_first', None)) and iterator.parallel_traversal_processes_parents_first()
+                completion_order = callable(getattr(iterator, 'parallel_traversal_prints_in_completion_order', None)) and iterator.parallel_traversal_prints_in_completion_order()
+                ParallelTraversal(jobs, parents_first=parents_first, completion_order=completion_order).run(self, iterator)
+            else:
+                for item in self:
+                    with item.chdir_to_path():
+                        if iterator(item) is GitWorkingCopy.STOP_TRAVERSAL:
+                            break
+
+            if callable(getattr(iterator, 'finish_for_root', None)):
+                iterator.finish_for_root(self)
+
+    @contextlib.contextmanager
+    def chdir_to_path(self):
+        """
+        A :ref:`context manager <context-managers>` for the :py:keyword:`with` statement
+        that temporarily switches the current working directory to the receiver's working
+        copy directory::
+
+            with wc.chdir_to_path():
+                # do something useful here inside the working copy directory.
+
+        """
+        oldwd = os.getcwd()
+        os.chdir(self.path)
+        yield
+        os.chdir(oldwd)
+
+    @contextlib.contextmanager
+    def switched_to_branch(self, branch_name):
+        """
+        A :ref:`context manager <context-managers>` for the :py:keyword:`with` statement
+        that temporarily switches the current git branch to another one and afterwards
+        restores the original one.
+
+        Example::
+
+            with wc.switched_to_branch('master'):
+                # do something useful here on the 'master' branch.
+
+        """
+        old_branch = self.current_branch()
+        different_branch = old_branch != branch_name
+        if different_branch:
+            print('Temporarily switching {0} from branch {1} to {2}'.format(self, old_branch, branch_name), file=sys.stderr)
+            self.switch_to_branch(branch_name)
+
+        yield
+
+        if different_branch:
+            print('Switching {0} back to branch {1}'.format(self, old_branch), file=sys.stderr)
+            self.switch_to_branch(old_branch)
+
+
+class AsyncGitWorkingCopy(object):
+    """
+    An :py:mod:`asyncio` version of the :py:class:`GitWorkingCopy` query API.
+
+    The query methods are coroutines that run git in asyncio subprocesses, so the state of many working
+    copies can be gathered concurrently from a single thread. The current directory is never changed.
+    All instances of a tree share one semaphore that limits the number of git processes running at the
+    same time.
+
+    Unlike :py:class:`GitWorkingCopy`, query results are not memoized. Each query that needs the status
+    runs ``git status`` again, so use :py:meth:`snapshot` to read several values at once.
+
+    Example::
+
+        async def print_branches(root_path):
+            async def print_branch(wc):
+                print(wc, await wc.current_branch(), await wc.is_dirty())
+            await githelper.AsyncGitWorkingCopy(root_path).traverse(print_branch)
+
+        asyncio.run(print_branches(sys.argv[1]))
+
+    :param object working_copy: A :py:class:`GitWorkingCopy` instance, or the path of a working copy.
+    :param int max_processes: The maximum number of concurrent git processes for the whole tree.
+    :param githelper.AsyncGitWorkingCopy parent: A parent instance, you don't usually use this yourself.
+
+    """
+
+    default_max_processes = 8
+
+    def __init__(self, working_copy, max_processes=None, parent=None):
+        if not isinstance(working_copy, GitWorkingCopy):
+            working_copy = GitWorkingCopy(working_copy)
+        self.working_copy = working_copy
+        self.path = working_copy.path
+        self.parent = parent
+        self.max_processes = max_processes or self.default_max_processes
+        self.semaphore_instance = None
+        self.child_list = None
+
+    def __str__(self):
+        return '<{}>'.format(self.working_copy.root_relative_path())
+
+    def root_working_copy(self):
+        """Returns the root working copy."""
+        if self.parent:
+            return self.parent.root_working_copy()
+        return self
+
+    def semaphore(self):
+        root = self.root_working_copy()
+        if root.semaphore_instance is None:
+            root.semaphore_instance = asyncio.Semaphore(root.max_processes)
+        return root.semaphore_instance
+
+    async def run_git_command(self, command, shell=False):
+        """
+        Runs the given command (array or string) in the receiver's working directory.
+
+        Returns a tuple of the exit status, the stdout output and the stderr output.
+
+        :param bool shell: If ``True``, runs the command through the shell.
+
+        """
+        async with self.semaphore():
+            start_time = time.perf_counter()
+            if shell:
+                process = await asyncio.create_subprocess_shell(command, cwd=self.path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            else:
+                process = await asyncio.create_subprocess_exec(*command, cwd=self.path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+
+        SubprocessProfile.record_finished(command, start_time, len(stdout), len(stderr))
+        encoding = locale.getpreferredencoding(False)
+        return process.returncode, stdout.decode(encoding, 'replace'), stderr.decode(encoding, 'replace')
+
+    async def output_for_git_command(self, command, shell=False, check_returncode=None, echo_stderr=True):
+        """
+        Runs the given command (array or string) in the receiver's working directory and returns
+        the output lines, like :py:meth:`GitWorkingCopy.output_for_git_command`.
+
+        :param bool shell: If ``True``, runs the command through the shell.
+        :param bool check_returncode: If ``True``, raises an exception if the command terminates with a non-zero exit code.
+        :param bool echo_stderr: If ``False``, the command's stderr output is not printed.
+
+        """
+        returncode, stdout, stderr = await self.run_git_command(command, shell=shell)
+        if echo_stderr and stderr:
+            sys.stderr.write(stderr)
+        if check_returncode and returncode:
+            raise Exception('Non-zero exit status for shell command "{}" in {}'.format(command, self.path))
+        return stdout.splitlines()
+
+    async def snapshot(self):
+        """
+        Returns a new :py:class:`WorkingCopySnapshot` of the working copy, with its status already loaded.
+        Reading the head commit's time from it blocks briefly, see :py:meth:`head_commit_age` for a coroutine.
+
+        """
+        returncode, stdout, stderr = await self.run_git_command(WorkingCopySnapshot.status_command)
+        if returncode:
+            raise Exception('Unable to get the status of {}: {}'.format(self.path, stderr.strip()))
+        snapshot = WorkingCopySnapshot(self.working_copy)
+        snapshot.parse_status_output(stdout)
+        return snapshot
+
+    async def current_branch(self):
+        """Returns the name of the current git branch"""
+        ref_reader = self.working_copy.ref_reader()
+        if ref_reader:
+            return ref_reader.current_branch()
+        return (await self.snapshot()).branch()
+
+    async def branch_names(self):
+        """Returns a list of git branch names, see :py:meth:`GitWorkingCopy.branch_names`."""
+        ref_reader = self.working_copy.ref_reader()
+        if ref_reader:
+            return ref_reader.branch_names()
+        return [i[2:] for i in await self.output_for_git_command('git branch -a'.split())]
+
+    async def has_branch(self, branch_name):
+        """Returns True if the working copy has a git branch with the given name"""
+        return branch_name in await self.branch_names()
+
+    async def head_commit_hash(self):
+        return (await self.snapshot()).head_commit_hash()
+
+    async def head_commit_age(self):
+        """Returns the age of the head commit as a :py:class:`datetime.timedelta`."""
+        snapshot = await self.snapshot()
+        loop = asyncio.get_running_loop()
+        # the object reader's pipe I/O blocks, so it runs on the default executor
+        await loop.run_in_executor(None, snapshot.head_commit_timestamp)
+        return snapshot.head_commit_age()
+
+    async def current_branch_upstream(self):
+        upstream = (await self.snapshot()).upstream()
+        return [upstream] if upstream else []
+
+    async def current_branch_has_upstream(self):
+        return (await self.snapshot()).has_upstream()
+
+    async def is_dirty(self):
+        """Returns True if the receiver's working copy has uncommitted modifications, see :py:meth:`GitWorkingCopy.is_dirty`."""
+        for command in (['git', 'diff', '--quiet'], ['git', 'diff', '--cached', '--quiet']):
+            status, stdout, stderr = await self.run_git_command(command)
+            if status == 1:
+                return True
+            if status:
+                raise Exception('Non-zero exit status {} for "{}" in {}'.format(status, ' '.join(command), self.path))
+        return False
+
+    async def dirty_file_lines(self):
+        return (await self.snapshot()).dirty_file_lines()
+
+    async def tags_pointing_at(self, commit_reference):
+        """Returns a list of tags that point to the given commit"""
+        return await self.output_for_git_command(['git', 'tag', '-l', '--points-at', commit_reference])
+
+    async def fork_point_commit_id_for_branch(self, other_branch):
+        """Returns the fork point with another branch"""
+        output = await self.output_for_git_command(['git', 'merge-base', '--fork-point', other_branch])
+        if len(output) != 1:
+            return None
+        return output[0].strip()
+
+    async def commits_not_in_upstream(self):
+        """Returns a list of git commits that have not yet been pushed to upstream."""
+        returncode, stdout, stderr = await self.run_git_command(['git', 'log', '-z', '--format=' + GitRevision.log_format, '@{u}..HEAD', '--'])
+        if stderr:
+            sys.stderr.write(stderr)
+        return list(GitRevision.parse_log_output(stdout))
+
+    async def commit_counts_relative_to_upstream(self, upstream='@{u}'):
+        """Returns a tuple of the number of commits ahead of and behind upstream, see :py:meth:`GitWorkingCopy.commit_counts_relative_to_upstream`."""
+        command = ['git', 'rev-list', '--count', '--left-right', '{}...HEAD'.format(upstream)]
+        output = await self.output_for_git_command(command, check_returncode=False, echo_stderr=False)
+        if len(output) != 1:
+            return None
+        behind, ahead = output[0].split()
+        return int(ahead), int(behind)
+
+    async def commits_only_in_upstream(self):
+        """Returns a list of git commits that are only in upstream but not in the local tracking branch."""
+        returncode, stdout, stderr = await self.run_git_command(['git', 'log', '-z', '--format=' + GitRevision.log_format, 'HEAD..@{u}', '--'])
+        if stderr:
+            sys.stderr.write(stderr)
+        return list(GitRevision.parse_log_output(stdout))
+
+    async def children(self):
+        """Returns a list of the working copies nested directly inside the receiver."""
+        if self.child_list is None:
+            loop = asyncio.get_running_loop()
+            # discovery reads the file system, so it runs on the default executor
+            children = await loop.run_in_executor(None, self.working_copy.children)
+            self.child_list = [AsyncGitWorkingCopy(child, parent=self) for child in children]
+        return self.child_list
+
+    async def __aiter__(self):
+        """An asynchronous iterator over ``self`` and all of its nested git working copies."""
+        yield self
+        for child in await self.children():
+            async for item in child:
+                yield item
+
+    async def traverse(self, iterator):
+        """
+        Awaits the coroutine function ``iterator`` for the receiver and then concurrently for all
+        of its nested working copies, and returns the results in tree order.
+
+        If ``iterator`` returns :py:data:`GitWorkingCopy.STOP_TRAVERSAL` for the root working copy,
+        the nested working copies are not processed. Once the nested working copies are running
+        concurrently, that value has no effect anymore.
+
+        """
+        root_result = await iterator(self)
+        if root_result is GitWorkingCopy.STOP_TRAVERSAL:
+            return [root_result]
+
+        working_copies = [item async for item in self]
+        results = await asyncio.gather(*[iterator(item) for item in working_copies[1:]])
+        if self.working_copy.is_root():
+            self.working_copy.save_discovery_index()
+        return [root_result] + list(results)
+
+
+class FetchTask(object):
+    """
+    One working copy's fetch as planned and run by :py:class:`FetchScheduler`.
+
+    After the fetch, ``returncode``, ``stdout_lines``, ``stderr_lines`` and ``duration`` describe the
+    result. ``leader`` is the task whose freshly fetched refs were copied instead of fetching from the
+    remote again, or ``None``.
+
+    """
+
+    def __init__(self, working_copy, remote_name=None, url=None, refspecs=None, prune=False):
+        self.working_copy = working_copy
+        self.remote_name = remote_name
+        self.url = url
+        self.refspecs = refspecs or []
+        self.prune = prune
+        self.has_ssh_command = False
+        self.host = FetchScheduler.host_for_url(url)
+        self.leader = None
+        self.did_finish = threading.Event()
+        self.returncode = None
+        self.stdout_lines = []
+        self.stderr_lines = []
+        self.duration = None
+
+    def can_share_fetch(self):
+        """Returns ``True`` if the fetch uses the default refspec, so its result can be copied to or from another repository."""
+        return bool(self.url) and self.refspecs == ['+refs/heads/*:refs/remotes/{}/*'.format(self.remote_name)]
+
+    def succeeded(self):
+        return self.returncode == 0
+
+
+class FetchScheduler(object):
+    """
+    Fetches a list of working copies concurrently.
+
+    * At most ``jobs`` fetches run at the same time, and at most ``per_host_jobs`` of them talk to
+      the same remote host.
+    * If several working copies fetch from the same remote URL with the default refspec, only the first
+      one in tree order fetches from the remote. The others copy the remote-tracking refs and the objects
+      from that working copy, which is a cheap local fetch. If the first fetch fails, the others fetch from
+      the remote themselves.
+    * For SSH remotes, a temporary ``ControlMaster`` socket is set up through ``GIT_SSH_COMMAND`` so that
+      all fetches from one host share one SSH connection. This is skipped if the user already configured
+      ``GIT_SSH_COMMAND``, ``GIT_SSH`` or ``core.sshCommand``.
+
+    Each working copy fetches the same remote that a plain ``git fetch`` would fetch: the current branch's
+    remote, or ``origin``.
+
+    :param int jobs: The maximum number of concurrent fetches.
+    :param int per_host_jobs: The maximum number of concurrent fetches from the same host.
+    :param bool deduplicate: Set to ``False`` to fetch each working copy from its remote.
+    :param bool ssh_multiplexing: Set to ``False`` to disable the SSH connection sharing.
+
+    """
+
+    default_per_host_jobs = 4
+    config_regex = r'^(remote\..*\.(url|fetch|prune)|fetch\.prune|branch\..*\.remote|core\.sshcommand)$'
+
+    def __init__(self, jobs=1, per_host_jobs=None, deduplicate=True, ssh_multiplexing=True):
+        self.jobs = max(1, jobs)
+        self.per_host_jobs = per_host_jobs or self.default_per_host_jobs
+        self.deduplicate = deduplicate
+        self.ssh_multiplexing = ssh_multiplexing
+        self.host_semaphores = collections.defaultdict(lambda: threading.Semaphore(self.per_host_jobs))
+        self.host_semaphores_lock = threading.Lock()
+        self.environment = None
+
+    @classmethod
+    def host_for_url(cls, url):
+        """Returns the host name part of a remote URL, or ``None`` for local repositories."""
+        if not url or url.lower().startswith('file://'):
+            return None
+        if re.match(r'^[a-z][a-z0-9+.-]*://', url, re.IGNORECASE):
+            match = re.match(r'^[^:]+://(?:[^@/]*@)?(\[[^\]]+\]|[^:/]+)', url)
+            return match.group(1).lower() if match else None
+        # scp-like syntax, user@host:path
+        match = re.match(r'^(?:[^@/:]+@)?([^/:]+):', url)
+        if match and not os.path.exists(url):
+            return match.group(1).lower()
+        return None
+
+    @classmethod
+    def is_ssh_url(cls, url):
+        if not url or not cls.host_for_url(url):
+            return False
+        return not re.match(r'^[a-z][a-z0-9+.-]*://', url, re.IGNORECASE) or re.match(r'^(ssh|git\+ssh|ssh\+git)://', url, re.IGNORECASE)
+
+    def task_for_working_copy(self, wc):
+        config = collections.defaultdict(list)
+        for line in wc.output_for_git_command(['git', 'config', '--get-regexp', self.config_regex], check_returncode=False, echo_stderr=False):
+            key, _, value = line.partition(' ')
+            config[key].append(value)
+
+        remote_name = None
+        branch_remote = config.get('branch.{}.remote'.format(wc.current_branch()))
+        if branch_remote and branch_remote[-1] != '.':
+            remote_name = branch_remote[-1]
+        elif 'remote.origin.url' in config:
+            remote_name = 'origin'
+        if remote_name is None or 'remote.{}.url'.format(remote_name) not in config:
+            # let git figure out what to fetch
+            return FetchTask(wc)
+
+        prune = config.get('remote.{}.prune'.format(remote_name)) or config.get('fetch.prune') or ['false']
+        task = FetchTask(wc, remote_name, config['remote.{}.url'.format(remote_name)][-1], config.get('remote.{}.fetch'.format(remote_name)), prune=prune[-1] == 'true')
+        task.has_ssh_command = 'core.sshcommand' in config
+        return task
+
+    def plan(self, working_copies):
+        """Returns a list of :py:class:`FetchTask` instances for the working copies, in the same order."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            tasks = list(executor.map(self.task_for_working_copy, working_copies))
+
+        if self.deduplicate:
+            leaders = {}
+            for task in tasks:
+                if not task.can_share_fetch():
+                    continue
+                if task.url in leaders:
+                    task.leader = leaders[task.url]
+                else:
+                    leaders[task.url] = task
+        return tasks
+
+    @contextlib.contextmanager
+    def ssh_environment(self, tasks):
+        ssh_tasks = [task for task in tasks if self.is_ssh_url(task.url)]
+        configured = any(task.has_ssh_command for task in ssh_tasks) or 'GIT_SSH_COMMAND' in os.environ or 'GIT_SSH' in os.environ
+        if not self.ssh_multiplexing or not ssh_tasks or configured:
+            yield None
+            return
+
+        # a short directory name because the socket path length is limited
+        control_directory = tempfile.mkdtemp(prefix='gh-ssh-')
+        environment = dict(os.environ)
+        environment['GIT_SSH_COMMAND'] = 'ssh -o ControlMaster=auto -o ControlPersist=10 -o ControlPath={}'.format(os.path.join(control_directory, '%C'))
+        try:
+            yield environment
+        finally:
+            shutil.rmtree(control_directory, ignore_errors=True)
+
+    def host_semaphore(self, host):
+        with self.host_semaphores_lock:
+            return self.host_semaphores[host]
+
+    def fetch_command(self, task):
+        leader = task.leader
+        if leader and leader.succeeded():
+            command = ['git', 'fetch']
+            if task.prune:
+                command.append('--prune')
+            command.extend([leader.working_copy.path, '+refs/remotes/{0}/*:refs/remotes/{1}/*'.format(leader.remote_name, task.remote_name), '^refs/remotes/{}/HEAD'.format(leader.remote_name)])
+            return command, None
+        return ['git', 'fetch'], task.host
+
+    def run_task(self, task):
+        if task.leader:
+            task.leader.did_finish.wait()
+
+        command, host = self.fetch_command(task)
+        start_time = time.perf_counter()
+        try:
+            with self.host_semaphore(host) if host else contextlib.nullcontext():
+                popen = FilteringPopen(command, cwd=task.working_copy.path, env=self.environment)
+                popen.run(echo_stdout=False, echo_stderr=False, check_returncode=False)
+            task.returncode = popen.returncode()
+            task.stdout_lines = popen.stdoutlines()
+            task.stderr_lines = popen.stderrlines()
+        except Exception as e:
+            task.returncode = -1
+            task.stderr_lines = [str(e)]
+        finally:
+            task.duration = time.perf_counter() - start_time
+            task.working_copy.invalidate_query_cache()
+            task.did_finish.set()
+        if task.leader and not task.leader.succeeded():
+            task.leader = None
+        return task
+
+    def run(self, working_copies, task_handler=None):
+        """
+        Fetches the working copies and returns the list of :py:class:`FetchTask` instances in tree order.
+
+        :param list working_copies: The :py:class:`GitWorkingCopy` instances to fetch.
+        :param callable task_handler: Called with each finished task, in the order of ``working_copies``.
+
+        """
+        tasks = self.plan(working_copies)
+        with self.ssh_environment(tasks) as environment:
+            self.environment = environment
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                # tasks that others wait for go first, so that waiting tasks can't take up all workers
+                futures = {}
+                for task in sorted(tasks, key=lambda task: task.leader is not None):
+                    futures[id(task)] = executor.submit(self.run_task, task)
+                for task in tasks:
+                    futures[id(task)].result()
+                    if task_handler:
+                        task_handler(task)
+        return tasks
+
+
+class InotifyWatcher(object):
+    """
+    Watches directories for changes with the Linux inotify API, accessed through :py:mod:`ctypes`.
+    Each watched directory belongs to a key, :py:meth:`changes` reports which keys had changes.
+    Use :py:meth:`is_available` to check if inotify can be used, :py:class:`PollingWatcher` is the
+    portable fallback with the same interface.
+
+    """
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_ONLYDIR = 0x1000000
+
+    watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    structure_mask = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    event_header_size = 16
+
+    libc = None
+
+    def __init__(self):
+        self.fd = self.load_libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError('inotify_init1 failed')
+        self.watches = collections.defaultdict(list)
+
+    @classmethod
+    def load_libc(cls):
+        if cls.libc is None:
+            # only needed here, so it is not imported up front
+            import ctypes
+            import ctypes.util
+            cls.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return cls.libc
+
+    @classmethod
+    def is_available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            return hasattr(cls.load_libc(), 'inotify_init1')
+        except (ImportError, OSError):
+            return False
+
+    def fileno(self):
+        return self.fd
+
+    def watch(self, key, directory_path, names=None):
+        """
+        Reports changes in the given directory for ``key``. If ``names`` is given, only
+        changes of entries with these names count. Returns ``False`` if the directory
+        can't be watched, for example because the per-user limit of watches is exhausted.
+
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory_path), self.watch_mask)
+        if wd < 0:
+            return False
+        if (key, names) not in self.watches[wd]:
+            self.watches[wd].append((key, names))
+        return True
+
+    def unwatch(self, key):
+        """Stops reporting changes for ``key``."""
+        for wd, watches in self.watches.items():
+            watches[:] = [i for i in watches if i[0] != key]
+
+    def changes(self, timeout=None):
+        """
+        Returns a dictionary with the keys of all directories that changed since the last call, each mapped
+        to ``True`` if entries were added, removed or renamed and ``False`` if only contents changed.
+        ``None`` is returned instead if events were lost and everything has to be considered changed.
+
+        """
+        changes = {}
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + self.event_header_size:offset + self.event_header_size + name_length].rstrip(b'\0')
+                offset += self.event_header_size + name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                name = os.fsdecode(name)
+                for key, names in self.watches.get(wd, []):
+                    if names is not None and name not in names:
+                        continue
+                    structure_changed = bool(mask & self.IN_ISDIR and mask & self.structure_mask) or bool(mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF))
+                    changes[key] = changes.get(key, False) or structure_changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(object):
+    """
+    The portable fallback for :py:class:`InotifyWatcher`. :py:meth:`changes` compares the
+    modification times and sizes of the entries in each watched directory with the previous call.
+
+    """
+
+    def __init__(self):
+        self.watches = collections.defaultdict(list)
+        self.signatures = {}
+
+    def fileno(self):
+        return None
+
+    def watch(self, key, directory_path, names=None):
+        self.watches[key].append((directory_path, names))
+        self.signatures[key] = self.signature(key)
+        return True
+
+    def unwatch(self, key):
+        self.watches.pop(key, None)
+        self.signatures.pop(key, None)
+
+    def signature(self, key):
+        signature = []
+        for directory_path, names in self.watches[key]:
+            try:
+                entries = list(os.scandir(directory_path))
+            except OSError:
+                signature.append((directory_path, None))
+                continue
+            for entry in entries:
+                if names is not None and entry.name not in names:
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                signature.append((entry.path, entry.is_dir(follow_symlinks=False), stat.st_mtime_ns, stat.st_size))
+        return signature
+
+    def changes(self, timeout=None):
+        changes = {}
+        for key in list(self.watches):
+            old_signature = self.signatures[key]
+            new_signature = self.signature(key)
+            if new_signature == old_signature:
+                continue
+            self.signatures[key] = new_signature
+            old_directories = set(i[0] for i in old_signature if len(i) > 1 and i[1])
+            new_directories = set(i[0] for i in new_signature if len(i) > 1 and i[1])
+            changes[key] = old_directories != new_directories
+        return changes
+
+    def close(self):
+        pass
+
+
+class RecordingOutputStream(object):
+    """A stand-in for :py:data:`sys.stdout` or :py:data:`sys.stderr` that appends ``(name, string)`` pairs to a shared list."""
+
+    def __init__(self, name, chunks):
+        self.name = name
+        self.chunks = chunks
+
+    def write(self, string):
+        self.chunks.append((self.name, string))
+        return len(string)
+
+    def flush(self):
+        pass
+
+
+class WorkingCopyStateDaemon(object):
+    """
+    A background process that keeps the state of a tree of working copies in memory and answers
+    the ``tree``, ``status`` and ``branch`` subcommands for the command line utility over a Unix socket.
+
+    The daemon keeps query memoization (see :py:meth:`GitWorkingCopy.memoized_queries`) enabled for its whole
+    lifetime. It watches the git directories (``HEAD``, the index, ``packed-refs`` and the configuration),
+    the local and remote branch refs and the work tree directories of each working copy, with
+    :py:class:`InotifyWatcher` if possible and :py:class:`PollingWatcher` otherwise. When something
+    changes, only the memoized results of the affected working copies are discarded. If directories
+    appear or disappear, the watches of that working copy are renewed, and the whole tree is rediscovered
+    if that changed the set of nested working copies. The output itself is rendered from the memoized
+    state for each request, so time-dependent values like the age of the head commit stay current.
+
+    Working copies with more than :py:data:`max_watched_directories` directories are not watched,
+    they are refreshed for every request instead.
 
-        if not callable(iterator):
-            raise Exception('{0} is not callable'.format(iterator))
+    Clients use :py:meth:`request_output`, which returns ``None`` if no daemon is running for the tree
+    or it can't answer, so they can fall back to doing the work themselves.
 
-        for item in self:
-            with item.chdir_to_path():
-                if iterator(item) is GitWorkingCopy.STOP_TRAVERSAL:
-                    break
+    :param str root_path: The path of the root working copy.
+    :param float idle_timeout: The daemon exits after this many seconds without a request.
 
-    @contextlib.contextmanager
-    def chdir_to_path(self):
-        """
-        A :ref:`context manager <context-managers>` for the :py:keyword:`with` statement
-        that temporarily switches the current working directory to the receiver's working
-        copy directory::
+    """
 
-            with wc.chdir_to_path():
-                # do something useful here inside the working copy directory.
+    max_watched_directories = 5000
+    polling_interval = 2
+    socket_timeout = 30
+    git_directory_entry_names = ('HEAD', 'index', 'packed-refs', 'config')
+
+    def __init__(self, root_path, idle_timeout=3600):
+        self.root_path = os.path.abspath(root_path)
+        self.idle_timeout = idle_timeout
+        self.root_wc = None
+        self.memoization = None
+        self.watcher = None
+        self.working_copies = {}
+        self.nested_working_copy_paths = {}
+        self.unwatched_paths = set()
+        self.subcommand_map = None
+        self.should_stop = False
 
-        """
-        oldwd = os.getcwd()
-        os.chdir(self.path)
-        yield
-        os.chdir(oldwd)
+    @classmethod
+    def socket_path_for_root_path(cls, root_path):
+        """Returns the path of the daemon's socket for the given root working copy, or ``None`` if it has no git directory."""
+        git_directory = GitRefReader.find_git_directory(os.path.abspath(root_path))
+        if not git_directory:
+            return None
+        socket_path = os.path.join(git_directory, 'githelper', 'daemon.sock')
+        if len(os.fsencode(socket_path)) < 100:
+            return socket_path
+        # too long for a socket address
+        digest = hashlib.sha1(os.fsencode(os.path.abspath(git_directory))).hexdigest()[:16]
+        return os.path.join(tempfile.gettempdir(), 'githelper-{}-{}.sock'.format(os.getuid(), digest))
 
-    @contextlib.contextmanager
-    def switched_to_branch(self, branch_name):
+    @classmethod
+    def send_request(cls, root_path, request):
+        socket_path = cls.socket_path_for_root_path(root_path)
+        if not socket_path or not os.path.exists(socket_path):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(cls.socket_timeout)
+                client.connect(socket_path)
+                client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                client.shutdown(socket.SHUT_WR)
+                data = b''.join(iter(lambda: client.recv(64 * 1024), b''))
+            return json.loads(data.decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def request_output(cls, subcommand_name, args):
         """
-        A :ref:`context manager <context-managers>` for the :py:keyword:`with` statement
-        that temporarily switches the current git branch to another one and afterwards
-        restores the original one.
+        Asks the daemon for the tree that ``args.root_path`` is the root of to run a subcommand.
+        Returns a list of ``(stream_name, string)`` pairs with its output to ``stdout`` and ``stderr``
+        in the order it was written, or ``None`` if that was not possible.
 
-        Example::
+        """
+        arguments = {k: v for k, v in vars(args).items() if k not in ('verbose', 'refresh_index', 'profile', 'profile_json', 'no_daemon')}
+        arguments['root_path'] = os.path.abspath(args.root_path)
+        response = cls.send_request(args.root_path, {'subcommand': subcommand_name, 'arguments': arguments})
+        if not response or 'error' in response:
+            return None
+        return response['output']
 
-            with wc.switched_to_branch('master'):
-                # do something useful here on the 'master' branch.
+    @classmethod
+    def is_running(cls, root_path):
+        response = cls.send_request(root_path, {'ping': True})
+        return bool(response and response.get('pong'))
 
-        """
-        old_branch = self.current_branch()
-        different_branch = old_branch != branch_name
-        if different_branch:
-            print('Temporarily switching {0} from branch {1} to {2}'.format(self, old_branch, branch_name), file=sys.stderr)
-            self.switch_to_branch(branch_name)
+    @classmethod
+    def stop(cls, root_path):
+        """Asks the daemon for the given root working copy to exit. Returns ``False`` if none was running."""
+        return cls.send_request(root_path, {'stop': True}) is not None
+
+    def load_tree(self):
+        if self.memoization:
+            self.memoization.__exit__(None, None, None)
+        if self.watcher:
+            self.watcher.close()
+        self.root_wc = GitWorkingCopy(self.root_path)
+        self.memoization = self.root_wc.memoized_queries()
+        self.memoization.__enter__()
+        self.watcher = InotifyWatcher() if InotifyWatcher.is_available() else PollingWatcher()
+        self.working_copies = {wc.path: wc for wc in self.root_wc}
+        self.nested_working_copy_paths = {}
+        self.unwatched_paths = set()
+        for wc in self.working_copies.values():
+            self.watch_working_copy(wc)
+
+    def watched_directories(self, wc):
+        """Returns the work tree directories of a working copy and the paths of the working copies nested anywhere inside it."""
+        discovery = self.root_wc.working_copy_discovery()
+        directories = []
+        nested_paths = set()
+        pending = [(wc.path, os.path.relpath(wc.path, self.root_path) if wc.parent else '')]
+        while pending:
+            path, relative_path = pending.pop()
+            has_git_entry, subdirectory_names = discovery.scan_directory(path, relative_path, list_working_copy=path == wc.path)
+            if has_git_entry and path != wc.path:
+                nested_paths.add(path)
+                continue
+            directories.append(path)
+            if len(directories) > self.max_watched_directories:
+                return None, nested_paths
+            for name in subdirectory_names or []:
+                pending.append((os.path.join(path, name), discovery.join_relative_path(relative_path, name)))
+        return directories, nested_paths
+
+    def watch_working_copy(self, wc):
+        self.watcher.unwatch(wc.path)
+        directories, nested_paths = self.watched_directories(wc)
+        self.nested_working_copy_paths[wc.path] = nested_paths
+        if directories is None:
+            self.unwatched_paths.add(wc.path)
+            return
 
-        yield
+        git_directory = wc.git_directory()
+        common_directory = wc.git_common_directory()
+        watches = [(git_directory, self.git_directory_entry_names), (common_directory, self.git_directory_entry_names)]
+        for ref_directory in ('refs/heads', 'refs/remotes'):
+            for path, subdirectory_names, file_names in os.walk(os.path.join(common_directory, ref_directory)):
+                watches.append((path, None))
+        watches.extend((path, None) for path in directories)
+
+        for path, names in watches:
+            if not self.watcher.watch(wc.path, path, names):
+                self.unwatched_paths.add(wc.path)
+                return
+        self.unwatched_paths.discard(wc.path)
 
-        if different_branch:
-            print('Switching {0} back to branch {1}'.format(self, old_branch), file=sys.stderr)
-            self.switch_to_branch(old_branch)
+    def process_changes(self):
+        changes = self.watcher.changes()
+        if changes is None:
+            # events were lost
+            self.load_tree()
+            return
+        for path, structure_changed in changes.items():
+            wc = self.working_copies.get(path)
+            if not wc:
+                continue
+            wc.invalidate_query_cache()
+            if structure_changed:
+                old_nested_paths = self.nested_working_copy_paths.get(path)
+                self.watch_working_copy(wc)
+                if self.nested_working_copy_paths[path] != old_nested_paths:
+                    self.load_tree()
+                    return
+
+    def output_for_request(self, request):
+        arguments = request['arguments']
+        if arguments.get('root_path') != self.root_path:
+            raise Exception('This daemon serves {}, not {}'.format(self.root_path, arguments.get('root_path')))
+        subcommand_class = self.subcommand_map.get(request['subcommand'])
+        if not subcommand_class or not subcommand_class.supports_daemon():
+            raise Exception('Unsupported subcommand {}'.format(request['subcommand']))
+
+        for path in self.unwatched_paths:
+            self.working_copies[path].invalidate_query_cache()
+
+        subcommand = subcommand_class(argparse.Namespace(**arguments))
+        jobs = arguments.get('jobs', 1) if subcommand.supports_parallel_traversal() else 1
+        chunks = []
+        with contextlib.redirect_stdout(RecordingOutputStream('stdout', chunks)), contextlib.redirect_stderr(RecordingOutputStream('stderr', chunks)):
+            self.root_wc.traverse(subcommand, jobs=jobs)
+        return {'output': chunks}
+
+    def handle_connection(self, connection):
+        with connection:
+            connection.settimeout(self.socket_timeout)
+            try:
+                data = b''.join(iter(lambda: connection.recv(64 * 1024), b''))
+                request = json.loads(data.decode('utf-8'))
+                if request.get('ping'):
+                    response = {'pong': True}
+                elif request.get('stop'):
+                    self.should_stop = True
+                    response = {}
+                else:
+                    self.process_changes()
+                    response = self.output_for_request(request)
+            except Exception as e:
+                logging.exception('Unable to handle request')
+                response = {'error': str(e)}
+            try:
+                connection.sendall(json.dumps(response).encode('utf-8'))
+            except OSError:
+                pass
+
+    def serve(self):
+        """Runs the daemon until it is stopped or idle for longer than the idle timeout."""
+        socket_path = self.socket_path_for_root_path(self.root_path)
+        if not socket_path:
+            raise Exception('{} is not a git working copy'.format(self.root_path))
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.subcommand_map = GitHelperCommandLineDriver.subcommand_map()
+        self.load_tree()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        watched_fileno = self.watcher.fileno()
+        if watched_fileno is not None:
+            selector.register(watched_fileno, selectors.EVENT_READ)
+        last_request_time = time.monotonic()
+        try:
+            while not self.should_stop and time.monotonic() - last_request_time < self.idle_timeout:
+                for key, events in selector.select(timeout=self.polling_interval):
+                    if key.fileobj is server:
+                        connection, address = server.accept()
+                        self.handle_connection(connection)
+                        last_request_time = time.monotonic()
+                if self.watcher.fileno() != watched_fileno:
+                    # the tree was reloaded with a new watcher
+                    if watched_fileno is not None:
+                        selector.unregister(watched_fileno)
+                    watched_fileno = self.watcher.fileno()
+                    if watched_fileno is not None:
+                        selector.register(watched_fileno, selectors.EVENT_READ)
+                self.process_changes()
+        finally:
+            selector.close()
+            server.close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self.watcher.close()
+            self.memoization.__exit__(None, None, None)
 
 
 class AbstractSubcommand(object):
@@ -946,6 +3657,24 @@ class AbstractSubcommand(object):
         """
         pass
 
+    def finish_for_root(self, root_wc):
+        """
+        This method gets called on the root working copy only, after the traversal
+        of the tree has finished, and lets you perform final steps like printing
+        a summary. It is not called if :py:meth:`prepare_for_root` stopped the traversal.
+
+        :param githelper.GitWorkingCopy root_wc: The root working copy.
+
+        """
+        pass
+
+    def exit_status(self):
+        """
+        Returns the exit status that the command line utility should exit with once this
+        subcommand and any chained subcommands are done. The default is ``0``.
+        """
+        return 0
+
     def chained_post_traversal_subcommand_for_root_working_copy(self, root_wc):
         """
         This method gets called on the root working copy after the traversal
@@ -957,6 +3686,18 @@ class AbstractSubcommand(object):
         """
         return None
 
+    def wants_json_lines(self):
+        """
+        Returns ``True`` if the ``--format=jsonl`` command line option asks for one JSON object
+        per working copy instead of human-readable output, see :py:meth:`print_json_record`.
+        """
+        return getattr(self.args, 'format', 'text') == 'jsonl'
+
+    @classmethod
+    def print_json_record(cls, record):
+        """Prints a dictionary as a JSON object on a line of its own, for example one from :py:meth:`GitWorkingCopy.state_record`."""
+        print(json.dumps(record, ensure_ascii=False), flush=True)
+
     @classmethod
     def print_dirty_working_copies_error_message(cls):
         print(ANSIColor.wrap('Dirty working copies found, please either 1.) commit or stash first, 2.) use git\'s rebase.autoStash configuration option, or 3.) use the -s/--stash-pop option\n', color=ANSIColor.red), file=sys.stderr)
@@ -994,6 +3735,40 @@ class AbstractSubcommand(object):
             with ANSIColor.terminal_color(ANSIColor.red, ANSIColor.red):
                 print(''.join([i + '\n' for i in wc.dirty_file_lines()]), file=sys.stderr)
 
+    @classmethod
+    def supports_parallel_traversal(cls):
+        """
+        Return ``True`` if your subcommand's :py:meth:`__call__` can safely run for several working copies
+        at the same time, see :py:class:`ParallelTraversal` for the constraints. This enables the ``-j`` command
+        line option for your subcommand. The default is ``False``.
+        """
+        return False
+
+    @classmethod
+    def supports_daemon(cls):
+        """
+        Return ``True`` if the command line utility can let a :py:class:`WorkingCopyStateDaemon` run your
+        subcommand, which requires that it only reads the working copies and only prints to stdout and stderr.
+        The default is ``False``.
+        """
+        return False
+
+    @classmethod
+    def parallel_traversal_processes_parents_first(cls):
+        """
+        Return ``True`` if a working copy must only be processed after its parent working copy is done
+        when the traversal runs in parallel, for example because processing a working copy modifies its
+        files. The default is ``False``.
+        """
+        return False
+
+    def parallel_traversal_prints_in_completion_order(self):
+        """
+        Return ``True`` if the output of each working copy should be printed as soon as it is done
+        when the traversal runs in parallel, instead of in tree order. The default is ``False``.
+        """
+        return False
+
     @classmethod
     def wants_working_copy(cls):
         """
@@ -1010,19 +3785,47 @@ class SubcommandTree(AbstractSubcommand):
     """List the tree of nested working copies"""
 
     def __call__(self, wc):
-        print('|{0}{1}'.format(len(wc.ancestors()) * '--', wc))
+        if self.wants_json_lines():
+            record = wc.state_record()
+            record['depth'] = wc.depth()
+            self.print_json_record(record)
+            return
+        print('|{0}{1}'.format(wc.depth() * '--', wc))
+
+    @classmethod
+    def supports_parallel_traversal(cls):
+        return True
+
+    @classmethod
+    def supports_daemon(cls):
+        return True
 
 
 class SubcommandStatus(AbstractSubcommand):
     """Run git status recursively, omitting output for any working copies without interesting status."""
 
     def __call__(self, wc):
+        if self.wants_json_lines():
+            self.print_json_record(wc.state_record())
+            return
+
         rules = (
             ('-', r' On branch '),
             ('-', r'working directory clean'),
         )
 
-        wc.run_shell_command('git status -s', filter_rules=rules, header=wc)
+        # git status only reads, so this does not go through run_shell_command(), which would discard memoized queries
+        # without optional locks, status does not rewrite the index, which would look like a change to a daemon watching it
+        popen = FilteringPopen('git --no-optional-locks status -s'.split(), cwd=wc.path)
+        popen.run(filter_rules=rules, store_stdout=False, store_stderr=False, header=wc)
+
+    @classmethod
+    def supports_parallel_traversal(cls):
+        return True
+
+    @classmethod
+    def supports_daemon(cls):
+        return True
 
 
 class SubcommandCopyHeadCommitHash(AbstractSubcommand):
@@ -1280,8 +4083,8 @@ class SubcommandCheckout(WorkingCopyTreeStashingSubcommand):
             ]
             wc.run_shell_command('git checkout {0}'.format(target_branch), filter_rules=rules)
         finally:
-            if stash_commit:
-                wc.apply_stash_commit(stash_commit)
+            if stash_commit and not wc.apply_stash_commit(stash_commit):
+                raise Exception('Unable to restore stashed changes, restore them with "git stash apply {}"'.format(stash_commit))
 
     def target_branch_for_branch_name(self, target_branch_candidate, wc):
         local_branch_candidates = [i for i in wc.local_branch_names() if target_branch_candidate in i]
@@ -1340,32 +4143,122 @@ class SubcommandCheckout(WorkingCopyTreeStashingSubcommand):
         parser.add_argument('branch', nargs='+', help='One or more names of the branch that should be checked out. The first one to exist will be used')
 
 
+class PullResult(object):
+    """The outcome of pulling one working copy, see :py:class:`SubcommandPull`."""
+
+    def __init__(self, working_copy):
+        self.working_copy = working_copy
+        self.status = 'not started'
+        self.old_head = None
+        self.new_head = None
+        self.stash_commit = None
+        self.stash_applied = False
+        self.error = None
+
+    def stash_outstanding(self):
+        return bool(self.stash_commit) and not self.stash_applied
+
+
 class SubcommandPull(WorkingCopyTreeStashingSubcommand):
     """Run git pull recursively, optionally stashing and unstashing uncommitted changes automatically."""
 
+    def __init__(self, arguments):
+        super(SubcommandPull, self).__init__(arguments)
+        self.results = {}
+        self.results_lock = threading.Lock()
+        self.did_fail = False
+
     def __call__(self, wc):
-        stash_commit = None
+        result = PullResult(wc)
+        with self.results_lock:
+            self.results[wc.path] = result
+            if self.did_fail and getattr(self.args, 'fail_fast', False):
+                return GitWorkingCopy.STOP_TRAVERSAL
+
         print(ANSIColor.wrap(wc, color=ANSIColor.green))
-        if wc.is_dirty() and not wc.has_autostash_enabled():
-            stash_commit = wc.create_stash_and_reset_hard()
+        try:
+            self.pull(wc, result)
+        except Exception as e:
+            result.status = 'failed'
+            result.error = str(e)
+            print(ANSIColor.wrap(e), file=sys.stderr)
+            with self.results_lock:
+                self.did_fail = True
+            if getattr(self.args, 'fail_fast', False):
+                return GitWorkingCopy.STOP_TRAVERSAL
 
+    def pull(self, wc, result):
         if not wc.current_branch_has_upstream():
             print('Current branch {} has no upstream branch to pull from'.format(wc.current_branch()))
+            result.status = 'no upstream'
             return
 
+        # only stash when a pull actually runs, so that nothing is left behind otherwise
+        if wc.is_dirty() and not wc.has_autostash_enabled():
+            result.stash_commit = wc.create_stash_and_reset_hard()
+
         try:
+            result.old_head = wc.head_commit_id()
             rules = [
                 ('-', r'Rebasing'),
                 ('-', r'Successfully rebased'),
             ]
             wc.run_shell_command('git pull', filter_rules=rules)
+            result.new_head = wc.head_commit_id()
+            result.status = 'updated' if result.new_head != result.old_head else 'up to date'
         finally:
-            if stash_commit:
-                wc.apply_stash_commit(stash_commit)
+            if result.stash_commit:
+                result.stash_applied = wc.apply_stash_commit(result.stash_commit)
+
+        if result.stash_outstanding():
+            raise Exception('Unable to restore stashed changes, restore them with "git stash apply {}"'.format(result.stash_commit))
+
+    def print_summary(self, root_wc):
+        rows = []
+        for wc in root_wc:
+            result = self.results.get(wc.path) or PullResult(wc)
+            change = ''
+            if result.status == 'updated':
+                change = '{}..{}'.format(result.old_head[:8] if result.old_head else '', result.new_head[:8] if result.new_head else '')
+            stash = ''
+            if result.stash_commit:
+                stash = 'restored' if result.stash_applied else 'outstanding: git stash apply {}'.format(result.stash_commit)
+            rows.append((str(wc), result.status, change, stash))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(3)]
+        print('\nSummary:')
+        for row in rows:
+            line = '{0:<{3}} {1:<{4}} {2:<{5}} '.format(*(row[:3] + tuple(widths)))
+            color = ANSIColor.red if row[1] == 'failed' or row[3].startswith('outstanding') else None
+            line = (line + row[3]).rstrip()
+            print(ANSIColor.wrap(line, color=color) if color else line)
+        print()
+
+    def finish_for_root(self, root_wc):
+        if self.results:
+            self.print_summary(root_wc)
+
+    def exit_status(self):
+        return 1 if self.did_fail else 0
 
     def chained_post_traversal_subcommand_for_root_working_copy(self, root_wc):
+        if not self.results:
+            return None
         return SubcommandBranch(self.args)
 
+    @classmethod
+    def supports_parallel_traversal(cls):
+        return True
+
+    @classmethod
+    def parallel_traversal_processes_parents_first(cls):
+        return True
+
+    @classmethod
+    def configure_argument_parser(cls, parser):
+        super(SubcommandPull, cls).configure_argument_parser(parser)
+        parser.add_argument('--fail-fast', action='store_true', help='Do not start pulling any more working copies after one failed')
+
 
 class SubcommandForkPoint(AbstractSubcommand):
 
@@ -1375,15 +4268,16 @@ class SubcommandForkPoint(AbstractSubcommand):
         fork_point_commit = wc.fork_point_commit_id_for_branch(self.args.target_branch)
         if fork_point_commit:
             print('\nFork-point between "head" ({}) and "{}":'.format(wc.current_branch(), self.args.target_branch))
-            cmd = ['git', 'log', '-1', '--pretty=format:%h  %ad  %s', fork_point_commit]
-            wc.run_shell_command(cmd)
+            for revision in wc.iter_log([fork_point_commit], max_count=1):
+                print(revision.oneline_description())
 
             print()
-            for other_branch in 'head', self.args.target_branch:
-                cmd = ['git', 'log', '--pretty=format:%h  %ad  %s', other_branch, '^' + fork_point_commit]
-                output = wc.output_for_git_command(cmd)
-                print('{} commits in "{}" but not in fork-point {}'.format(len(output), other_branch, fork_point_commit[:12]))
-                print(''.join([line + '\n' for line in output]))
+            for other_branch in 'HEAD', self.args.target_branch:
+                revisions = [other_branch, '^' + fork_point_commit]
+                print('{} commits in "{}" but not in fork-point {}'.format(wc.commit_count(revisions), other_branch, fork_point_commit[:12]))
+                for revision in wc.iter_log(revisions):
+                    print(revision.oneline_description())
+                print()
         else:
             print('Unable to find fork point between "{}" and "{}"'.format(wc.current_branch(), self.args.target_branch))
         return GitWorkingCopy.STOP_TRAVERSAL
@@ -1408,14 +4302,15 @@ class SubcommandSquashToForkPoint(AbstractSubcommand):
             return GitWorkingCopy.STOP_TRAVERSAL
 
         print('\nFork-point between "head" ({}) and "{}":'.format(wc.current_branch(), self.args.target_branch))
-        cmd = ['git', 'log', '-1', '--pretty=format:%h  %ad  %s', fork_point_commit]
-        wc.run_shell_command(cmd)
+        for revision in wc.iter_log([fork_point_commit], max_count=1):
+            print(revision.oneline_description())
 
-        cmd = ['git', 'log', '--pretty=format:%h  %ad  %s', 'head', '^' + fork_point_commit]
-        output = wc.output_for_git_command(cmd)
-        commit_count = len(output)
+        revisions = ['HEAD', '^' + fork_point_commit]
+        commit_count = wc.commit_count(revisions)
         print('\n{} commits in head but not in fork-point {}'.format(commit_count, fork_point_commit[:12]))
-        print(''.join(['{}) {}\n'.format(commit_count - number, line) for number, line in enumerate(output)]))
+        for number, revision in enumerate(wc.iter_log(revisions)):
+            print('{}) {}'.format(commit_count - number, revision.oneline_description()))
+        print()
 
         if commit_count < 2:
             print('Fewer than two commits, nothing to squash')
@@ -1426,7 +4321,8 @@ class SubcommandSquashToForkPoint(AbstractSubcommand):
         try:
             value = int(prompt_input)
             if value >= 1 and value <= commit_count:
-                authorship_commit = output[commit_count - value].split()[0]
+                for revision in wc.iter_log(revisions, max_count=1, skip=commit_count - value):
+                    authorship_commit = revision.revision
         except ValueError as e:
             pass
 
@@ -1447,37 +4343,119 @@ class SubcommandSquashToForkPoint(AbstractSubcommand):
         parser.add_argument('--dry-run', '-n', action='store_true', help="Don't make any changes, just print the git commands")
 
 
+class TableRenderer(object):
+    """
+    Formats rows of strings as a table with aligned columns.
+
+    :param justifiers: One of :py:meth:`str.ljust` and :py:meth:`str.rjust` per column.
+    :param widths: Optional minimum width per column.
+
+    :py:meth:`lines` sizes the columns to fit all rows. :py:meth:`format_row` formats
+    one row at a time with the widths seen so far, growing them as wider cells arrive,
+    for output that is printed while the rows are still being computed.
+
+    """
+
+    def __init__(self, justifiers, widths=None):
+        self.justifiers = justifiers
+        self.widths = list(widths) if widths else [0] * len(justifiers)
+
+    def format_row(self, row):
+        self.widths = [max(width, len(cell)) for width, cell in zip(self.widths, row)]
+        return ' '.join(justifier(cell, width) for justifier, cell, width in zip(self.justifiers, row, self.widths))
+
+    def lines(self, rows):
+        rows = list(rows)
+        for row in rows:
+            self.widths = [max(width, len(cell)) for width, cell in zip(self.widths, row)]
+        return [self.format_row(row) for row in rows]
+
+
 class SubcommandBranch(AbstractSubcommand):
     """Show checked out branch and other status information of each working copy"""
 
+    # each accessor gets passed a WorkingCopySnapshot
     column_justifiers_and_accessors = (
         (str.ljust, lambda x: str(x)),
-        (str.rjust, lambda x: str(len(x.commits_not_in_upstream())) + '↑' if x.current_branch_has_upstream() else '-'),
-        (str.rjust, lambda x: str(len(x.commits_only_in_upstream())) + '↓' if x.current_branch_has_upstream() else '-'),
-        (str.ljust, lambda x: x.current_branch()),
-        (str.ljust, lambda x: x.head_commit_hash()),
+        (str.rjust, lambda x: str(x.commits_ahead_of_upstream()) + '↑' if x.has_upstream() else '-'),
+        (str.rjust, lambda x: str(x.commits_behind_upstream()) + '↓' if x.has_upstream() else '-'),
+        (str.ljust, lambda x: x.branch()),
+        (str.ljust, lambda x: x.head_commit_hash() or '-'),
         (str.rjust, lambda x: str(x.head_commit_age_approximate_string())),
     )
 
+    # divergence from upstream at which a missing commit-graph file is worth a hint
+    commit_graph_hint_threshold = 1000
+
+    # starting widths for --stream, wide enough for most rows so that columns rarely shift
+    stream_minimum_widths = (0, 3, 3, 16, 8, 3)
+
+    def __init__(self, arguments):
+        super(SubcommandBranch, self).__init__(arguments)
+        self.rows = {}
+        self.rows_lock = threading.Lock()
+        self.renderer = None
+
     def column_count(self):
         return len(SubcommandBranch.column_justifiers_and_accessors)
 
+    def row_for_working_copy(self, wc):
+        snapshot = wc.snapshot()
+        return [accessor(snapshot) for justifier, accessor in SubcommandBranch.column_justifiers_and_accessors]
+
+    def wants_stream(self):
+        return getattr(self.args, 'stream', False)
+
+    def table_renderer(self, working_copies=()):
+        justifiers = [justifier for justifier, accessor in SubcommandBranch.column_justifiers_and_accessors]
+        if not self.wants_stream():
+            return TableRenderer(justifiers)
+        widths = list(SubcommandBranch.stream_minimum_widths)
+        # the path column is known up front, leave room for the " l*" flags
+        widths[0] = max([len('<{} l*>'.format(wc.root_relative_path())) for wc in working_copies] + [0])
+        return TableRenderer(justifiers, widths)
+
     def prepare_for_root(self, root_wc):
-        self.maxlen = [0] * self.column_count()
-        for wc in root_wc:
-            for index, (justifier, accessor) in enumerate(SubcommandBranch.column_justifiers_and_accessors):
-                self.maxlen[index] = max((self.maxlen[index], len(accessor(wc))))
+        self.rows = {}
+        self.renderer = self.table_renderer(list(root_wc) if self.wants_stream() else ())
 
     def __call__(self, wc):
-        def access(index, item):
-            return self.column_justifiers_and_accessors[index][1](item)
+        if self.wants_json_lines():
+            self.print_json_record(wc.state_record())
+            return
+        row = self.row_for_working_copy(wc)
+        with self.rows_lock:
+            self.rows[wc.path] = row
+            line = self.renderer.format_row(row) if self.wants_stream() else None
+        if line is not None:
+            print(line, flush=True)
+
+    def finish_for_root(self, root_wc):
+        if self.wants_json_lines():
+            return
+        working_copies = [wc for wc in root_wc if wc.path in self.rows]
+        if not self.wants_stream():
+            for line in self.renderer.lines(self.rows[wc.path] for wc in working_copies):
+                print(line)
+        self.print_commit_graph_hints(working_copies)
+
+    def print_commit_graph_hints(self, working_copies):
+        """Suggests a commit-graph file for working copies that are so far from upstream that counting the commits is slow without one."""
+        for wc in working_copies:
+            snapshot = wc.snapshot()
+            if not snapshot.has_upstream():
+                continue
+            commit_count = snapshot.commits_ahead_of_upstream() + snapshot.commits_behind_upstream()
+            if commit_count >= self.commit_graph_hint_threshold and not wc.has_commit_graph():
+                print('hint: {} is {} commits away from its upstream branch and has no commit-graph file, counting them is faster with one. Create it with "gh maintenance" or "git commit-graph write --reachable".'.format(wc, commit_count), file=sys.stderr)
 
-        def justify(index, string, length):
-            return self.column_justifiers_and_accessors[index][0](string, length)
+    @classmethod
+    def supports_parallel_traversal(cls):
+        return True
 
-        format = ' '.join(['{' + str(i) + '}' for i in range(self.column_count())])
-        output = format.format(*[justify(i, access(i, wc), self.maxlen[i]) for i in range(self.column_count())])
-        print(output)
+    @classmethod
+    def supports_daemon(cls):
+        return True
 
     @classmethod
     def configure_argument_parser(cls, parser):
@@ -1505,44 +4483,351 @@ class SubcommandBranch(AbstractSubcommand):
             For the "commits to pull" information to be up to date, you have to run the "fetch" subcommand first.
 
             Many subcommands (among them "fetch") automatically run the branch subcommand afterwards.''')
+        parser.add_argument('--stream', action='store_true', help='Print each row as soon as it is available instead of waiting for all rows to align the columns')
 
 
 class SubcommandFetch(AbstractSubcommand):
     """Run git fetch recursively"""
 
-    def __call__(self, wc):
-        wc.run_shell_command('git fetch')
+    def __init__(self, arguments):
+        super(SubcommandFetch, self).__init__(arguments)
+        self.failed_tasks = []
+
+    def prepare_for_root(self, root_wc):
+        # the scheduler takes the place of the traversal, it runs the fetches concurrently with the global -j limit
+        scheduler = FetchScheduler(jobs=getattr(self.args, 'jobs', 1), per_host_jobs=getattr(self.args, 'per_host_jobs', None), deduplicate=not getattr(self.args, 'no_deduplicate', False), ssh_multiplexing=not getattr(self.args, 'no_ssh_multiplexing', False))
+        tasks = scheduler.run(list(root_wc), task_handler=self.print_task)
+        self.failed_tasks = [task for task in tasks if not task.succeeded()]
+        if self.failed_tasks:
+            print(ANSIColor.wrap('git fetch failed in {}'.format(', '.join(task.working_copy.path for task in self.failed_tasks))), file=sys.stderr)
+        return GitWorkingCopy.STOP_TRAVERSAL
+
+    @classmethod
+    def print_task(cls, task):
+        lines = task.stdout_lines + task.stderr_lines
+        if not lines and task.succeeded():
+            return
+        print(task.working_copy)
+        with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
+            for line in lines:
+                print(line)
+        if not task.succeeded():
+            print(ANSIColor.wrap('git fetch failed with exit status {}'.format(task.returncode)))
+
+    def exit_status(self):
+        return 1 if self.failed_tasks else 0
 
     def chained_post_traversal_subcommand_for_root_working_copy(self, root_wc):
         return SubcommandBranch(self.args)
 
+    @classmethod
+    def configure_argument_parser(cls, parser):
+        parser.add_argument('--per-host-jobs', type=int, help='Maximum number of concurrent fetches from the same host. Use the global -j option to set the total. Defaults to {}'.format(FetchScheduler.default_per_host_jobs))
+        parser.add_argument('--no-deduplicate', action='store_true', help='Fetch every working copy from its remote, even if another working copy already fetched from the same URL')
+        parser.add_argument('--no-ssh-multiplexing', action='store_true', help='Do not share one SSH connection per host between the fetches')
+
 
 class SubcommandEach(AbstractSubcommand):
     """Run a shell command in each working copy"""
 
+    def __init__(self, arguments):
+        super(SubcommandEach, self).__init__(arguments)
+        self.exit_statuses = {}
+        self.durations = {}
+        self.results_lock = threading.Lock()
+        self.start_time = None
+
+    def prepare_for_root(self, root_wc):
+        self.start_time = time.perf_counter()
+
     def __call__(self, wc):
         command = ' '.join(self.args.shell_command)
-        wc.run_shell_command(command, header=wc, check_returncode=False)
+        start_time = time.perf_counter()
+        if not self.wants_json_lines():
+            popen = wc.run_shell_command(command, header=wc, check_returncode=False)
+            self.record_result(wc, popen.returncode(), time.perf_counter() - start_time)
+            return
+
+        popen = wc.run_shell_command(command, check_returncode=False, capture_output=True)
+        duration = time.perf_counter() - start_time
+        self.record_result(wc, popen.returncode(), duration)
+        record = wc.state_record()
+        record.update({
+            'command': command,
+            'exit_status': popen.returncode(),
+            'duration': round(duration, 3),
+            'stdout': popen.stdoutlines(),
+            'stderr': popen.stderrlines(),
+        })
+        self.print_json_record(record)
+
+    def record_result(self, wc, exit_status, duration):
+        with self.results_lock:
+            self.exit_statuses[wc.path] = exit_status
+            self.durations[wc.path] = duration
+
+    def print_summary(self, root_wc):
+        rows = []
+        for wc in root_wc:
+            if wc.path in self.exit_statuses:
+                rows.append((wc.root_relative_path(), self.exit_statuses[wc.path], self.durations[wc.path]))
+        if len(rows) < 2:
+            return
+
+        width = max(len(row[0]) for row in rows)
+        print('\nSummary:')
+        for path, exit_status, duration in rows:
+            line = '{0:<{3}} {1:>4} {2:8.2f}s'.format(path, exit_status, duration, width)
+            print(ANSIColor.wrap(line) if exit_status else line)
+
+        failed_count = len([row for row in rows if row[1]])
+        total_duration = sum(row[2] for row in rows)
+        elapsed_time = time.perf_counter() - self.start_time
+        summary = '{} working copies, {} failed, {:.2f}s of command time in {:.2f}s'.format(len(rows), failed_count, total_duration, elapsed_time)
+        print(ANSIColor.wrap(summary) if failed_count else summary)
+
+    def finish_for_root(self, root_wc):
+        if not self.wants_json_lines() and not getattr(self.args, 'no_summary', False):
+            self.print_summary(root_wc)
+
+    def exit_status(self):
+        return 1 if any(self.exit_statuses.values()) else 0
+
+    def parallel_traversal_prints_in_completion_order(self):
+        return getattr(self.args, 'completion_order', False)
+
+    @classmethod
+    def supports_parallel_traversal(cls):
+        return True
 
     @classmethod
     def configure_argument_parser(cls, parser):
+        parser.add_argument('--completion-order', action='store_true', help='With the global -j option, print the output of each working copy as soon as its command finishes instead of in tree order')
+        parser.add_argument('--no-summary', action='store_true', help='Do not print a summary of the exit statuses and durations at the end')
         parser.add_argument('shell_command', nargs='+', help='A shell command to execute in the context of each working copy. If you need to use options starting with -, add " -- " before the first one.')
 
 
+class MaintenanceTask(object):
+    """
+    The maintenance work that :py:class:`SubcommandMaintenance` decided one working copy needs,
+    based on its :py:meth:`GitWorkingCopy.object_statistics`.
+
+    """
+
+    def __init__(self, working_copy, statistics, actions):
+        self.working_copy = working_copy
+        self.statistics = statistics
+        self.actions = actions
+        self.statistics_after = None
+        self.failed_command = None
+        self.output_lines = []
+        self.duration = None
+
+    @classmethod
+    def command_for_action(cls, action):
+        return {
+            'gc': ['git', 'gc', '--quiet'],
+            'repack': ['git', 'repack', '-a', '-d', '-l', '-q'],
+            'commit-graph': ['git', 'commit-graph', 'write', '--reachable', '--changed-paths'],
+        }[action]
+
+    def run(self, threads):
+        """Runs the actions one after another, each git process using up to ``threads`` threads."""
+        start_time = time.perf_counter()
+        try:
+            for action in self.actions:
+                command = ['git', '-c', 'pack.threads={}'.format(threads)] + self.command_for_action(action)[1:]
+                popen = FilteringPopen(command, cwd=self.working_copy.path)
+                popen.run(echo_stdout=False, echo_stderr=False, check_returncode=False)
+                self.output_lines.extend(popen.stdoutlines() + popen.stderrlines())
+                if popen.returncode():
+                    self.failed_command = ' '.join(command)
+                    break
+        finally:
+            self.working_copy.invalidate_query_cache()
+            self.duration = time.perf_counter() - start_time
+        self.statistics_after = self.working_copy.object_statistics()
+
+
+class SubcommandMaintenance(AbstractSubcommand):
+    """Run git gc, repack or commit-graph write in the working copies that need it"""
+
+    def __init__(self, arguments):
+        super(SubcommandMaintenance, self).__init__(arguments)
+        self.failed_tasks = []
+
+    def prepare_for_root(self, root_wc):
+        working_copies = list(root_wc)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, getattr(self.args, 'jobs', 1))) as executor:
+            statistics = list(executor.map(lambda wc: wc.object_statistics(), working_copies))
+
+        tasks = []
+        for wc, wc_statistics in zip(working_copies, statistics):
+            actions = self.actions_for_working_copy(wc, wc_statistics)
+            if actions:
+                tasks.append(MaintenanceTask(wc, wc_statistics, actions))
+        if not tasks:
+            print('No working copy needs maintenance')
+            return GitWorkingCopy.STOP_TRAVERSAL
+
+        for task in tasks:
+            print('{}: {} ({} loose objects, {} packs)'.format(task.working_copy, ', '.join(task.actions), task.statistics['count'], task.statistics['packs']))
+        if self.args.dry_run:
+            return GitWorkingCopy.STOP_TRAVERSAL
+
+        cpu_budget = self.args.cpu_budget or os.cpu_count() or 1
+        jobs = max(1, min(len(tasks), cpu_budget))
+        threads = max(1, cpu_budget // jobs)
+        print('Maintaining {} working copies, {} at a time with {} threads each\n'.format(len(tasks), jobs, threads))
+        def run_task(task):
+            task.run(threads)
+            return task
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            # results are printed in tree order
+            for task in executor.map(run_task, tasks):
+                self.print_task(task)
+
+        self.failed_tasks = [task for task in tasks if task.failed_command]
+        if self.failed_tasks:
+            print(ANSIColor.wrap('Maintenance failed in {}'.format(', '.join(task.working_copy.path for task in self.failed_tasks))), file=sys.stderr)
+        return GitWorkingCopy.STOP_TRAVERSAL
+
+    def exit_status(self):
+        return 1 if self.failed_tasks else 0
+
+    def actions_for_working_copy(self, wc, statistics):
+        actions = []
+        if statistics['count'] >= self.args.loose_objects:
+            actions.append('gc')
+        elif statistics['packs'] >= self.args.packs:
+            actions.append('repack')
+        # gc writes a commit-graph itself unless gc.writeCommitGraph is off
+        if 'gc' not in actions and not wc.has_commit_graph() and wc.head_commit_id():
+            actions.append('commit-graph')
+        return actions
+
+    @classmethod
+    def print_task(cls, task):
+        after = task.statistics_after
+        line = '{}: {} in {:.1f}s, {} -> {} loose objects, {} -> {} packs'.format(task.working_copy, ', '.join(task.actions), task.duration, task.statistics['count'], after['count'], task.statistics['packs'], after['packs'])
+        print(ANSIColor.wrap(line, color=ANSIColor.red if task.failed_command else ANSIColor.green))
+        if task.failed_command:
+            print('{} failed:'.format(task.failed_command))
+        with ANSIColor.terminal_color(ANSIColor.blue, ANSIColor.blue):
+            for line in task.output_lines:
+                print(line)
+
+    @classmethod
+    def configure_argument_parser(cls, parser):
+        parser.formatter_class = argparse.RawDescriptionHelpFormatter
+        parser.description = textwrap.dedent('''\
+            Checks "git count-objects -v" in each working copy and maintains only the ones that need it:
+            - "git gc" if there are too many loose objects
+            - "git repack" if there are too many pack files
+            - "git commit-graph write" if there is no commit-graph file yet
+
+            The work runs in parallel, within a budget of CPU threads that is split between the
+            concurrent git processes.''')
+        parser.add_argument('-n', '--dry-run', action='store_true', help='Only print which working copies need which maintenance')
+        parser.add_argument('--loose-objects', type=int, default=6700, metavar='COUNT', help='Run git gc if there are at least this many loose objects. The default is 6700, like the gc.auto git configuration variable')
+        parser.add_argument('--packs', type=int, default=50, metavar='COUNT', help='Repack if there are at least this many pack files. The default is 50, like the gc.autoPackLimit git configuration variable')
+        parser.add_argument('--cpu-budget', type=int, metavar='THREADS', help='The total number of threads for all git processes. The default is the number of CPUs')
+
+
+class SubcommandDaemon(AbstractSubcommand):
+    """Keep the state of the tree in memory in a background process to answer tree, status and branch faster"""
+
+    def prepare_for_root(self, root_wc):
+        if self.args.stop:
+            if not WorkingCopyStateDaemon.stop(root_wc.path):
+                print('No daemon is running for {}'.format(root_wc.path), file=sys.stderr)
+            return GitWorkingCopy.STOP_TRAVERSAL
+
+        if WorkingCopyStateDaemon.is_running(root_wc.path):
+            print('A daemon is already running for {}'.format(root_wc.path), file=sys.stderr)
+            return GitWorkingCopy.STOP_TRAVERSAL
+
+        if not self.args.detach:
+            WorkingCopyStateDaemon(root_wc.path, idle_timeout=self.args.idle_timeout * 60).serve()
+            return GitWorkingCopy.STOP_TRAVERSAL
+
+        command = [sys.executable, os.path.abspath(sys.argv[0]), '--root_path', root_wc.path, 'daemon', '--idle-timeout', str(self.args.idle_timeout)]
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        for i in range(100):
+            if WorkingCopyStateDaemon.is_running(root_wc.path):
+                break
+            time.sleep(0.1)
+        else:
+            raise Exception('The daemon for {} did not start'.format(root_wc.path))
+        return GitWorkingCopy.STOP_TRAVERSAL
+
+    @classmethod
+    def configure_argument_parser(cls, parser):
+        parser.formatter_class = argparse.RawDescriptionHelpFormatter
+        parser.description = textwrap.dedent('''\
+            Runs a daemon for the tree of working copies that keeps their state in memory and
+            watches them for changes. While it runs, the tree, status and branch subcommands
+            ask it for their output instead of running git in every working copy. They fall back
+            to doing the work themselves if no daemon is running. Use the global --no-daemon
+            option to bypass a running daemon.''')
+        parser.add_argument('--detach', action='store_true', help='Run the daemon in the background')
+        parser.add_argument('--stop', action='store_true', help='Stop the daemon running for this tree')
+        parser.add_argument('--idle-timeout', type=float, default=60, metavar='MINUTES', help='Exit after this many minutes without a request. The default is 60')
+
+
 class GitHelperCommandLineDriver(object):
 
     @classmethod
-    def subcommand_map(cls):
-        sys.path.extend(os.environ['PATH'].split(':'))
-        githelper_local = None
+    @functools.lru_cache(maxsize=None)
+    def plugin_module_path(cls):
+        """
+        Returns the path of the :file:`githelper_local.py` plug-in module, or ``None`` if there is none.
+        The :envvar:`GITHELPER_LOCAL` environment variable can point to it explicitly, otherwise it is
+        looked up in the module search path and then in the directories in :envvar:`PATH`.
+
+        """
+        path = os.environ.get('GITHELPER_LOCAL')
+        if path:
+            return path
+
+        spec = importlib.util.find_spec('githelper_local')
+        if spec and spec.origin:
+            return spec.origin
+
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            path = os.path.join(directory, 'githelper_local.py')
+            if directory and os.path.isfile(path):
+                return path
+        return None
+
+    @classmethod
+    def load_plugin_module(cls):
+        path = cls.plugin_module_path()
+        if not path:
+            return None
+        module = sys.modules.get('githelper_local')
+        if module:
+            return module
         try:
-            import githelper_local
-        except ImportError:
-            pass
+            # plug-ins can import their own helper modules from the same directory
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory not in sys.path:
+                sys.path.append(directory)
+            spec = importlib.util.spec_from_file_location('githelper_local', path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules['githelper_local'] = module
+            spec.loader.exec_module(module)
+            return module
         except Exception as e:
-            print('Unable to import githelper_local extension module:', file=sys.stderr)
+            sys.modules.pop('githelper_local', None)
+            print('Unable to import githelper_local extension module {}:'.format(path), file=sys.stderr)
             raise
 
+    @classmethod
+    def subcommand_map(cls):
+        githelper_local = cls.load_plugin_module()
+
         namespaces = globals()
         subcommand_map = {}
         if githelper_local:
@@ -1554,13 +4839,30 @@ class GitHelperCommandLineDriver(object):
 
         return subcommand_map
 
+    global_options_with_values = ('--root_path', '-j', '--jobs', '--profile-json', '--format')
+
+    @classmethod
+    def first_non_option_argument(cls):
+        arguments = iter(sys.argv[1:])
+        for argument in arguments:
+            if argument in cls.global_options_with_values:
+                next(arguments, None)
+            elif not argument.startswith('-'):
+                return argument
+        return None
+
+    @classmethod
+    def subcommand_name_in_arguments(cls, subcommand_map):
+        """Returns the name of the subcommand given on the command line, or ``None`` if there is no valid one."""
+        subcommand = cls.first_non_option_argument()
+        return subcommand if subcommand in subcommand_map else None
+
     @classmethod
     def resolve_subcommand_abbreviation(cls, subcommand_map):
-        non_option_arguments = [i for i in sys.argv[1:] if not i.startswith('-')]
-        if not non_option_arguments:
+        subcommand = cls.first_non_option_argument()
+        if not subcommand:
             return True
 
-        subcommand = non_option_arguments[0]
         if subcommand in list(subcommand_map.keys()):
             return True
 
@@ -1606,23 +4908,62 @@ class GitHelperCommandLineDriver(object):
         parser = argparse.ArgumentParser(description='Git helper')
         parser.add_argument('--root_path', help='Path to root working copy', default=os.getcwd())
         parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose debug logging')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='Process up to this many working copies concurrently, for subcommands that support it')
+        parser.add_argument('--refresh-index', action='store_true', help='Rescan the whole tree for nested working copies instead of using the index of the previous run')
+        parser.add_argument('--profile', action='store_true', help='Print statistics about the subprocesses that were run to stderr when done')
+        parser.add_argument('--profile-json', metavar='PATH', help='Write statistics about the subprocesses that were run to this file in JSON format')
+        parser.add_argument('--no-daemon', action='store_true', help='Do not ask a running daemon (see the daemon subcommand) for the output')
+        parser.add_argument('--format', choices=('text', 'jsonl'), default='text', help='With "jsonl", the tree, status, branch and each subcommands print one JSON object with the state of each working copy per line')
         subparsers = parser.add_subparsers(title='Subcommands', dest='subcommand_name')
+        # only the parser of the subcommand that runs needs its options, unless the overview is printed
+        selected_subcommand_name = cls.subcommand_name_in_arguments(subcommand_map)
         for subcommand_name, subcommand_class in list(subcommand_map.items()):
             subparser = subparsers.add_parser(subcommand_name, help=subcommand_class.__doc__)
-            subcommand_class.configure_argument_parser(subparser)
+            if selected_subcommand_name in (None, subcommand_name):
+                subcommand_class.configure_argument_parser(subparser)
 
         args = parser.parse_args()
         if args.verbose:
             logging.basicConfig(level=logging.INFO)
 
+        if not (args.profile or args.profile_json):
+            cls.run_subcommand(subcommand_map, args)
+            return
+
+        with SubprocessProfile.recording() as profile:
+            cls.run_subcommand(subcommand_map, args)
+        if args.profile_json:
+            profile.write_json(args.profile_json)
+        if args.profile:
+            profile.print_summary()
+
+    @classmethod
+    def run_subcommand(cls, subcommand_map, args):
         subcommand_class = subcommand_map[args.subcommand_name]
+        # the daemon's subprocesses would not show up in a profile
+        wants_profile = getattr(args, 'profile', False) or getattr(args, 'profile_json', None)
+        if callable(getattr(subcommand_class, 'supports_daemon', None)) and subcommand_class.supports_daemon() and not getattr(args, 'no_daemon', False) and not getattr(args, 'refresh_index', False) and not wants_profile:
+            output = WorkingCopyStateDaemon.request_output(args.subcommand_name, args)
+            if output is not None:
+                for stream_name, string in output:
+                    getattr(sys, stream_name).write(string)
+                return
         subcommand = subcommand_class(args)
 
         if subcommand_class.wants_working_copy():
+            refresh_index = args.refresh_index
+            exit_status = 0
             while subcommand:
                 wc = GitWorkingCopy(args.root_path, verbose=args.verbose)
-                wc.traverse(subcommand)
+                if refresh_index:
+                    wc.discard_discovery_index()
+                    refresh_index = False
+                jobs = args.jobs if subcommand.supports_parallel_traversal() else 1
+                wc.traverse(subcommand, jobs=jobs)
+                exit_status = exit_status or subcommand.exit_status()
                 subcommand = subcommand.chained_post_traversal_subcommand_for_root_working_copy(wc)
+            if exit_status:
+                exit(exit_status)
         else:
             subcommand()
 
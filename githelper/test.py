@@ -1,21 +1,59 @@
 #!/usr/bin/env python
 
+import io
+import json
+import argparse
+import os
+import re
+import sys
+import time
+import asyncio
+import shutil
+import tempfile
+import threading
+import benchmark
 import githelper
 import unittest
+import unittest.mock
+import contextlib
 import subprocess
 
 
+GIT_ENVIRONMENT = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com', GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(path, *args):
+    return subprocess.check_output(('git',) + args, cwd=path, env=GIT_ENVIRONMENT, text=True)
+
+
+def create_git_repository(path, files=('a',)):
+    os.makedirs(path, exist_ok=True)
+    git(path, 'init', '-q', '-b', 'master')
+    for name in files:
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(name + '\n')
+    git(path, 'add', '.')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+
+
+class GitRepositoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_directory)
+
+
 class TestFilteringPopen(unittest.TestCase):
 
     def test_nofilter(self):
-        popen = githelper.FilteringPopen('echo $\'foo1\\nfoo2\'; echo $\'bar1\\nbar2\' 1>&2', shell=True)
+        popen = githelper.FilteringPopen('printf \'foo1\\nfoo2\\n\'; printf \'bar1\\nbar2\\n\' 1>&2', shell=True)
         popen.run()
         self.assertEquals(popen.returncode(), 0)
         self.assertEquals(popen.stdoutlines(), ['foo1', 'foo2'])
         self.assertEquals(popen.stderrlines(), ['bar1', 'bar2'])
 
     def test_filter(self):
-        popen = githelper.FilteringPopen('echo $\'foo1\\nfoo2\'; echo $\'bar1\\nbar2\' 1>&2', shell=True)
+        popen = githelper.FilteringPopen('printf \'foo1\\nfoo2\\n\'; printf \'bar1\\nbar2\\n\' 1>&2', shell=True)
         rules = [
             ('-', r'^#'),
             ('-', r'1$'),
@@ -43,7 +81,7 @@ class TestFilteringPopen(unittest.TestCase):
         self.assertEquals(popen.returncode(), 0)
 
     def test_header(self):
-        popen = githelper.FilteringPopen('echo $\'foo1\\nfoo2\'; echo $\'bar1\\nbar2\' 1>&2', shell=True)
+        popen = githelper.FilteringPopen('printf \'foo1\\nfoo2\\n\'; printf \'bar1\\nbar2\\n\' 1>&2', shell=True)
         rules = [
             ('-', r'^foo'),
             ('-', r'^bar'),
@@ -51,11 +89,791 @@ class TestFilteringPopen(unittest.TestCase):
         popen.run(filter_rules=rules, header='Should not show up')
 
     def test_header(self):
-        popen = githelper.FilteringPopen('echo $\'foo1\\nfoo2\'; echo $\'bar1\\nbar2\' 1>&2', shell=True)
+        popen = githelper.FilteringPopen('printf \'foo1\\nfoo2\\n\'; printf \'bar1\\nbar2\\n\' 1>&2', shell=True)
         rules = [
             ('-', r'^foo'),
         ]
         popen.run(filter_rules=rules, header='Should show up')
 
+    def test_partial_lines(self):
+        popen = githelper.FilteringPopen('printf "foo"; sleep 0.2; printf "1\\nbar\\r\\n\\nbaz"', shell=True)
+        popen.run(echo_stdout=False)
+        self.assertEqual(popen.stdoutlines(), ['foo1', 'bar', '', 'baz'])
+
+    def test_lines_delivered_while_running(self):
+        popen = githelper.FilteringPopen('echo foo; exec sleep 30', shell=True)
+        returncodes_at_delivery = []
+        def handle_stdout_line(line):
+            returncodes_at_delivery.append(popen.popen.poll())
+            popen.popen.terminate()
+        popen.handle_stdout_line = handle_stdout_line
+        popen.run(check_returncode=False)
+        self.assertEqual(returncodes_at_delivery, [None])
+
+    def test_text_mode_arguments(self):
+        with self.assertRaises(ValueError):
+            githelper.FilteringPopen(['true'], text=False)
+        popen = githelper.FilteringPopen(['printf', '\\344\\n'], universal_newlines=True, encoding='latin-1', errors='strict')
+        popen.run(echo_stdout=False)
+        self.assertEqual(popen.stdoutlines(), ['\u00e4'])
+
+    def test_large_output_on_both_pipes(self):
+        command = 'for i in $(seq 1 20000); do echo out $i; echo err $i 1>&2; done'
+        popen = githelper.FilteringPopen(command, shell=True)
+        popen.run(echo_stdout=False, echo_stderr=False)
+        self.assertEqual(len(popen.stdoutlines()), 20000)
+        self.assertEqual(len(popen.stderrlines()), 20000)
+        self.assertEqual(popen.stderrlines()[-1], 'err 20000')
+
+    def test_multibyte_characters(self):
+        popen = githelper.FilteringPopen(['printf', '\\342\\206\\221\\n'])
+        popen.run(echo_stdout=False)
+        self.assertEqual(popen.stdoutlines(), ['\u2191'])
+
+    def test_profile(self):
+        with githelper.SubprocessProfile.recording() as profile:
+            githelper.FilteringPopen(['printf', 'foo\\nbar\\n']).run(echo_stdout=False)
+            githelper.FilteringPopen('echo foo 1>&2', shell=True).run(echo_stderr=False)
+        githelper.FilteringPopen(['true']).run()
+
+        commands = {command['command']: command for command in profile.summary()['commands']}
+        self.assertEqual(sorted(commands), ['echo foo', 'printf foo\\nbar\\n'])
+        self.assertEqual(commands['printf foo\\nbar\\n']['stdout_bytes'], 8)
+        self.assertEqual(commands['echo foo']['stderr_bytes'], 4)
+        self.assertEqual(commands['echo foo']['count'], 1)
+        self.assertIsNone(githelper.SubprocessProfile.current)
+
+
+class TestPopenOutputFilter(unittest.TestCase):
+
+    lines = [
+        '', 'foo', 'foo1', 'bar1', '# comment', 'Rebasing (1/2)', 'Successfully rebased and updated refs/heads/master.',
+        'From ../remote', '   abc..def  master     -> origin/master', 'fatal: no upstream', 'FOO', 'x foo y', 'foofoo', 'a(b)c',
+    ]
+
+    rulesets = [
+        [('-', r'^#'), ('-', r'1$')],
+        [('+', r'foo'), ('+', r'bar'), ('-', '.*')],
+        [('-', r'Rebasing'), ('-', r'Successfully rebased')],
+        [('-', r'fatal')],
+        [('-', r'^(foo)\1$'), ('+', r'foo')],
+        [('+', r'(?i)foo'), ('-', r'.')],
+        [('+', r'(?P<x>o)'), ('-', r'(?P<x>a)'), ('?', r'.')],
+        [('-', r'(?P<word>o+)(?P=word)'), ('+', r'^(a)\((b)\)'), ('-', r'\b\w+$')],
+        [('-', r'o'), ('x', r'a'), ('+', r'a'), ('-', r'')],
+        [('-', r'a(b)c'), ('-', r'(?<=x )foo')],
+    ]
+
+    @classmethod
+    def keep_line_one_by_one(cls, line, rules):
+        for action, regex in rules:
+            if re.search(regex, line):
+                if action == '+':
+                    return True
+                if action == '-':
+                    return False
+        return True
+
+    def test_rule_semantics(self):
+        for rules in self.rulesets:
+            output_filter = githelper.PopenOutputFilter(rules)
+            for line in self.lines:
+                self.assertEqual(output_filter.keep_stdoutline(line), self.keep_line_one_by_one(line, rules), (rules, line))
+
+    def test_matching_strategy(self):
+        self.assertIsNotNone(githelper.PopenOutputFilterRuleSet([('-', 'Rebasing'), ('+', 'foo bar')]).literal_rules)
+        self.assertIsNone(githelper.PopenOutputFilterRuleSet([('-', 'Rebasing'), ('-', r'1$')]).literal_rules)
+        self.assertIsNone(githelper.PopenOutputFilterRuleSet([('-', 'Rebasing'), ('-', r'(?i)foo')]).literal_rules)
+
+
+class TestParallelTraversal(unittest.TestCase):
+
+    def test_output_in_tree_order(self):
+        def iterator(item):
+            time.sleep(0.01 * (5 - item))
+            print('item', item)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            githelper.ParallelTraversal(4).run(list(range(6)), iterator)
+        self.assertEqual(output.getvalue().splitlines(), ['item {}'.format(i) for i in range(6)])
+
+    def test_stop_traversal_at_root(self):
+        visited = []
+        def iterator(item):
+            visited.append(item)
+            return githelper.GitWorkingCopy.STOP_TRAVERSAL
+
+        githelper.ParallelTraversal(4).run(list(range(6)), iterator)
+        self.assertEqual(visited, [0])
+
+    def test_exception_propagates(self):
+        def iterator(item):
+            if item == 3:
+                raise ValueError(item)
+
+        with self.assertRaises(ValueError):
+            githelper.ParallelTraversal(2).run(list(range(6)), iterator)
+
+
+class TestWorkingCopySnapshot(GitRepositoryTestCase):
+
+    def test_snapshot(self):
+        remote_path = os.path.join(self.temp_directory, 'remote')
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(remote_path, files=('a', 'b'))
+        git(self.temp_directory, 'clone', '-q', remote_path, path)
+        git(path, 'commit', '-q', '--allow-empty', '-m', 'Local commit')
+        git(path, 'mv', 'a', 'c')
+        with open(os.path.join(path, 'b'), 'w') as f:
+            f.write('changed\n')
+        with open(os.path.join(path, 'untracked'), 'w') as f:
+            f.write('untracked\n')
+
+        wc = githelper.GitWorkingCopy(path)
+        snapshot = wc.snapshot()
+        self.assertEqual(snapshot.branch(), 'master')
+        self.assertEqual(snapshot.upstream(), 'origin/master')
+        self.assertEqual(snapshot.commits_ahead_of_upstream(), 1)
+        self.assertEqual(snapshot.commits_behind_upstream(), 0)
+        self.assertEqual(snapshot.head_commit_hash(), git(path, 'rev-parse', 'HEAD')[:8])
+        self.assertEqual(sorted(snapshot.dirty_file_lines()), ['a -> c', 'b'])
+        self.assertLess(snapshot.head_commit_age().total_seconds(), 60)
+        self.assertEqual(str(snapshot), '<wc *>')
+
+    def test_special_characters_and_unborn_head(self):
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(path, files=('tab\there', 'quote"d'))
+        git(path, 'mv', 'quote"d', 'ren\u00e4med')
+        with open(os.path.join(path, 'tab\there'), 'w') as f:
+            f.write('changed\n')
+        snapshot = githelper.GitWorkingCopy(path).snapshot()
+        self.assertEqual(sorted(snapshot.dirty_file_lines()), ['quote"d -> ren\u00e4med', 'tab\there'])
+
+        empty_path = os.path.join(self.temp_directory, 'empty')
+        os.makedirs(empty_path)
+        git(empty_path, 'init', '-q', '-b', 'master')
+        self.assertIsNone(githelper.GitWorkingCopy(empty_path).snapshot().head_commit_hash())
+
+    def test_local_only_branch(self):
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(path)
+        snapshot = githelper.GitWorkingCopy(path).snapshot()
+        self.assertFalse(snapshot.has_upstream())
+        self.assertIsNone(snapshot.commits_ahead_of_upstream())
+        self.assertFalse(snapshot.is_dirty())
+        self.assertEqual(str(snapshot), '<wc l>')
+
+    def test_is_dirty(self):
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(path, files=('a', 'b'))
+        wc = githelper.GitWorkingCopy(path)
+        with open(os.path.join(path, 'untracked'), 'w') as f:
+            f.write('untracked\n')
+        self.assertFalse(wc.is_dirty())
+
+        with open(os.path.join(path, 'a'), 'w') as f:
+            f.write('changed\n')
+        self.assertTrue(wc.is_dirty())
+        git(path, 'add', 'a')
+        self.assertTrue(wc.is_dirty())
+        self.assertEqual(wc.snapshot().dirty_file_lines(), ['a'])
+        git(path, 'commit', '-q', '-m', 'Change')
+        self.assertFalse(wc.is_dirty())
+
+
+class TestQueryMemoization(GitRepositoryTestCase):
+
+    def test_memoization_and_invalidation(self):
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(path)
+        git(path, 'branch', 'other')
+        wc = githelper.GitWorkingCopy(path)
+        self.assertIsNot(wc.snapshot(), wc.snapshot())
+
+        with wc.memoized_queries():
+            self.assertIsNone(wc.cached_snapshot())
+            snapshot = wc.snapshot()
+            self.assertIs(wc.snapshot(), snapshot)
+            self.assertIs(wc.cached_snapshot(), snapshot)
+            self.assertEqual(wc.current_branch(), 'master')
+            branch_names = wc.branch_names()
+            branch_names.append('modified')
+            self.assertEqual(wc.branch_names(), ['master', 'other'])
+
+            wc.switch_to_branch('other')
+            self.assertIsNone(wc.cached_snapshot())
+            self.assertIsNot(wc.snapshot(), snapshot)
+            self.assertEqual(wc.current_branch(), 'other')
+
+        self.assertEqual(wc.query_cache, {})
+
+
+class TestAsyncGitWorkingCopy(GitRepositoryTestCase):
+
+    def test_traverse(self):
+        remote_path = os.path.join(self.temp_directory, 'remote')
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(remote_path)
+        git(self.temp_directory, 'clone', '-q', remote_path, root_path)
+        git(root_path, 'commit', '-q', '--allow-empty', '-m', 'Local commit')
+        for name in ('a', 'b'):
+            create_git_repository(os.path.join(root_path, 'sub', name), files=('README',))
+        with open(os.path.join(root_path, 'sub', 'b', 'README'), 'w') as f:
+            f.write('changed\n')
+
+        async def state(wc):
+            return wc.path, await wc.current_branch(), await wc.is_dirty(), len(await wc.commits_not_in_upstream()) if await wc.current_branch_has_upstream() else None
+
+        async def traverse():
+            return await githelper.AsyncGitWorkingCopy(root_path, max_processes=2).traverse(state)
+
+        expected = [
+            (root_path, 'master', False, 1),
+            (os.path.join(root_path, 'sub', 'a'), 'master', False, None),
+            (os.path.join(root_path, 'sub', 'b'), 'master', True, None),
+        ]
+        self.assertEqual(asyncio.run(traverse()), expected)
+
+        async def head_commit_age():
+            return await githelper.AsyncGitWorkingCopy(root_path).head_commit_age()
+        self.assertLess(asyncio.run(head_commit_age()).total_seconds(), 60)
+
+
+class TestFetchScheduler(GitRepositoryTestCase):
+
+    def test_host_for_url(self):
+        host_for_url = githelper.FetchScheduler.host_for_url
+        self.assertEqual(host_for_url('git@github.com:liyanage/git-tools.git'), 'github.com')
+        self.assertEqual(host_for_url('ssh://git@Example.com:2222/repo.git'), 'example.com')
+        self.assertEqual(host_for_url('https://example.com/repo.git'), 'example.com')
+        self.assertIsNone(host_for_url('file:///tmp/repo.git'))
+        self.assertIsNone(host_for_url('/tmp/repo.git'))
+        self.assertTrue(githelper.FetchScheduler.is_ssh_url('git@github.com:liyanage/git-tools.git'))
+        self.assertFalse(githelper.FetchScheduler.is_ssh_url('https://example.com/repo.git'))
+
+    def test_fetch(self):
+        remote_paths = [os.path.join(self.temp_directory, name) for name in ('remote1', 'remote2')]
+        for remote_path in remote_paths:
+            create_git_repository(remote_path)
+        root_path = os.path.join(self.temp_directory, 'root')
+        git(self.temp_directory, 'clone', '-q', remote_paths[0], root_path)
+        git(root_path, 'clone', '-q', remote_paths[0], 'same')
+        git(root_path, 'clone', '-q', 'file://' + remote_paths[1], 'other')
+        for remote_path in remote_paths:
+            git(remote_path, 'commit', '-q', '--allow-empty', '-m', 'New commit')
+            git(remote_path, 'branch', 'new')
+
+        working_copies = list(githelper.GitWorkingCopy(root_path))
+        finished_tasks = []
+        tasks = githelper.FetchScheduler(jobs=3).run(working_copies, task_handler=finished_tasks.append)
+        self.assertEqual(finished_tasks, tasks)
+        self.assertTrue(all(task.succeeded() for task in tasks))
+        self.assertIs(tasks[2].leader, tasks[0])
+        self.assertIsNone(tasks[1].leader)
+
+        for wc, remote_path in zip(working_copies, remote_paths[:1] + remote_paths[::-1]):
+            self.assertEqual(git(wc.path, 'rev-parse', 'origin/new'), git(remote_path, 'rev-parse', 'master'))
+            self.assertEqual(git(wc.path, 'symbolic-ref', 'refs/remotes/origin/HEAD').strip(), 'refs/remotes/origin/master')
+
+
+class TestSubcommandPull(GitRepositoryTestCase):
+
+    def test_parallel_pull(self):
+        remote_path = os.path.join(self.temp_directory, 'remote')
+        create_git_repository(remote_path)
+        root_path = os.path.join(self.temp_directory, 'root')
+        git(self.temp_directory, 'clone', '-q', remote_path, root_path)
+        for name in ('child', 'broken'):
+            git(root_path, 'clone', '-q', remote_path, name)
+        create_git_repository(os.path.join(root_path, 'local'))
+        with open(os.path.join(root_path, 'local', 'a'), 'w') as f:
+            f.write('local only change\n')
+        git(os.path.join(root_path, 'child'), 'clone', '-q', remote_path, 'grandchild')
+        git(os.path.join(root_path, 'broken'), 'remote', 'set-url', 'origin', os.path.join(self.temp_directory, 'missing'))
+        with open(os.path.join(root_path, 'a'), 'w') as f:
+            f.write('local change\n')
+        create_git_repository(remote_path, files=('b',))
+        remote_head = git(remote_path, 'rev-parse', 'HEAD').strip()
+
+        args = argparse.Namespace(stash_pop=True, fail_fast=False)
+        pull = githelper.SubcommandPull(args)
+        root_wc = githelper.GitWorkingCopy(root_path)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            root_wc.traverse(pull, jobs=4)
+        self.assertEqual(pull.exit_status(), 1)
+        self.assertIsInstance(pull.chained_post_traversal_subcommand_for_root_working_copy(root_wc), githelper.SubcommandBranch)
+
+        results = {os.path.relpath(path, root_path): result for path, result in pull.results.items()}
+        self.assertEqual({name: result.status for name, result in results.items()},
+                         {'.': 'updated', 'child': 'updated', 'child/grandchild': 'updated', 'broken': 'failed', 'local': 'no upstream'})
+        self.assertIsNone(results['local'].stash_commit)
+        with open(os.path.join(root_path, 'local', 'a')) as f:
+            self.assertEqual(f.read(), 'local only change\n')
+        self.assertEqual(results['.'].new_head, remote_head)
+        self.assertTrue(results['.'].stash_applied)
+        with open(os.path.join(root_path, 'a')) as f:
+            self.assertEqual(f.read(), 'local change\n')
+        self.assertIn('Summary:', output.getvalue())
+
+
+class TestSubcommandBranch(GitRepositoryTestCase):
+
+    def branch_output(self, root_path, **arguments):
+        branch = githelper.SubcommandBranch(argparse.Namespace(**arguments))
+        computed_rows = []
+        row_for_working_copy = branch.row_for_working_copy
+        def counting_row_for_working_copy(wc):
+            computed_rows.append(wc.path)
+            return row_for_working_copy(wc)
+        branch.row_for_working_copy = counting_row_for_working_copy
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            githelper.GitWorkingCopy(root_path).traverse(branch, jobs=arguments.get('jobs', 1))
+        return output.getvalue().splitlines(), computed_rows
+
+    def test_branch(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        for name in ('sub1', 'sub2', 'sub2/sub3'):
+            create_git_repository(os.path.join(root_path, name), files=('README',))
+        git(os.path.join(root_path, 'sub2'), 'checkout', '-q', '-b', 'a-long-branch-name')
+
+        lines, computed_rows = self.branch_output(root_path, jobs=4)
+        self.assertEqual(len(computed_rows), 4)
+        self.assertEqual(len(set(computed_rows)), 4)
+        self.assertEqual([line.split()[0] for line in lines], ['<root', '<root/sub1', '<root/sub2', '<root/sub2/sub3'])
+        self.assertEqual(len(set(len(line.rstrip()) for line in lines)), 1)
+        self.assertEqual(len(set(line.index(' master') for line in lines if ' master' in line)), 1)
+
+        stream_lines, computed_rows = self.branch_output(root_path, jobs=4, stream=True)
+        # the last column is the head commit age, which can tick over between the two runs
+        self.assertEqual([line.split()[:-1] for line in stream_lines], [line.split()[:-1] for line in lines])
+        self.assertEqual(len(computed_rows), 4)
+
+
+class TestSubcommandEach(GitRepositoryTestCase):
+
+    def test_parallel_each(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        for name in ('sub1', 'sub2'):
+            create_git_repository(os.path.join(root_path, name), files=('README',))
+        # the root finishes first because it runs alone, then sub2 before sub1
+        command = 'case $PWD in */sub1) sleep 0.5; echo $PWD; exit 3;; esac; echo $PWD'
+
+        for completion_order, expected_order in ((False, ['root', 'sub1', 'sub2']), (True, ['root', 'sub2', 'sub1'])):
+            each = githelper.SubcommandEach(argparse.Namespace(shell_command=[command], completion_order=completion_order))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                root_wc = githelper.GitWorkingCopy(root_path)
+                root_wc.traverse(each, jobs=3)
+            lines = output.getvalue().splitlines()
+            headers = [re.sub(r'^.*<root/?|[ l*]*>.*$', '', line) or 'root' for line in lines if '<root' in line]
+            self.assertEqual(headers, expected_order)
+            self.assertEqual([os.path.basename(path) for path in sorted(each.exit_statuses)], ['root', 'sub1', 'sub2'])
+            self.assertEqual(each.exit_statuses[os.path.join(root_path, 'sub1')], 3)
+            self.assertGreater(each.durations[os.path.join(root_path, 'sub1')], 0.4)
+            self.assertIn('3 working copies, 1 failed', output.getvalue())
+            self.assertEqual(each.exit_status(), 1)
+
+
+class TestSubcommandMaintenance(GitRepositoryTestCase):
+
+    def test_maintenance(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path, files=('a', 'b', 'c', 'd'))
+        create_git_repository(os.path.join(root_path, 'sub'), files=('README',))
+        root_wc = githelper.GitWorkingCopy(root_path)
+        wcs = list(root_wc)
+        self.assertEqual([wc.object_statistics()['count'] for wc in wcs], [6, 3])
+        self.assertFalse(any(wc.has_commit_graph() for wc in wcs))
+
+        args = argparse.Namespace(jobs=2, dry_run=False, loose_objects=5, packs=50, cpu_budget=2)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            root_wc.traverse(githelper.SubcommandMaintenance(args))
+        self.assertIn('2 working copies, 2 at a time with 1 threads each', output.getvalue())
+        self.assertEqual([wc.object_statistics()['count'] for wc in wcs], [0, 3])
+        self.assertEqual([wc.object_statistics()['packs'] for wc in wcs], [1, 0])
+        self.assertTrue(all(wc.has_commit_graph() for wc in wcs))
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            root_wc.traverse(githelper.SubcommandMaintenance(args))
+        self.assertEqual(output.getvalue(), 'No working copy needs maintenance\n')
+
+    def test_failed_task(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        create_git_repository(os.path.join(root_path, 'sub'), files=('README',))
+        root_wc = githelper.GitWorkingCopy(root_path)
+
+        args = argparse.Namespace(jobs=2, dry_run=False, loose_objects=1, packs=50, cpu_budget=2)
+        maintenance = githelper.SubcommandMaintenance(args)
+        with unittest.mock.patch.object(githelper.MaintenanceTask, 'command_for_action', return_value=['git', 'no-such-command']), \
+                contextlib.redirect_stdout(io.StringIO()) as output, contextlib.redirect_stderr(io.StringIO()) as error_output:
+            root_wc.traverse(maintenance)
+        self.assertIn('git -c pack.threads=1 no-such-command failed:', output.getvalue())
+        self.assertIn('Maintenance failed in {}, {}'.format(root_path, os.path.join(root_path, 'sub')), error_output.getvalue())
+        self.assertEqual(maintenance.exit_status(), 1)
+        self.assertEqual(githelper.SubcommandMaintenance(args).exit_status(), 0)
+
+
+class TestJSONLinesOutput(GitRepositoryTestCase):
+
+    def json_records(self, subcommand_class, root_path, **arguments):
+        subcommand = subcommand_class(argparse.Namespace(format='jsonl', **arguments))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            githelper.GitWorkingCopy(root_path).traverse(subcommand, jobs=arguments.get('jobs', 1))
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_state_records(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        create_git_repository(os.path.join(root_path, 'sub'), files=('README',))
+        with open(os.path.join(root_path, 'a'), 'w') as f:
+            f.write('change\n')
+
+        for subcommand_class in (githelper.SubcommandTree, githelper.SubcommandStatus, githelper.SubcommandBranch):
+            records = self.json_records(subcommand_class, root_path, jobs=2)
+            self.assertEqual([record['relative_path'] for record in records], ['root', 'root/sub'])
+            self.assertEqual(records[0]['dirty_files'], ['a'])
+            self.assertEqual(records[1]['dirty_files'], [])
+            self.assertEqual(records[0]['head'], git(root_path, 'rev-parse', 'HEAD').strip())
+            self.assertEqual((records[0]['branch'], records[0]['upstream'], records[0]['ahead']), ('master', None, None))
+
+        records = self.json_records(githelper.SubcommandEach, root_path, jobs=2, shell_command=['echo out; echo err >&2; exit 3'])
+        self.assertEqual([(record['exit_status'], record['stdout'], record['stderr']) for record in records], [(3, ['out'], ['err'])] * 2)
+
+
+class TestWorkingCopyStateDaemon(GitRepositoryTestCase):
+
+    def run_daemon(self, root_path):
+        daemon = githelper.WorkingCopyStateDaemon(root_path)
+        daemon.polling_interval = 0.1
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(githelper.WorkingCopyStateDaemon.stop, root_path)
+        for i in range(100):
+            if githelper.WorkingCopyStateDaemon.is_running(root_path):
+                return daemon
+            time.sleep(0.05)
+        self.fail('daemon did not start')
+
+    def daemon_output(self, root_path, subcommand_name):
+        args = argparse.Namespace(root_path=root_path, jobs=1, format='text', subcommand_name=subcommand_name)
+        output = githelper.WorkingCopyStateDaemon.request_output(subcommand_name, args)
+        return ''.join(string for stream_name, string in output if stream_name == 'stdout')
+
+    def check_daemon(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        create_git_repository(os.path.join(root_path, 'sub'), files=('README',))
+        self.assertIsNone(githelper.WorkingCopyStateDaemon.request_output('tree', argparse.Namespace(root_path=root_path)))
+        daemon = self.run_daemon(root_path)
+
+        self.assertEqual(self.daemon_output(root_path, 'tree'), '|<root l>\n|--<root/sub l>\n')
+        with open(os.path.join(root_path, 'sub', 'README'), 'w') as f:
+            f.write('change\n')
+        time.sleep(0.3)
+        self.assertEqual(self.daemon_output(root_path, 'tree'), '|<root l>\n|--<root/sub l*>\n')
+
+        create_git_repository(os.path.join(root_path, 'sub', 'nested'), files=('README',))
+        git(os.path.join(root_path, 'sub'), 'checkout', '-q', '-b', 'topic')
+        time.sleep(0.3)
+        self.assertEqual(self.daemon_output(root_path, 'tree'), '|<root l>\n|--<root/sub l*>\n|----<root/sub/nested l>\n')
+        self.assertIn(' topic ', self.daemon_output(root_path, 'branch'))
+        return daemon
+
+    def test_inotify(self):
+        if not githelper.InotifyWatcher.is_available():
+            self.skipTest('inotify is not available')
+        self.assertIsInstance(self.check_daemon().watcher, githelper.InotifyWatcher)
+
+    def test_polling(self):
+        with unittest.mock.patch.object(githelper.InotifyWatcher, 'is_available', return_value=False):
+            self.assertIsInstance(self.check_daemon().watcher, githelper.PollingWatcher)
+
+    def test_profile_bypasses_daemon(self):
+        root_path = os.path.join(self.temp_directory, 'root')
+        create_git_repository(root_path)
+        args = argparse.Namespace(root_path=root_path, jobs=1, format='text', subcommand_name='tree', verbose=False, refresh_index=False, no_daemon=False, profile=True, profile_json=None)
+        subcommand_map = githelper.GitHelperCommandLineDriver.subcommand_map()
+        with unittest.mock.patch.object(githelper.WorkingCopyStateDaemon, 'request_output') as request_output, contextlib.redirect_stdout(io.StringIO()) as output:
+            with githelper.SubprocessProfile.recording() as profile:
+                githelper.GitHelperCommandLineDriver.run_subcommand(subcommand_map, args)
+        request_output.assert_not_called()
+        self.assertEqual(output.getvalue(), '|<root l>\n')
+        self.assertGreater(profile.summary()['subprocess_count'], 0)
+
+
+class TestGitObjectReader(GitRepositoryTestCase):
+
+    def test_read_object(self):
+        paths = [os.path.join(self.temp_directory, name) for name in ('wc1', 'wc2', 'wc3')]
+        for path in paths:
+            create_git_repository(path)
+        wc = githelper.GitWorkingCopy(paths[0])
+        head_commit = git(paths[0], 'rev-parse', 'HEAD').strip()
+
+        object_id, object_type, contents = wc.read_object('HEAD:a')
+        self.assertEqual((object_type, contents), ('blob', b'a\n'))
+        self.assertIsNone(wc.read_object('does-not-exist'))
+        self.assertEqual(wc.commit_timestamp(head_commit), int(git(paths[0], 'log', '-1', '--format=%ct')))
+
+        pool = githelper.GitObjectReaderPool(size=2)
+        readers = [pool.reader_for_path(path) for path in paths]
+        for path in paths:
+            self.assertEqual(pool.read_object(path, 'HEAD:a')[1], 'blob')
+        self.assertEqual(list(pool.readers), paths[1:])
+        self.assertTrue(readers[0].is_closed)
+        pool.close_all()
+        self.assertIsNone(readers[2].process)
+
+
+class TestGitRefReader(GitRepositoryTestCase):
+
+    def assertMatchesGit(self, path):
+        wc = githelper.GitWorkingCopy(path)
+        ref_reader = wc.ref_reader()
+        self.assertIsNotNone(ref_reader)
+        self.assertEqual(ref_reader.branch_names(), [line[2:] for line in git(path, 'branch', '-a').splitlines()])
+        self.assertEqual(ref_reader.current_branch(), wc.snapshot().branch())
+        self.assertEqual(os.path.realpath(wc.git_directory()), os.path.realpath(os.path.join(path, git(path, 'rev-parse', '--git-dir').strip())))
+
+    def test_refs(self):
+        remote_path = os.path.join(self.temp_directory, 'remote')
+        path = os.path.join(self.temp_directory, 'wc')
+        create_git_repository(remote_path)
+        git(remote_path, 'branch', 'feature/remote')
+        git(self.temp_directory, 'clone', '-q', remote_path, path)
+        git(path, 'branch', 'packed')
+        git(path, 'pack-refs', '--all')
+        git(path, 'branch', 'feature/loose')
+        git(path, 'branch', 'zz')
+        self.assertMatchesGit(path)
+
+        git(path, 'branch', '-D', 'packed')
+        git(path, 'checkout', '-q', '-b', 'other')
+        self.assertMatchesGit(path)
+
+        git(path, 'checkout', '-q', '--detach')
+        self.assertMatchesGit(path)
+
+        worktree_path = os.path.join(self.temp_directory, 'worktree')
+        git(path, 'worktree', 'add', '-q', worktree_path, 'zz')
+        self.assertMatchesGit(worktree_path)
+        self.assertEqual(githelper.GitWorkingCopy(worktree_path).current_branch(), 'zz')
+
+
+class TestWorkingCopyDiscovery(GitRepositoryTestCase):
+
+    def test_discovery(self):
+        root = self.temp_directory
+        for path in ('a', 'b/c', 'b/c/d', 'e/f', 'node_modules/g', 'build/h'):
+            os.makedirs(os.path.join(root, path, '.git'))
+        os.symlink(root, os.path.join(root, 'e', 'loop'))
+
+        expected = [os.path.join(root, path) for path in ('a', 'b/c', 'e/f')]
+        for jobs in (1, 4):
+            discovery = githelper.WorkingCopyDiscovery(['build/*'], jobs=jobs)
+            self.assertEqual(discovery.nested_working_copy_paths(root), expected)
+
+        discovery = githelper.WorkingCopyDiscovery()
+        self.assertEqual(discovery.nested_working_copy_paths(os.path.join(root, 'b', 'c'), root), [os.path.join(root, 'b/c/d')])
+        self.assertIn(os.path.join(root, 'build/h'), discovery.nested_working_copy_paths(root))
+
+
+    def test_index(self):
+        root = os.path.join(self.temp_directory, 'root')
+        for path in ('a', 'b/c', 'd/e/f'):
+            os.makedirs(os.path.join(root, path, '.git'))
+        index_path = os.path.join(self.temp_directory, 'index.json')
+
+        def discovery_and_scan_count():
+            discovery = githelper.WorkingCopyDiscovery()
+            discovery.index = githelper.WorkingCopyDiscoveryIndex.load(index_path, root, discovery.exclude_patterns)
+            discovery.index.racy_interval = 0
+            scanned_paths = []
+            scan_directory = discovery.scan_directory
+            def counting_scan_directory(path, *args, **kwargs):
+                scanned_paths.append(path)
+                return scan_directory(path, *args, **kwargs)
+            discovery.scan_directory = counting_scan_directory
+            return discovery, scanned_paths
+
+        discovery, scanned_paths = discovery_and_scan_count()
+        self.assertEqual(discovery.nested_working_copy_paths(root, root), [os.path.join(root, path) for path in ('a', 'b/c', 'd/e/f')])
+        discovery.index.save()
+        self.assertEqual(len(scanned_paths), 7)
+
+        os.makedirs(os.path.join(root, 'd', 'g', '.git'))
+        discovery, scanned_paths = discovery_and_scan_count()
+        self.assertEqual(discovery.nested_working_copy_paths(root, root), [os.path.join(root, path) for path in ('a', 'b/c', 'd/e/f', 'd/g')])
+        self.assertEqual(scanned_paths, [os.path.join(root, 'd'), os.path.join(root, 'd/g')])
+
+    def test_lazy_iteration(self):
+        root = os.path.join(self.temp_directory, 'root')
+        for path in ('', 'a', 'b'):
+            create_git_repository(os.path.join(root, path), files=('README',))
+
+        wc = githelper.GitWorkingCopy(root)
+        iterator = iter(wc)
+        self.assertIs(next(iterator), wc)
+        self.assertEqual(next(iterator).path, os.path.join(root, 'a'))
+        self.assertIsNone(wc.child_list)
+        self.assertEqual([child.path for child in iterator], [os.path.join(root, 'b')])
+        self.assertEqual([child.path for child in wc.children()], [os.path.join(root, path) for path in ('a', 'b')])
+
+        with self.assertRaises(Exception):
+            githelper.GitWorkingCopy(self.temp_directory)
+
+    def test_working_copy_tree(self):
+        root = os.path.join(self.temp_directory, 'root')
+        for path in ('', 'a', 'a/b', 'c'):
+            create_git_repository(os.path.join(root, path), files=('README',))
+
+        wc = githelper.GitWorkingCopy(root)
+        working_copies = {os.path.relpath(item.path, root): item for item in wc}
+        nested = working_copies[os.path.join('a', 'b')]
+        self.assertEqual(len(wc.tree), 4)
+        self.assertIs(nested.tree, wc.tree)
+        self.assertIs(nested.parent, working_copies['a'])
+        self.assertIs(nested.root_working_copy(), wc)
+        self.assertEqual(nested.ancestors(), [working_copies['a'], wc])
+        self.assertEqual([item.depth() for item in (wc, working_copies['a'], nested, working_copies['c'])], [0, 1, 2, 1])
+        self.assertIsNone(wc.parent)
+        self.assertTrue(wc.is_root() and not nested.is_root())
+        self.assertIs(nested.path, sys.intern(os.path.join(root, 'a', 'b')))
+        self.assertFalse(hasattr(nested, '__dict__'))
+
+
+class TestCommandLineDriver(GitRepositoryTestCase):
+
+    def test_lazy_imports(self):
+        code = 'import sys, githelper; print(sorted(m for m in ("asyncio", "socket", "concurrent.futures") if m in sys.modules))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(githelper.__file__)), text=True)
+        self.assertEqual(output.strip(), '[]')
+
+    def test_lazy_module_keeps_proxy(self):
+        proxy = githelper.LazyModule('textwrap')
+        self.assertEqual(proxy.dedent('  foo'), 'foo')
+        self.assertIs(proxy.module, sys.modules['textwrap'])
+        self.assertIsInstance(githelper.textwrap, githelper.LazyModule)
+
+    def test_plugin_module(self):
+        plugin_path = os.path.join(self.temp_directory, 'plugin.py')
+        with open(plugin_path, 'w') as f:
+            f.write('import githelper\n\nclass SubcommandFooBar(githelper.AbstractSubcommand):\n    pass\n')
+        githelper.GitHelperCommandLineDriver.plugin_module_path.cache_clear()
+        self.addCleanup(githelper.GitHelperCommandLineDriver.plugin_module_path.cache_clear)
+        self.addCleanup(sys.modules.pop, 'githelper_local', None)
+        with unittest.mock.patch.dict(os.environ, {'GITHELPER_LOCAL': plugin_path}):
+            subcommand_map = githelper.GitHelperCommandLineDriver.subcommand_map()
+        self.assertEqual(subcommand_map['foo-bar'].__name__, 'SubcommandFooBar')
+        self.assertIn('branch', subcommand_map)
+
+
+class TestUpstreamCounts(GitRepositoryTestCase):
+
+    def test_commit_counts(self):
+        builder = benchmark.FixtureBuilder(os.path.join(self.temp_directory, 'fixture'), repositories=1, depth=1, history=5, dirty=0, divergence=3)
+        builder.build()
+        wc = githelper.GitWorkingCopy(builder.tree_path())
+        self.assertEqual(wc.commit_counts_relative_to_upstream(), (3, 3))
+        self.assertEqual(wc.commit_counts_relative_to_upstream(), (len(wc.commits_not_in_upstream()), len(wc.commits_only_in_upstream())))
+        self.assertEqual(wc.commit_counts_relative_to_upstream('HEAD~1'), (1, 0))
+        self.assertEqual(asyncio.run(githelper.AsyncGitWorkingCopy(wc).commit_counts_relative_to_upstream()), (3, 3))
+
+        local_path = os.path.join(self.temp_directory, 'local')
+        create_git_repository(local_path)
+        self.assertIsNone(githelper.GitWorkingCopy(local_path).commit_counts_relative_to_upstream())
+
+    def test_commit_graph_hint(self):
+        builder = benchmark.FixtureBuilder(os.path.join(self.temp_directory, 'fixture'), repositories=1, depth=1, history=5, dirty=0, divergence=3)
+        builder.build()
+        wc = githelper.GitWorkingCopy(builder.tree_path())
+        self.assertFalse(wc.has_commit_graph())
+
+        branch = githelper.SubcommandBranch(argparse.Namespace())
+        branch.commit_graph_hint_threshold = 6
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as error_output:
+            wc.traverse(branch)
+        self.assertIn('6 commits away from its upstream branch and has no commit-graph file', error_output.getvalue())
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            wc.write_commit_graph()
+        self.assertTrue(wc.has_commit_graph())
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as error_output:
+            wc.traverse(branch)
+        self.assertEqual(error_output.getvalue(), '')
+
+
+class TestLogStreaming(GitRepositoryTestCase):
+
+    def test_iter_log(self):
+        path = os.path.join(self.temp_directory, 'repository')
+        create_git_repository(path)
+        subjects = ['Caf\u00e9 number {}'.format(index) for index in range(20)]
+        for subject in subjects:
+            git(path, 'commit', '-q', '--allow-empty', '-m', subject, '-m', 'Body line one\nbody line two')
+        wc = githelper.GitWorkingCopy(path)
+
+        revisions = list(wc.iter_log(['HEAD'], chunk_size=7))
+        self.assertEqual([revision.message for revision in revisions], list(reversed(subjects)) + ['Initial commit'])
+        self.assertEqual(revisions[0].revision, git(path, 'rev-parse', 'HEAD').strip())
+        self.assertEqual(revisions[0].author, 'Test')
+        self.assertFalse(hasattr(revisions[0], '__dict__'))
+        self.assertEqual(wc.commit_count(['HEAD~5..HEAD']), 5)
+        self.assertEqual([revision.message for revision in wc.iter_log(['HEAD'], max_count=1, skip=2)], [subjects[-3]])
+
+        log = wc.iter_log(['HEAD'], chunk_size=7)
+        self.assertEqual(next(log).message, subjects[-1])
+        log.close()
+
+        with self.assertRaisesRegex(Exception, 'no-such-branch'):
+            list(wc.iter_log(['no-such-branch']))
+        with contextlib.redirect_stderr(io.StringIO()) as error_output:
+            self.assertEqual(list(wc.iter_log(['no-such-branch'], check_returncode=False)), [])
+        self.assertIn('no-such-branch', error_output.getvalue())
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(wc.commits_not_in_upstream(), [])
+
+    def test_squash_to_fork_point(self):
+        path = os.path.join(self.temp_directory, 'repository')
+        create_git_repository(path)
+        git(path, 'checkout', '-q', '-b', 'feature', '--track', 'master')
+        for index in range(3):
+            git(path, 'commit', '-q', '--allow-empty', '-m', 'Feature commit {}'.format(index))
+        wc = githelper.GitWorkingCopy(path)
+
+        squash = githelper.SubcommandSquashToForkPoint(argparse.Namespace(target_branch='master', dry_run=True))
+        with contextlib.redirect_stdout(io.StringIO()) as output, unittest.mock.patch('builtins.input', return_value='1'):
+            wc.traverse(squash)
+        self.assertIn('3 commits in head but not in fork-point', output.getvalue())
+        self.assertIn('3) {}'.format(git(path, 'rev-parse', 'HEAD').strip()[:12]), output.getvalue())
+        self.assertIn('git commit -C {}'.format(git(path, 'rev-parse', 'HEAD~2').strip()), output.getvalue())
+
+
+class TestBenchmarkFixture(GitRepositoryTestCase):
+
+    def test_fixture(self):
+        fixture_path = os.path.join(self.temp_directory, 'fixture')
+        builder = benchmark.FixtureBuilder(fixture_path, repositories=4, depth=2, history=3, dirty=1, divergence=2)
+        builder.build()
+
+        paths = [wc.path for wc in githelper.GitWorkingCopy(builder.tree_path())]
+        self.assertEqual(paths, builder.working_copy_paths())
+        self.assertEqual(len(paths), 4)
+
+        snapshot = githelper.GitWorkingCopy(paths[-1]).snapshot()
+        self.assertEqual(snapshot.commits_ahead_of_upstream(), 2)
+        self.assertEqual(snapshot.commits_behind_upstream(), 2)
+        self.assertEqual(snapshot.dirty_file_lines(), ['file0'])
+
+
 if __name__ == '__main__':
     unittest.main()